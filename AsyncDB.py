@@ -0,0 +1,98 @@
+# coding=utf-8
+# This file is part of the uberserver (GPL v2 or later), see LICENSE
+# runs SQLUsers handler calls on db threads, so that slow queries don't stall the reactor
+
+import time
+import logging
+import threading
+
+from twisted.internet import reactor, threads
+from twisted.python.threadpool import ThreadPool
+
+class DBThreadPool:
+	'''
+	read() calls need their result and may run concurrently on up to n threads.
+	write() calls are fire-and-forget and run in order on a single thread, so e.g.
+	an op followed by a deop reaches the db in that order.
+	Every call runs in its own transaction of a thread-local session, see session_manager.guarded
+	'''
+	def __init__(self, root, n_threads):
+		self._root = root
+		self.readpool = ThreadPool(1, n_threads, 'dbread')
+		if n_threads > 1:
+			self.writepool = ThreadPool(1, 1, 'dbwrite')
+		else:
+			self.writepool = self.readpool # sqlite: a single thread keeps everything in order
+		self.stats = {} # name -> [calls, seconds spent on db threads]
+		self.lock = threading.Lock()
+
+	def start(self):
+		self.readpool.start()
+		if self.writepool is not self.readpool:
+			self.writepool.start()
+
+	def stop(self):
+		# finishes all queued calls first
+		self.readpool.stop()
+		if self.writepool is not self.readpool:
+			self.writepool.stop()
+
+	def _run(self, func, args, kwargs):
+		start = time.time()
+		if self._root.query_profiler:
+			self._root.query_profiler.tag(func.__qualname__)
+		try:
+			return self._root.session_manager.guarded(func, *args, **kwargs)
+		finally:
+			self._record(func.__qualname__, time.time() - start)
+
+	def _record(self, name, duration):
+		with self.lock:
+			if name in self.stats:
+				self.stats[name][0] += 1
+				self.stats[name][1] += duration
+			else:
+				self.stats[name] = [1, duration]
+
+	def read(self, func, *args, **kwargs):
+		return threads.deferToThreadPool(reactor, self.readpool, self._run, func, args, kwargs)
+
+	def write(self, func, *args, **kwargs):
+		d = threads.deferToThreadPool(reactor, self.writepool, self._run, func, args, kwargs)
+		d.addErrback(self._write_failed, func)
+		return d
+
+	def _write_failed(self, failure, func):
+		logging.error("db write %s failed: %s" % (func.__qualname__, failure.getTraceback()))
+
+	def queue_length(self):
+		return self.readpool.q.qsize() + (self.writepool.q.qsize() if self.writepool is not self.readpool else 0)
+
+	def idle(self):
+		# nothing queued or running, results of finished calls may still be on their way to the reactor thread
+		return self.queue_length() == 0 and not self.readpool.working and not self.writepool.working
+
+	def log_stats(self):
+		logging.info("DB thread pool (calls, total seconds, avg ms):")
+		with self.lock:
+			for name in sorted(self.stats):
+				calls, duration = self.stats[name]
+				logging.info(" %s %d %.3f %.2f" % (name, calls, duration, 1000 * duration / calls))
+
+class DeferredHandler:
+	'''
+	wraps a SQLUsers handler: handler.method(...) becomes a call on the db pool
+	that returns a Deferred (or, if ordered, is queued on the write thread)
+	the results must not be ORM objects, those are detached once the call returns
+	'''
+	def __init__(self, pool, handler, ordered=False):
+		self._pool = pool
+		self._handler = handler
+		self._ordered = ordered
+
+	def __getattr__(self, name):
+		func = getattr(self._handler, name)
+		run = self._pool.write if self._ordered else self._pool.read
+		def call(*args, **kwargs):
+			return run(func, *args, **kwargs)
+		return call
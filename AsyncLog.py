@@ -0,0 +1,146 @@
+# coding=utf-8
+# This file is part of the uberserver (GPL v2 or later), see LICENSE
+# logging off the reactor thread: records are queued, formatted and written in batches by a writer thread
+
+import queue
+import atexit
+import logging
+import threading
+from logging.handlers import QueueHandler, TimedRotatingFileHandler
+
+class LogQueueHandler(QueueHandler):
+	# never blocks the caller, records are dropped (and counted) when the queue is full
+	def __init__(self, queue):
+		QueueHandler.__init__(self, queue)
+		self.dropped = 0
+
+	def prepare(self, record):
+		# formatting happens on the writer thread, log args are strings and numbers here so keeping them is safe
+		return record
+
+	def enqueue(self, record):
+		try:
+			self.queue.put_nowait(record)
+		except queue.Full:
+			self.dropped += 1
+
+class BatchedFileHandler(TimedRotatingFileHandler):
+	# flushed once per batch by the writer instead of once per record
+	def flush(self):
+		pass
+
+	def flush_batch(self):
+		TimedRotatingFileHandler.flush(self)
+
+	def close(self):
+		self.flush_batch()
+		TimedRotatingFileHandler.close(self)
+
+class LogWriter:
+	'''
+	writes queued records to handlers on its own thread, up to batch_size records per flush
+	a run of identical messages is written once, followed by "last message repeated N times"
+	'''
+	def __init__(self, handlers, maxsize=100000, batch_size=500):
+		self.handlers = handlers
+		self.queue = queue.Queue(maxsize)
+		self.handler = LogQueueHandler(self.queue)
+		self.batch_size = batch_size
+		self.reported_dropped = 0
+		self.repeated = 0
+		self.written = 0
+		self.thread = None
+
+	def start(self):
+		self.thread = threading.Thread(target=self.run, name='logwriter')
+		self.thread.daemon = True
+		self.thread.start()
+		atexit.register(self.stop)
+
+	def stop(self):
+		# writes what is queued, then ends the thread
+		if not self.thread or not self.thread.is_alive():
+			return
+		self.queue.put(None)
+		self.thread.join(10)
+
+	def queue_length(self):
+		return self.queue.qsize()
+
+	def run(self):
+		last = None # (levelno, name, message) of the last written record
+		last_record = None
+		while True:
+			batch = [self.queue.get()]
+			try:
+				while len(batch) < self.batch_size:
+					batch.append(self.queue.get_nowait())
+			except queue.Empty:
+				pass
+			for record in batch:
+				if record is None:
+					self.summarize(last_record)
+					self.flush()
+					return
+				key = (record.levelno, record.name, record.getMessage())
+				if key == last:
+					self.repeated += 1
+					continue
+				self.summarize(last_record)
+				last = key
+				last_record = record
+				self.write(record)
+			self.summarize(last_record)
+			self.flush()
+
+	def summarize(self, last_record):
+		# records for repeated and dropped messages
+		if self.repeated:
+			self.write(logging.makeLogRecord(dict(last_record.__dict__, msg='last message repeated %d times' % self.repeated, args=None, exc_info=None, exc_text=None)))
+			self.repeated = 0
+		dropped = self.handler.dropped
+		if dropped != self.reported_dropped:
+			self.write(logging.makeLogRecord({'name': 'root', 'levelno': logging.WARNING, 'levelname': 'WARNING', 'module': 'AsyncLog', 'funcName': 'summarize',
+				'msg': 'log queue full, dropped %d records' % (dropped - self.reported_dropped)}))
+			self.reported_dropped = dropped
+
+	def flush(self):
+		for handler in self.handlers:
+			if hasattr(handler, 'flush_batch'):
+				handler.flush_batch()
+			else:
+				handler.flush()
+
+	def write(self, record):
+		self.written += 1
+		for handler in self.handlers:
+			if record.levelno >= handler.level:
+				handler.handle(record)
+
+if __name__ == '__main__':
+	class ListHandler(logging.Handler):
+		def __init__(self):
+			logging.Handler.__init__(self)
+			self.lines = []
+		def emit(self, record):
+			self.lines.append(self.format(record))
+	target = ListHandler()
+	writer = LogWriter([target], maxsize=10000)
+	logger = logging.getLogger('asynclogtest')
+	logger.propagate = False
+	logger.setLevel(logging.DEBUG)
+	logger.addHandler(writer.handler)
+	for i in range(1000):
+		logger.info('flood breach from %s', '127.0.0.1')
+	logger.info('connected %d', 1)
+	for i in range(20000):
+		logger.info('line %d', i) # fills the queue before the writer runs
+	writer.start()
+	writer.stop()
+	assert(target.lines[0] == 'log queue full, dropped 11001 records')
+	assert(target.lines[1] == 'flood breach from 127.0.0.1')
+	assert(target.lines[2:4] == ['last message repeated 499 times', 'last message repeated 500 times']) # one summary per batch
+	assert(target.lines[4] == 'connected 1')
+	assert(writer.handler.dropped == 20000 - (10000 - 1001))
+	assert(len(target.lines) == 5 + (10000 - 1001))
+	print("Tests went ok")
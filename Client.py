@@ -5,9 +5,29 @@ import logging
 from collections import defaultdict
 from BridgedClient import BridgedClient
 
+# battle status fields as packed by MYBATTLESTATUS and CLIENTBATTLESTATUS: name -> (shift, bits)
+BATTLESTATUS_FIELDS = {'ready': (1, 1), 'id': (2, 4), 'ally': (6, 4), 'mode': (10, 1), 'handicap': (11, 7), 'sync': (22, 2), 'side': (24, 4)}
+BATTLESTATUS_MASK = 0
+for shift, bits in BATTLESTATUS_FIELDS.values():
+	BATTLESTATUS_MASK |= ((1 << bits) - 1) << shift
+HANDICAP_MASK = ((1 << 7) - 1) << 11
+
+NO_COMPAT = frozenset() # shared by clients that didn't send compat flags (yet)
+
 class Client():
 	'this object represents one server-side connected client'
 
+	# one slot per field instead of a __dict__ per client, subclasses (Chat, ChanServClient) still get a __dict__ for their own
+	__slots__ = ('_root', 'ip_address', 'local_ip', 'port',
+		'user_id', 'username', 'password', 'register_date', 'last_login', 'last_ip', 'last_id', 'ingame_time', 'access', 'email', 'bot',
+		'last_agent', 'last_sys_id', 'last_mac_id',
+		'session_id', 'login_id', 'login_pending', 'resume_token', 'static', 'removing', 'compat', 'country_code', 'agent', 'status', 'away', 'accesslevels', 'logged_in',
+		'buffersend', 'buffer', 'msg_id', 'msg_length_history', 'data', 'held', 'held_size', 'lastdata',
+		'channels', 'ignored', 'lastsaid', 'bridge', 'known_users', 'friends',
+		'is_ingame', 'scriptPassword', 'battle_bots', 'current_battle', 'pending_battle', 'went_ingame', 'battlestatus', 'teamcolor', 'hostport', 'udpport')
+
+	remote = False # Cluster.RemoteClient for users on other nodes
+
 	def __init__(self, root, address, session_id):
 		'initial setup for the connected client'
 		self._root = root
@@ -29,26 +49,32 @@ class Client():
 		self.username = ""
 		self.password = ""
 		self.register_date = datetime.datetime.now()
-		self.last_login = datetime.datetime.now()
+		self.last_login = self.register_date
 		self.last_ip = self.ip_address
 		self.last_id = 0
 		self.ingame_time = 0
 		self.access = 'fresh'
 		self.email = ''
 		self.bot = False
+		self.last_agent = None
+		self.last_sys_id = None
+		self.last_mac_id = None
 
 		# session
 		self.session_id = session_id
-		self.debug = False
+		self.login_id = None # id of the db login row, set by LOGIN
+		self.login_pending = False # LOGIN or REGISTER is waiting for the db
+		self.resume_token = None # lets RESUME take over this session after the connection is lost, see Protocol._detach
 		self.static = False
-		self.sendError = False
+		self.removing = False
 
-		self.compat = set() # holds compatibility flags
+		self.compat = NO_COMPAT # holds compatibility flags, LOGIN sets a client's own
 
 		self.country_code = '??'
 		self.agent = ""
 		self.setFlagByIP(self.ip_address)
 		self.status = 12
+		self.away = False
 		self.accesslevels = ['fresh','everyone']
 
 		# note: this NEVER becomes false after LOGIN!
@@ -58,26 +84,21 @@ class Client():
 		self.buffersend = False # if True, write all sends to a buffer (must not be used when a client is logging in but didn't yet receive full server state!)
 		self.buffer = ""
 		self.msg_id = ''
-		self.msg_sendbuffer = []
-		self.sendingmessage = ''
 		self.msg_length_history = {}
+		self.data = '' # incomplete line received so far
+		self.held = [] # lines received while LOGIN or REGISTER waits for the db, see Protocol._replayHeld
+		self.held_size = 0 # their length, limited like the data of a second
+		self.lastdata = now
 
 		# channels
 		self.channels = set()
 		self.ignored = {}
-		self.lastsaid = {}
+		self.known_users = None # user_ids this client got ADDUSER for, only tracked with the 'lu' compat flag
+		self.friends = set() # user_ids, loaded with LOGIN and kept up to date by the friend commands
+		self.lastsaid = None # channel -> {time -> [messages]}, created by SayHooks on the first message
 		
 		# for if we are a bridge bot
 		self.bridge = {} #location->{external_id->bridged_id}
-		
-		# perhaps these are unused?
-		self.cpu = 0
-		self.data = ''
-		self.lastdata = now
-
-		# time-stamps for encrypted data
-		self.incoming_msg_ctr = 0
-		self.outgoing_msg_ctr = 1
 
 		# battle stuff
 		self.is_ingame = False
@@ -87,13 +108,28 @@ class Client():
 		self.current_battle = None # battle_id
 		self.pending_battle = None # battle_id
 		self.went_ingame = 0
-		self.spectator = False
-		self.battlestatus = {'ready':'0', 'id':'0000', 'ally':'0000', 'mode':'0', 'sync':'00', 'side':'00', 'handicap':'0000000'}
+		self.battlestatus = 0 # packed, see BATTLESTATUS_FIELDS
 		self.teamcolor = '0'
 
 		self.hostport = None
 		self.udpport = 0
 
+	def battlestatus_field(self, name):
+		shift, bits = BATTLESTATUS_FIELDS[name]
+		return (self.battlestatus >> shift) & ((1 << bits) - 1)
+
+	def set_battlestatus_field(self, name, value):
+		shift, bits = BATTLESTATUS_FIELDS[name]
+		mask = ((1 << bits) - 1) << shift
+		self.battlestatus = (self.battlestatus & ~mask) | ((int(value) << shift) & mask)
+
+	def set_battlestatus(self, status):
+		# everything but the handicap, which only the battle host sets
+		self.battlestatus = (status & BATTLESTATUS_MASK & ~HANDICAP_MASK) | (self.battlestatus & HANDICAP_MASK)
+
+	def is_spectator(self):
+		return not self.battlestatus & (1 << BATTLESTATUS_FIELDS['mode'][0])
+
 	def set_msg_id(self, msg):
 		self.msg_id = ""
 
@@ -116,13 +152,15 @@ class Client():
 	##
 	## handle data from client
 	##
-	def Handle(self, data):
+	def flood_limits(self):
 		if self.bot:
-			flood_limits = self._root.flood_limits['bot']
-		elif (self.access in self._root.flood_limits):
-			flood_limits = self._root.flood_limits[self.access]
-		else:
-			flood_limits = self._root.flood_limits['fresh']
+			return self._root.flood_limits['bot']
+		if (self.access in self._root.flood_limits):
+			return self._root.flood_limits[self.access]
+		return self._root.flood_limits['fresh']
+
+	def Handle(self, data):
+		flood_limits = self.flood_limits()
 		
 		#logging.info("  < [" + self.username + " " + str(self.session_id) + "] " + data.strip()) # uncomment for debugging
 
@@ -169,6 +207,18 @@ class Client():
 		# probably caused by trailing newline ("abc\n".split("\n") == ["abc", ""])
 		if (len(cmd) < 1):
 			return
+		if self.login_pending:
+			if self.removing: # kicked below, the rest of its data is dropped
+				return
+			flood_limits = self.flood_limits()
+			self.held_size += len(cmd)
+			if self.held_size > flood_limits['bytespersecond'] * flood_limits['seconds']:
+				self.Send('SERVERMSG No flooding (over %s bytes while waiting for the db)' % (flood_limits['bytespersecond'] * flood_limits['seconds']))
+				self.ReportFloodBreach("held lines limit", self.held_size)
+				self.Remove('Kicked for flooding (%s)' % (self.access))
+				return
+			self.held.append(cmd)
+			return
 		self._root.protocol._handle(self, cmd)
 
 	def HandleProtocolCommands(self, split_data, flood_limits):
@@ -223,7 +273,9 @@ class Client():
 
 		#logging.info("> [" + self.username + " " + str(self.session_id) + "] " + data.strip()) # uncomment for debugging
 		
-		self.transport.write(data.encode("utf-8") + b"\n")
+		data = data.encode("utf-8") + b"\n"
+		self._root.metrics.bytes_sent.inc(len(data))
+		self.transport.write(data)
 
 	def Send(self, data):
 		if self.msg_id:
@@ -234,7 +286,9 @@ class Client():
 			self.RealSend(data)
 
 	def flushBuffer(self):
-		self.transport.write(self.buffer.encode("utf-8"))
+		data = self.buffer.encode("utf-8")
+		self._root.metrics.bytes_sent.inc(len(data))
+		self.transport.write(data)
 		self.buffer = ""
 		self.buffersend = False
 
@@ -0,0 +1,584 @@
+# coding=utf-8
+# This file is part of the uberserver (GPL v2 or later), see LICENSE
+# cluster mode: several server processes share presence, broadcasts and battle listings over a message bus
+#
+# every node owns its own connections, users logged in on other nodes are RemoteClients in
+# root.usernames / root.user_ids, so clientFromUsername finds them and Send() reaches them through the bus
+# the bus is pluggable (publish(message) + a receive callback), UnixBus talks to the Broker below
+#
+# what is not shared: channel membership lists (JOINED/LEFT/SAID still reach everyone),
+# joining battles hosted on another node, and in-memory channel settings (ops/bans/mutes) changed on another node
+
+import os
+import json
+import logging
+import traceback
+
+from twisted.internet import reactor, protocol
+from twisted.protocols.basic import LineReceiver
+
+MAX_NODES = 16 # battle ids are node + MAX_NODES * n, so nodes never hand out the same id
+
+class RemoteClient:
+	'a user logged in on another node'
+	remote = True
+	static = False
+	logged_in = True
+	compat = frozenset()
+
+	def __init__(self, cluster, node, user):
+		self._cluster = cluster
+		self.node = node
+		self.username = user['username']
+		self.user_id = user['user_id']
+		self.country_code = user['country_code']
+		self.agent = user['agent']
+		self.status = user['status']
+		self.login_time = user['login_time']
+		self.access = user['access']
+		self.bot = user['bot']
+		self.accesslevels = user['accesslevels']
+		self.session_id = None
+		self.ip_address = None
+		self.local_ip = None
+		self.current_battle = None
+		self.channels = set()
+		# no .ignored: Protocol.is_ignored asks the db for clients without one
+
+	def Send(self, msg):
+		self._cluster.send_to(self, msg)
+
+	def RealSend(self, msg):
+		self._cluster.send_to(self, msg)
+
+	def Remove(self, reason='Quit'):
+		self._cluster.publish({'type': 'kick', 'username': self.username, 'reason': reason})
+
+	def isAdmin(self):
+		return 'admin' in self.accesslevels
+
+	def isMod(self):
+		return self.isAdmin() or 'mod' in self.accesslevels
+
+class Cluster:
+	def __init__(self, root, bus, node):
+		self._root = root
+		self.bus = bus
+		self.node = node
+		self.remote_users = {} # username -> RemoteClient
+		self.replacing = {} # username -> (node, user) of a remote login that wins over the local session being kicked
+		self.remote_battles = {} # battle_id -> {'node', 'opened': {'u': line, '': line}, 'info': line, 'users': [usernames]}
+		self.received = 0
+		self.sent = 0
+		bus.receive = self.receive
+		bus.connected = self.hello
+
+	def battle_id(self, n):
+		# interleaved, so the nodes never hand out the same id
+		return n * MAX_NODES + self.node
+
+	def publish(self, message):
+		message['node'] = self.node
+		self.sent += 1
+		self.bus.publish(message)
+
+	def user(self, client):
+		return {'username': client.username, 'user_id': client.user_id, 'country_code': client.country_code, 'agent': client.agent,
+			'status': client.status, 'access': client.access, 'bot': client.bot, 'accesslevels': client.accesslevels,
+			'login_time': self.login_time(client)}
+
+	def login_time(self, client):
+		if client.remote:
+			return client.login_time
+		return client.last_login.timestamp() if client.last_login else 0
+
+	def local_users(self):
+		return [client for client in self._root.usernames.values() if not getattr(client, 'remote', False) and not client.static]
+
+	# local events, published to the other nodes
+
+	def hello(self):
+		# (re)connected to the bus: announce ourselves and our state, the other nodes answer with theirs
+		self.publish({'type': 'hello'})
+		self.sync()
+
+	def sync(self):
+		battles = []
+		for battle in self._root.battles.values():
+			battles.append(self.battle(battle))
+		self.publish({'type': 'sync', 'users': [self.user(client) for client in self.local_users()], 'battles': battles})
+
+	def user_login(self, client):
+		if not client.static:
+			self.publish({'type': 'login', 'user': self.user(client)})
+
+	def user_logout(self, client):
+		if not client.static:
+			self.publish({'type': 'logout', 'username': client.username})
+		replacing = self.replacing.pop(client.username, None)
+		if replacing:
+			self.add_remote_user(*replacing)
+
+	def battle(self, battle):
+		protocol = self._root.protocol
+		host = self._root.clientFromSession(battle.host)
+		users = [self._root.clientFromSession(session_id) for session_id in battle.users if session_id != battle.host]
+		return {
+			'battle_id': battle.battle_id,
+			'opened': {'u': protocol.client_AddBattle(LineFormat(('u',)), battle), '': protocol.client_AddBattle(LineFormat(()), battle)},
+			'info': 'UPDATEBATTLEINFO %s %i %i %s %s' % (battle.battle_id, battle.spectators, battle.locked, battle.maphash, battle.map),
+			'users': [user.username for user in users if user],
+			'host': host.username if host else None,
+		}
+
+	def battle_opened(self, battle):
+		self.publish({'type': 'battle_opened', 'battle': self.battle(battle)})
+
+	def battle_closed(self, battle_id):
+		self.publish({'type': 'battle_closed', 'battle_id': battle_id})
+
+	def broadcast(self, msg, chan=None, sourceClient=None, flag=None, not_flag=None, user=None):
+		self.publish({'type': 'broadcast', 'msg': msg, 'chan': chan, 'source_user_id': sourceClient.user_id if sourceClient else None, 'flag': flag, 'not_flag': not_flag,
+			'user': user.username if user else None})
+
+	def client_status(self, client):
+		# not a broadcast, every node sends it like its own statuses, batched for 'bm' clients
+		self.publish({'type': 'status', 'username': client.username, 'status': client.status})
+
+	def send_to(self, remote, msg):
+		self.publish({'type': 'to', 'username': remote.username, 'msg': msg})
+
+	def introduce(self, remote, user, status=True):
+		# Protocol._introduce for a client on another node, on the bus before whatever is sent to it next
+		self.publish({'type': 'introduce', 'username': remote.username, 'user': user.username, 'status': status})
+
+	# messages from other nodes
+
+	def receive(self, message):
+		self.received += 1
+		if message.get('node') == self.node:
+			return
+		try:
+			getattr(self, 'on_' + message['type'])(message)
+			self._root.session_manager.commit_guard()
+		except:
+			logging.error(traceback.format_exc())
+			self._root.session_manager.rollback_guard()
+		finally:
+			self._root.session_manager.close_guard()
+
+	def on_hello(self, message):
+		logging.info("Cluster node %s joined" % message['node'])
+		self.sync()
+
+	def on_sync(self, message):
+		for user in message['users']:
+			if not user['username'] in self.remote_users:
+				self.add_remote_user(message['node'], user)
+		for battle in message['battles']:
+			if not battle['battle_id'] in self.remote_battles:
+				self.on_battle_opened({'node': message['node'], 'battle': battle})
+
+	def on_login(self, message):
+		self.add_remote_user(message['node'], message['user'])
+
+	def on_logout(self, message):
+		remote = self.remote_users.get(message['username'])
+		if remote and remote.node == message['node']: # not the session on another node that won over a double login
+			self.remove_remote_user(remote)
+
+	def on_kick(self, message):
+		client = self._root.usernames.get(message['username'])
+		if client and not getattr(client, 'remote', False):
+			client.Remove(message['reason'])
+
+	def on_to(self, message):
+		client = self._root.usernames.get(message['username'])
+		if client and not getattr(client, 'remote', False):
+			client.Send(message['msg'])
+
+	def set_friend(self, remote, user, friends):
+		# keeps Client.friends of a client on another node up to date after ACCEPTFRIENDREQUEST / UNFRIEND here
+		self.publish({'type': 'friend', 'username': remote.username, 'user_id': user.user_id, 'friends': friends})
+
+	def on_friend(self, message):
+		client = self._root.usernames.get(message['username'])
+		if not client or client.remote:
+			return
+		if message['friends']:
+			client.friends.add(message['user_id'])
+		else:
+			client.friends.discard(message['user_id'])
+
+	def on_introduce(self, message):
+		client = self._root.usernames.get(message['username'])
+		user = self._root.usernames.get(message['user'])
+		if client and user and not client.remote:
+			self._root.protocol._introduce(client, user, message['status'])
+
+	def on_broadcast(self, message):
+		msg = message['msg']
+		self.track(msg)
+		source = self._root.user_ids.get(message['source_user_id']) if message['source_user_id'] else None
+		chan = message['chan']
+		if chan:
+			if not chan in self._root.channels:
+				return
+			session_ids = self._root.channels[chan].users
+		else:
+			session_ids = self._root.clients
+		# chanserv already got it on the sending node
+		session_ids = [session_id for session_id in session_ids if not self._root.clientFromSession(session_id).static]
+		user = self._root.usernames.get(message['user']) if message.get('user') else None
+		self._root.multicast(session_ids, msg, set(), source, message['flag'], message['not_flag'], user)
+
+	def on_status(self, message):
+		remote = self.remote_users.get(message['username'])
+		if not remote or remote.node != message['node']:
+			return
+		remote.status = message['status']
+		self.local_status(remote)
+
+	def local_status(self, remote):
+		# what Protocol.broadcast_ClientStatus does for a local client
+		self.local_multicast('CLIENTSTATUS %s %d' % (remote.username, remote.status), not_flag='bm', user=remote)
+		self._root.queue_status(remote)
+
+	def on_battle_opened(self, message):
+		battle = message['battle']
+		battle['node'] = message['node']
+		self.remote_battles[battle['battle_id']] = battle
+		host = self.remote_users.get(battle['host'])
+		if host:
+			for client in self._root.clients.values():
+				if client.logged_in and client.known_users is not None:
+					self._root.protocol._introduce(client, host)
+		self.local_multicast(battle['opened']['u'], flag='u')
+		self.local_multicast(battle['opened'][''], not_flag='u')
+
+	def on_battle_closed(self, message):
+		if self.remote_battles.pop(message['battle_id'], None):
+			self.local_multicast('BATTLECLOSED %s' % message['battle_id'])
+
+	def on_node_left(self, message):
+		# sent by the broker when a node's connection is gone
+		logging.info("Cluster node %s left" % message['left'])
+		for remote in [r for r in self.remote_users.values() if r.node == message['left']]:
+			self.remove_remote_user(remote)
+		for battle_id in [b for b, battle in self.remote_battles.items() if battle['node'] == message['left']]:
+			self.on_battle_closed({'battle_id': battle_id})
+
+	def add_remote_user(self, node, user):
+		username = user['username']
+		other = self._root.usernames.get(username)
+		if other:
+			# logged in on two nodes at once, each login was done before the other node heard of the other one.
+			# every node keeps the earlier login (the lower node on a tie) and the other session is kicked where it is
+			other_node = other.node if other.remote else self.node
+			if (self.login_time(other), other_node) <= (user['login_time'], node):
+				logging.warning("Cluster: <%s> also logged in on node %s, the session on node %s stays" % (username, node, other_node))
+				return
+			logging.warning("Cluster: <%s> also logged in on node %s, the session on node %s is kicked" % (username, node, other_node))
+			if other.remote:
+				self.remove_remote_user(other)
+			else:
+				self.replacing[username] = (node, user) # added once it is gone, see user_logout
+				other.Remove('Logged in on another server')
+				return
+		remote = RemoteClient(self, node, user)
+		self.remote_users[username] = remote
+		self._root.usernames[username] = remote
+		self._root.user_ids[remote.user_id] = remote
+		# clients with the 'lu' compat flag hear of remote users if they are friends, through SAYPRIVATE or FINDUSER
+		self.local_multicast(self._root.protocol.client_AddUser(None, remote), not_flag='lu')
+		for client in self._root.clients.values():
+			if client.logged_in and client.known_users is not None and remote.user_id in client.friends:
+				self._root.protocol._introduce(client, remote, False)
+		if remote.status:
+			self.local_status(remote)
+
+	def remove_remote_user(self, remote):
+		del self.remote_users[remote.username]
+		if self._root.usernames.get(remote.username) is remote:
+			del self._root.usernames[remote.username]
+		if self._root.user_ids.get(remote.user_id) is remote:
+			del self._root.user_ids[remote.user_id]
+		self.local_multicast('REMOVEUSER %s' % remote.username, user=remote)
+		for client in self._root.clients.values():
+			if client.known_users:
+				client.known_users.discard(remote.user_id)
+
+	def local_multicast(self, msg, flag=None, not_flag=None, user=None):
+		self._root.multicast(self._root.clients, msg, set(), None, flag, not_flag, user)
+
+	def track(self, msg):
+		# keeps remote users and battles current for clients that log in here later
+		words = msg.split(' ')
+		command = words[0]
+		if command == 'UPDATEBATTLEINFO' and len(words) > 1 and int(words[1]) in self.remote_battles:
+			self.remote_battles[int(words[1])]['info'] = msg
+		elif command == 'JOINEDBATTLE' and len(words) > 2 and int(words[1]) in self.remote_battles:
+			self.remote_battles[int(words[1])]['users'].append(words[2])
+		elif command == 'LEFTBATTLE' and len(words) > 2 and int(words[1]) in self.remote_battles:
+			users = self.remote_battles[int(words[1])]['users']
+			if words[2] in users:
+				users.remove(words[2])
+
+	def send_login_info(self, client):
+		# the remote part of the state a client gets in _SendLoginInfo, batched the same way for 'bm' clients
+		protocol = self._root.protocol
+		if client.known_users is not None: # 'lu': friends (already in known_users) and battle hosts
+			for battle in self.remote_battles.values():
+				if battle['host'] in self.remote_users:
+					client.known_users.add(self.remote_users[battle['host']].user_id)
+		remotes = [remote for remote in self.remote_users.values() if protocol._knows(client, remote)]
+		batched = 'bm' in client.compat
+		if batched:
+			for line in protocol.client_AddUsers(client, remotes):
+				client.RealSend(line)
+		else:
+			for remote in remotes:
+				client.RealSend(protocol.client_AddUser(client, remote))
+		for battle in self.remote_battles.values():
+			client.RealSend(battle['opened']['u' if 'u' in client.compat else ''])
+			client.RealSend(battle['info'])
+			members = [username for username in battle['users'] if username in self.remote_users and protocol._knows(client, self.remote_users[username])]
+			if batched:
+				if members:
+					client.RealSend('JOINEDBATTLES %s %s' % (battle['battle_id'], ' '.join(members)))
+			else:
+				for username in members:
+					client.RealSend('JOINEDBATTLE %s %s' % (battle['battle_id'], username))
+		if batched:
+			for line in protocol.client_ClientStatuses([remote for remote in remotes if remote.status]):
+				client.RealSend(line)
+		else:
+			for remote in remotes:
+				if remote.status:
+					client.RealSend('CLIENTSTATUS %s %d' % (remote.username, remote.status))
+
+class LineFormat:
+	# stands in for the receiving client when BATTLEOPENED is formatted for other nodes
+	def __init__(self, compat):
+		self.compat = compat
+		self.ip_address = None
+
+class BusProtocol(LineReceiver):
+	delimiter = b'\n'
+	MAX_LENGTH = 1 << 26 # sync messages carry all users of a node
+
+	def connectionMade(self):
+		self.factory.bus.connectionMade(self)
+
+	def connectionLost(self, reason):
+		self.factory.bus.connectionLost(self)
+
+	def lineReceived(self, line):
+		self.factory.bus.receive(json.loads(line.decode('utf-8')))
+
+class UnixBus(protocol.ReconnectingClientFactory):
+	'''
+	client side of the Broker, messages are json lines
+	while the broker is unreachable messages are dropped, the hello/sync after reconnecting restores presence
+	'''
+	protocol = BusProtocol
+	maxDelay = 5
+
+	def __init__(self, path):
+		self.path = path
+		self.bus = self
+		self.connection = None
+		self.receive = None # set by Cluster
+		self.connected = None
+
+	def start(self):
+		reactor.connectUNIX(self.path, self)
+
+	def connectionMade(self, connection):
+		self.resetDelay()
+		self.connection = connection
+		logging.info("Connected to the cluster broker at %s" % self.path)
+		self.connected()
+
+	def connectionLost(self, connection):
+		self.connection = None
+		logging.warning("Lost the cluster broker at %s" % self.path)
+
+	def publish(self, message):
+		if self.connection:
+			self.connection.sendLine(json.dumps(message, separators=(',', ':')).encode('utf-8'))
+
+class BrokerProtocol(LineReceiver):
+	delimiter = b'\n'
+	MAX_LENGTH = 1 << 26
+
+	def connectionMade(self):
+		self.node = None
+		self.factory.connections.add(self)
+
+	def connectionLost(self, reason):
+		self.factory.connections.discard(self)
+		if self.node is not None:
+			self.factory.relay(self, json.dumps({'type': 'node_left', 'node': None, 'left': self.node}).encode('utf-8'))
+
+	def lineReceived(self, line):
+		if self.node is None:
+			self.node = json.loads(line.decode('utf-8')).get('node') # the first message of a node is its hello
+		self.factory.relay(self, line)
+
+class Broker(protocol.Factory):
+	'relays every line from a node to all other nodes'
+	protocol = BrokerProtocol
+
+	def __init__(self):
+		self.connections = set()
+
+	def relay(self, sender, line):
+		for connection in self.connections:
+			if connection is not sender:
+				connection.sendLine(line)
+
+def listen_broker(path):
+	if os.path.exists(path):
+		os.unlink(path)
+	reactor.listenUNIX(path, Broker())
+	logging.info("Cluster broker listening on %s" % path)
+
+def start(root):
+	# joins root to the cluster over root.clusterpath, starting the broker there first if root.cluster_broker
+	if not 0 <= root.node < MAX_NODES:
+		logging.error("Cluster node number must be between 0 and %d" % (MAX_NODES - 1))
+		return None
+	if root.cluster_broker:
+		listen_broker(root.clusterpath)
+	bus = UnixBus(root.clusterpath)
+	root.cluster = Cluster(root, bus, root.node)
+	bus.start()
+	return root.cluster
+
+if __name__ == '__main__':
+	# two nodes over an in-process bus
+	class LoopbackBus:
+		def __init__(self):
+			self.nodes = []
+		def publish(self, message):
+			for node in self.nodes:
+				node.receive(json.loads(json.dumps(message)))
+	class Guard:
+		def commit_guard(self): pass
+		def rollback_guard(self): pass
+		def close_guard(self): pass
+	class DummyProtocol:
+		def client_AddUser(self, receiver, user):
+			return 'ADDUSER %s %s %s %s' % (user.username, user.country_code, user.user_id, user.agent)
+		def client_AddUsers(self, receiver, users):
+			return ['ADDUSERS ' + '\t'.join(self.client_AddUser(receiver, user)[len('ADDUSER '):] for user in users)]
+		def client_ClientStatuses(self, users):
+			return ['CLIENTSTATUSES ' + ' '.join('%s %d' % (user.username, user.status) for user in users)]
+		def _knows(self, receiver, user):
+			return receiver.known_users is None or user.user_id in receiver.known_users
+	class DummyClient:
+		static = False
+		remote = False
+		logged_in = True
+		compat = ()
+		known_users = None
+		def __init__(self, username, user_id, last_login=None):
+			self.username = username
+			self.user_id = user_id
+			self.last_login = last_login
+			self.removed = None
+			self.country_code = 'DE'
+			self.agent = 'test'
+			self.status = 0
+			self.access = 'user'
+			self.bot = False
+			self.accesslevels = ['user', 'everyone']
+			self.sent = []
+		def Send(self, msg):
+			self.sent.append(msg)
+		RealSend = Send
+		def Remove(self, reason):
+			self.removed = reason
+	class DummyRoot:
+		def __init__(self):
+			self.usernames = {}
+			self.user_ids = {}
+			self.clients = {}
+			self.channels = {}
+			self.battles = {}
+			self.protocol = DummyProtocol()
+			self.session_manager = Guard()
+			self.queued = [] # queue_status, 'bm' clients get these from flush_statuses
+		def clientFromSession(self, session_id):
+			return self.clients[session_id]
+		def login(self, session_id, client):
+			self.clients[session_id] = client
+			self.usernames[client.username] = client
+			self.user_ids[client.user_id] = client
+		def logout(self, session_id, cluster):
+			# what Protocol._remove does once the connection is gone
+			client = self.clients.pop(session_id)
+			if self.usernames.get(client.username) is client:
+				del self.usernames[client.username]
+				del self.user_ids[client.user_id]
+			cluster.user_logout(client)
+		def queue_status(self, client):
+			self.queued.append(client)
+		def multicast(self, session_ids, msg, ignore=(), sourceClient=None, flag=None, not_flag=None, user=None):
+			for session_id in session_ids:
+				client = self.clients[session_id]
+				if flag and not flag in client.compat:
+					continue
+				if not_flag and not_flag in client.compat:
+					continue
+				client.Send(msg)
+	class SubBus:
+		def __init__(self, loopback):
+			self.loopback = loopback
+		def publish(self, message):
+			self.loopback.publish(message)
+
+	loopback = LoopbackBus()
+	roots = [DummyRoot(), DummyRoot()]
+	clusters = [Cluster(root, SubBus(loopback), i) for i, root in enumerate(roots)]
+	loopback.nodes = clusters
+	alice, bob = DummyClient('alice', 1), DummyClient('bob', 2)
+	roots[1].login(1, bob)
+	roots[0].login(1, alice)
+	clusters[0].user_login(alice)
+	clusters[1].hello() # bob's node announces the users it already has
+	assert('ADDUSER bob DE 2 test' in alice.sent)
+	assert('ADDUSER alice DE 1 test' in bob.sent)
+	assert(isinstance(roots[0].usernames['bob'], RemoteClient))
+	roots[0].usernames['bob'].Send('SAIDPRIVATE alice hi') # what SAYPRIVATE does with a remote receiver
+	assert(bob.sent[-1] == 'SAIDPRIVATE alice hi')
+	alice.status = 1
+	clusters[0].client_status(alice)
+	assert(bob.sent[-1] == 'CLIENTSTATUS alice 1' and roots[1].usernames['alice'].status == 1)
+	assert(roots[1].queued == [roots[1].usernames['alice']])
+
+	# a 'bm' client logging in on bob's node gets alice batched
+	dave = DummyClient('dave', 4)
+	dave.compat = ('bm',)
+	clusters[1].send_login_info(dave)
+	assert(dave.sent == ['ADDUSERS alice DE 1 test', 'CLIENTSTATUSES alice 1'])
+
+	# carol logs in on both nodes before either heard of the other login: the earlier one stays on both
+	import datetime
+	now = datetime.datetime.now()
+	first, second = DummyClient('carol', 3, now), DummyClient('carol', 3, now + datetime.timedelta(seconds=1))
+	roots[0].login(2, first)
+	roots[1].login(2, second)
+	clusters[0].user_login(first)
+	clusters[1].user_login(second)
+	assert(first.removed is None and second.removed)
+	assert(roots[0].usernames['carol'] is first)
+	roots[1].logout(2, clusters[1]) # the kicked connection is gone
+	assert(roots[0].usernames['carol'] is first)
+	assert(isinstance(roots[1].usernames['carol'], RemoteClient) and roots[1].usernames['carol'].node == 0)
+
+	clusters[1].on_node_left({'node': None, 'left': 0})
+	assert(not 'alice' in roots[1].usernames and not 'carol' in roots[1].usernames)
+	assert('REMOVEUSER alice' in bob.sent)
+	print("Tests went ok")
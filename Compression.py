@@ -0,0 +1,138 @@
+# coding=utf-8
+# This file is part of the uberserver (GPL v2 or later), see LICENSE
+# zlib compression of a client's output, negotiated with COMPRESS
+#
+# everything the server sends after OK cmd=COMPRESS is one deflate stream (zlib header, RFC 1950),
+# writes of one reactor iteration are compressed together and end with a sync flush,
+# so the client can always decode all lines it got so far. client -> server stays plain text.
+
+import time
+import zlib
+
+DEFAULT_LEVEL = 6
+MAX_LEVEL = 9
+
+class Budget:
+	'''
+	cpu guard shared by all compressors: the seconds spent compressing in the last window
+	new COMPRESS requests are refused while they exceed fraction of it
+	'''
+	def __init__(self, fraction=0.25, window=10):
+		self.fraction = fraction
+		self.window = window
+		self.start = time.time()
+		self.spent = 0.0 # in the current window
+		self.last_spent = 0.0 # in the previous window
+		self.total = 0.0
+
+	def add(self, seconds):
+		now = time.time()
+		if now - self.start >= self.window:
+			self.last_spent = self.spent if now - self.start < 2 * self.window else 0.0
+			self.spent = 0.0
+			self.start = now
+		self.spent += seconds
+		self.total += seconds
+
+	def over(self):
+		return max(self.spent, self.last_spent) > self.fraction * self.window
+
+class Compressor:
+	'collects writes, flush() returns them compressed up to a sync point'
+	def __init__(self, level=DEFAULT_LEVEL, budget=None):
+		self.level = level
+		self.budget = budget
+		self.compressor = zlib.compressobj(level)
+		self.pending = []
+		self.bytes_in = 0
+		self.bytes_out = 0
+		self.seconds = 0.0
+
+	def write(self, data):
+		self.pending.append(data)
+
+	def flush(self):
+		if not self.pending:
+			return b''
+		data = b''.join(self.pending)
+		self.pending = []
+		start = time.perf_counter()
+		out = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+		seconds = time.perf_counter() - start
+		self.seconds += seconds
+		if self.budget:
+			self.budget.add(seconds)
+		self.bytes_in += len(data)
+		self.bytes_out += len(out)
+		return out
+
+class CompressingTransport:
+	'''
+	stands in for a client's transport after COMPRESS, writes are compressed once per reactor iteration
+	call_later is reactor.callLater, metrics the root's ServerMetrics or None
+	'''
+	def __init__(self, transport, compressor, call_later, metrics=None):
+		self.transport = transport
+		self.compressor = compressor
+		self.call_later = call_later
+		self.metrics = metrics
+		self.scheduled = False
+
+	def __getattr__(self, name):
+		# getPeer, abortConnection, startTLS, ... of the wrapped transport
+		return getattr(self.transport, name)
+
+	def write(self, data):
+		self.compressor.write(data)
+		if not self.scheduled:
+			self.scheduled = True
+			self.call_later(0, self.flush)
+
+	def flush(self):
+		self.scheduled = False
+		bytes_in, seconds = self.compressor.bytes_in, self.compressor.seconds
+		out = self.compressor.flush()
+		if not out:
+			return
+		if self.metrics:
+			self.metrics.compress_bytes_in.inc(self.compressor.bytes_in - bytes_in)
+			self.metrics.compress_bytes_out.inc(len(out))
+			self.metrics.compress_seconds.inc(self.compressor.seconds - seconds)
+		self.transport.write(out)
+
+	def loseConnection(self):
+		self.flush()
+		self.transport.loseConnection()
+
+	def startTLS(self, options):
+		# what was written before STLS goes out first, the deflate stream then continues inside tls
+		self.flush()
+		self.transport.startTLS(options)
+
+if __name__ == '__main__':
+	calls = []
+	class Transport:
+		def __init__(self):
+			self.data = b''
+		def write(self, data):
+			self.data += data
+		def getPeer(self):
+			return ('127.0.0.1', 1234)
+	raw = Transport()
+	budget = Budget(fraction=0.5, window=10)
+	transport = CompressingTransport(raw, Compressor(6, budget), lambda delay, f: calls.append(f))
+	assert(transport.getPeer() == ('127.0.0.1', 1234))
+	transport.write(b'SAID main alice hello\n')
+	transport.write(b'SAID main bob hello\n')
+	assert(len(calls) == 1 and raw.data == b'') # one flush per reactor iteration
+	calls.pop()()
+	decompressor = zlib.decompressobj()
+	assert(decompressor.decompress(raw.data) == b'SAID main alice hello\nSAID main bob hello\n') # complete up to the sync flush
+	sent = len(raw.data)
+	transport.write(b'SAID main alice hello again\n')
+	calls.pop()()
+	assert(decompressor.decompress(raw.data[sent:]) == b'SAID main alice hello again\n')
+	assert(not budget.over())
+	budget.add(6)
+	assert(budget.over())
+	print("Tests went ok")
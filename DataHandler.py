@@ -4,22 +4,31 @@ import subprocess
 import traceback
 import importlib
 import SQLUsers
+import AsyncDB
+import AsyncLog
+import Metrics
+import Watchdog
+import QueryProfiler
+import TrafficCapture
 import ChanServ
 import ip2country
 import datetime
 from protocol import Protocol, Channel, Battle
 import getpass
-from pem.twisted import certificateOptionsFromFiles
+import TLSOptions
+import Compression
+import TimingWheel
 import logging
-from logging.handlers import TimedRotatingFileHandler
-from twisted.internet import ssl
+from twisted.internet import ssl, reactor, threads
 
 import base64
 import hashlib
+import json
 
 
 
 separator = '-'*60
+SNAPSHOT_TIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
 
 try:
 	from urllib2 import urlopen
@@ -30,6 +39,8 @@ except:
 class DataHandler:
 
 	def __init__(self):
+		self.startup_phases = [] # (name, seconds), logged by log_startup
+		self.phase_start = time.time()
 		self.logfilename = "server.log"
 		self.initlogger(self.logfilename)
 		
@@ -40,6 +51,9 @@ class DataHandler:
 		self.console_buffer = []
 		self.port = 8200
 		self.natport = self.port + 1
+		self.httpport = None # read-only json state, off unless set
+		self.http_interval = 5 # seconds, how often the json state is rebuilt at most
+		self.metricsport = None # prometheus metrics on localhost, off unless set
 		self.min_spring_version = '*'
 
 		self.disableSignupMessage = None
@@ -51,7 +65,7 @@ class DataHandler:
 		self.trusted_proxies = set([])		
 		
 		self.server = 'TASSERVER'
-		self.server_version = 'unknown'
+		self._server_version = None # resolved on a thread once the server listens, see detectServerVersion
 		
 		self.sighup = False
 
@@ -60,6 +74,7 @@ class DataHandler:
 		self.channeldb = None
 		self.verificationdb = None
 		self.bandb = None
+		self.dbpool = None
 
 		self.chanserv = None
 		self.engine = None
@@ -67,19 +82,43 @@ class DataHandler:
 		self.trusted_proxyfile = None
 
 		self.pool_size = 50
+		self.max_threads = 4 # db threads
 		self.sqlurl = 'sqlite:///server.db'
 		self.nextbattle = 0
 		self.SayHooks = __import__('SayHooks')
 		self.censor = True
 		self.running = True
 		self.redirect = None
+		self.disableSignupURL = None # --ds: REGISTER points to this site instead
 
 		self.start_time = time.time()
-		self.detectIp()
+		self.detectIp() # local only, the online ip is detected once the server listens
 		self.sslFactory = None
 		
 		# stats
 		self.inbound_command_stats = {}
+		self.metrics = Metrics.ServerMetrics(self) # latency histograms, traffic and gauges
+		self.watchdog = Watchdog.Watchdog(self.metrics) # reactor lag, and what caused stalls
+		self.query_profiler = None
+		self.slow_query_threshold = 0.1 # seconds
+		self.slowlogfile = "slow_queries.log"
+		self.capturefile = None # inbound traffic capture for tests/replay.py, off unless set
+		self.capture = None
+		self.clusterpath = None # unix socket of the cluster broker, off unless set
+		self.cluster_broker = False # run the broker in this process
+		self.node = 0 # this server's number in the cluster, 0 to Cluster.MAX_NODES - 1
+		self.cluster = None
+		self.compress_level = Compression.DEFAULT_LEVEL # highest zlib level COMPRESS may ask for, 0 = COMPRESS is off
+		self.compress_budget = Compression.Budget(0.25) # COMPRESS is refused while compressing takes over a quarter of the reactor's time
+		self.resume_grace = 30 # seconds a lost session of a client with the 'rs' compat flag can be resumed, 0 = off
+		self.resume_buffer_limit = 1 << 20 # bytes queued for a detached session before it is ended early
+		self.workers = 0 # front end worker processes (Frontend.py) sharing the lobby port, 0 = accept in this process
+		self.workersocket = 'workers.sock'
+		self.login_timeout = 60 # seconds a connection may take to log in
+		self.idle_timeout = 60 # seconds a logged in client may send nothing, lobby clients PING every 30
+		self.idle_wheel = TimingWheel.TimingWheel(lambda client: client.timeoutDeadline(), lambda client: client.timeoutConnection()) # swept every second
+		self.handoffpath = None # unix socket to take over from / hand off to another server process, off unless set
+		self.listener = None # the lobby port
 		self.outbound_command_stats = {}
 		self.flag_stats = {}
 		self.agent_stats = {}
@@ -92,6 +131,9 @@ class DataHandler:
 		self.usernames = {} #username->client
 		self.user_ids = {} #user_id->client
 		self.clients = {} #session_id->client
+		self.ended_sessions = [] #(user_id, login_id) of logged out clients, not yet written to db
+		self.purges = [] # SQLUsers.Purge jobs of the running scheduled clean
+		self.purge_pause = 0.1 # seconds between two purge batches
 
 		self.bridged_locations = {} #location->bridge_user_id
 		self.bridged_ids = {} #bridged_id->bridgedClient
@@ -102,6 +144,9 @@ class DataHandler:
 		self.ip_type_cache = {} #ip->state (iphub: 0=non-residential, 1=residential, 2=both)
 		self.recent_registrations = {} #ip_address->int
 		self.recent_renames = {} #user_id->int
+		self.pending_statuses = {} # username -> client, CLIENTSTATUS changes of this reactor iteration for 'bm' clients
+		self.status_flush = None
+		self.detached = {} # username -> (client, time the grace period ends), sessions waiting for RESUME
 		self.flood_limits = {
 			'fresh':{'msglength':1000, 'bytespersecond':1000, 'seconds':2}, # also the default
 			'user':{'msglength':10000, 'bytespersecond':2000, 'seconds':10},
@@ -112,22 +157,26 @@ class DataHandler:
 
 		self.certfile = "server.crt"
 		self.keyfile = "server.key"
+		self.snapshotfile = "state_snapshot.json"
 
 	def initlogger(self, filename):
 		# logging
 		server_logfile = os.path.join(os.path.dirname(__file__), filename)
 		self.logger = logging.getLogger()
 		self.logger.setLevel(logging.DEBUG)
-		fh = TimedRotatingFileHandler(server_logfile, when="midnight", backupCount=6)
+		fh = AsyncLog.BatchedFileHandler(server_logfile, when="midnight", backupCount=6)
 		formatter = logging.Formatter(fmt='%(asctime)s %(levelname)-5s %(module)s.%(funcName)s:%(lineno)d  %(message)s',
 						datefmt='%Y-%m-%d %H:%M:%S')
 		fh.setFormatter(formatter)
 		fh.setLevel(logging.DEBUG)
-		self.logger.addHandler(fh)
+		# formatting, writing and rotation happen on the logwriter thread, the reactor only queues records
+		self.logwriter = AsyncLog.LogWriter([fh])
+		self.logwriter.start()
+		self.logger.addHandler(self.logwriter.handler)
 		
 	def init(self):
 		self.parseFiles()
-		self.get_server_version()		
+		self.startup_phase('config files')
 		
 		now = datetime.datetime.now()
 		sqlalchemy = __import__('sqlalchemy')
@@ -146,6 +195,14 @@ class DataHandler:
 		else:
 			self.engine = sqlalchemy.create_engine(self.sqlurl, pool_size=self.pool_size, pool_recycle=3600)
 
+		self.query_profiler = QueryProfiler.QueryProfiler(self.metrics.db_query_seconds, self.slow_query_threshold,
+			os.path.join(os.path.dirname(__file__), self.slowlogfile))
+		self.query_profiler.instrument(self.engine)
+		self.query_profiler.tag('startup') # until the first command or loop on this (the reactor) thread
+		self.watchdog.on_begin = self.query_profiler.tag # statements on the reactor count for the command or loop running
+		if self.capturefile:
+			self.capture = TrafficCapture.TrafficCapture(self.capturefile)
+		self.startup_phase('db engine')
 		self.session_manager = SQLUsers.session_manager(self, self.engine)
 		
 		self.userdb = SQLUsers.UsersHandler(self)
@@ -153,111 +210,219 @@ class DataHandler:
 		self.verificationdb = SQLUsers.VerificationsHandler(self)
 		self.bridgeduserdb = SQLUsers.BridgedUsersHandler(self)
 
-		self.contentdb = SQLUsers.ContentHandler(self)
-		self.min_spring_version = self.contentdb.get_min_spring_version()
+		self.channeldb = SQLUsers.ChannelsHandler(self)
 
-		self.protocol = Protocol.Protocol(self)
+		# same handlers, but run on db threads and return Deferreds / queue ordered writes
+		self.dbpool = AsyncDB.DBThreadPool(self, self.max_threads)
+		self.dbpool.start()
+		self.userdb_async = AsyncDB.DeferredHandler(self.dbpool, self.userdb)
+		self.bandb_async = AsyncDB.DeferredHandler(self.dbpool, self.bandb)
+		self.verificationdb_async = AsyncDB.DeferredHandler(self.dbpool, self.verificationdb)
+		self.channeldb_async = AsyncDB.DeferredHandler(self.dbpool, self.channeldb)
+		self.userdb_queue = AsyncDB.DeferredHandler(self.dbpool, self.userdb, ordered=True)
+		self.channeldb_queue = AsyncDB.DeferredHandler(self.dbpool, self.channeldb, ordered=True)
 
-		self.channeldb = SQLUsers.ChannelsHandler(self)
-		channels = self.channeldb.all_channels()
+		self.contentdb = SQLUsers.ContentHandler(self)
+		self.startup_phase('db schema and pool')
 
-		# set up channels/battles from db
-		for name in channels:
-			channel = channels[name]
+		t_start = time.time()
+		state = self.load_snapshot()
+		if state:
+			self.min_spring_version = state['min_spring_version']
+		else:
+			self.min_spring_version = self.contentdb.get_min_spring_version()
+			state = self.channeldb.load_all()
+		t_query = time.time()
 
-			owner_user_id = None
-			client = self.userdb.clientFromID(channel['owner_user_id'])
-			if client and client.id:
-				owner_user_id = client.id
+		self.protocol = Protocol.Protocol(self)
 
+		# set up channels/battles from db
+		channel_names = {} # channel_id -> name
+		for dbchannel in state['channels']:
+			name = dbchannel['name']
 			assert(name not in self.channels)
-			dbchannel = channels[name]
 			channel = Channel.Channel(self, name)
 			if name.startswith('__battle__'):
 				channel = Battle.Battle(self, name)
 
-			owner = self.userdb.clientFromID(dbchannel['owner_user_id'])
-			if owner:
-				channel.owner_user_id = owner.id
-
+			channel.owner_user_id = dbchannel['owner_user_id']
 			channel.antispam = dbchannel['antispam']
 			channel.store_history = dbchannel['store_history']
 			channel.id = dbchannel['id']
 			channel.key = dbchannel['key']
 			if channel.key in ('', None, '*'):
 				channel.key = None
-			channel.last_used = dbchannel['last_used']
-			if not channel.last_used: # can remove after first run!
-				channel.last_used = now
-				self.channeldb.recordUse(channel)
+			channel.last_used = dbchannel['last_used'] or now # written by the next recordUse
 
 			channel.topic_user_id = dbchannel['topic_user_id']
 			channel.topic = dbchannel['topic']
 			self.channels[name] = channel
+			channel_names[channel.id] = name
+
+		# set up channel properties, in memory only: the db already has them
+		for forward in state['forwards']:
+			if forward['channel_from_id'] in channel_names and forward['channel_to_id'] in channel_names:
+				self.channels[channel_names[forward['channel_from_id']]].forwards.add(channel_names[forward['channel_to_id']])
+
+		for op in state['operators']:
+			if op['channel_id'] in channel_names:
+				self.channels[channel_names[op['channel_id']]].operators.add(op['user_id'])
+
+		for ban in state['bans']:
+			if ban['channel_id'] in channel_names:
+				channel = self.channels[channel_names[ban['channel_id']]]
+				if ban['user_id'] in channel.ban:
+					continue
+				channel.ban[ban['user_id']] = {'user_id':ban['user_id'], 'ip_address':ban['ip_address'], 'expires':ban['expires'], 'reason':ban['reason'], 'issuer_user_id':ban['issuer_user_id']}
+				channel.ban_ip[ban['ip_address']] = channel.ban[ban['user_id']]
+
+		for ban in state['bridged_bans']:
+			if ban['channel_id'] in channel_names:
+				channel = self.channels[channel_names[ban['channel_id']]]
+				channel.bridged_ban.setdefault(ban['bridged_id'], {'bridged_id':ban['bridged_id'], 'expires':ban['expires'], 'reason':ban['reason'], 'issuer_user_id':ban['issuer_user_id']})
+
+		for mute in state['mutes']:
+			if mute['channel_id'] in channel_names:
+				channel = self.channels[channel_names[mute['channel_id']]]
+				channel.mutelist.setdefault(mute['user_id'], {'user_id':mute['user_id'], 'expires':mute['expires'], 'reason':mute['reason'], 'issuer_user_id':mute['issuer_user_id']})
+
+		self.apply_forwards()
+		t_build = time.time()
 
 		# set up chanserv
-		self.chanserv = ChanServ.ChanServClient(self, (self.online_ip, 0), self.session_id)
-		for name in channels:
+		self.chanserv = ChanServ.ChanServClient(self, (self.online_ip or self.local_ip, 0), self.session_id)
+		for name in self.channels:
 			self.chanserv.HandleProtocolCommand("JOIN %s" %(name))
 
-		if not 'moderator' in channels:
+		if not 'moderator' in self.channels:
 			self.chanserv.Handle(":register moderator ChanServ")
+		t_chanserv = time.time()
+
+		logging.info("Loaded %d channels, %d ops, %d bans, %d bridged bans, %d mutes, %d forwards: db %.2fs, build %.2fs, chanserv %.2fs" % (
+			len(state['channels']), len(state['operators']), len(state['bans']), len(state['bridged_bans']), len(state['mutes']), len(state['forwards']),
+			t_query - t_start, t_build - t_query, t_chanserv - t_build))
+		self.startup_phase('channels and chanserv')
 
-		# set up channel properties
-		forwards = self.channeldb.all_forwards()
-		for forward in forwards:
-			dbchannel_from = self.channeldb.channel_from_id(forward['channel_from_id'])
-			dbchannel_to = self.channeldb.channel_from_id(forward['channel_to_id'])
-			if dbchannel_from and dbchannel_to:
-				self.channels[dbchannel_from.name].forwards.add(dbchannel_to.name)
-
-		operators = self.channeldb.all_operators()
-		for op in operators:
-			dbchannel = self.channeldb.channel_from_id(op['channel_id'])
-			if dbchannel:
-				target = self.clientFromID(op['user_id'], True)
-				if not target: continue
-				self.channels[dbchannel.name].opUser(self.chanserv, target)
-
-		bans = self.channeldb.all_bans()
-		for ban in bans:
-			dbchannel = self.channeldb.channel_from_id(ban['channel_id'])
-			if dbchannel:
-				target = self.clientFromID(ban['user_id'], True)
-				if not target: continue
-				issuer = self.clientFromID(ban['issuer_user_id'], True)
-				if not issuer: issuer = self.chanserv
-				duration = ban['expires'] - now
-				self.channels[dbchannel.name].banUser(issuer, target, ban['expires'], ban['reason'], duration)
-
-		bridged_bans = self.channeldb.all_bridged_bans()
-		for ban in bridged_bans:
-			dbchannel = self.channeldb.channel_from_id(ban['channel_id'])
-			if dbchannel:
-				target = self.bridgedClientFromID(ban['bridged_id'], True)
-				if not target: continue
-				issuer = self.clientFromID(ban['issuer_user_id'], True)
-				if not issuer: issuer = self.chanserv
-				duration = ban['expires'] - now
-				self.channels[dbchannel.name].banBridgedUser(issuer, target, ban['expires'], ban['reason'], duration)
-
-		mutes = self.channeldb.all_mutes()
-		for mute in mutes:
-			dbchannel = self.channeldb.channel_from_id(mute['channel_id'])
-			if dbchannel:
-				target = self.clientFromID(mute['user_id'], True)
-				if not target: continue
-				issuer = self.clientFromID(mute['issuer_user_id'], True)
-				if not issuer: issuer = self.chanserv
-				duration = mute['expires'] - now
-				self.channels[dbchannel.name].muteUser(issuer, target, mute['expires'], mute['reason'], duration)
-		
 		if len(self.userdb.list_mods()[0]) == 0:# 0 is admins, 1 is mods, misleading name
 			print("No admin exist, please enter username and password to create new one")
 			username = input("\033[0mUsername:\033[32m")
 			password = getpass.getpass("\033[0mPassword:")
 			self.userdb.register_user(username, base64.b64encode(hashlib.md5(password.encode()).digest()), "127.0.0.1", "root@localhost", "admin")
 			print("User created, no further action required")
+		self.startup_phase('admin check')
+
+	def startup_phase(self, name):
+		# records the time since the previous phase
+		now = time.time()
+		self.startup_phases.append((name, now - self.phase_start))
+		self.phase_start = now
+
+	def log_startup(self):
+		total = sum(seconds for name, seconds in self.startup_phases)
+		logging.info("Startup took %.2fs: %s" % (total, ', '.join('%s %.2fs' % phase for phase in self.startup_phases)))
+
+	def apply_forwards(self):
+		# a channel forwards its ops, bans and mutes to its forward targets, and on from there
+		# (as Channel.opUser etc. do when they are set), entries the target has itself take precedence
+		changed = True
+		while changed:
+			changed = False
+			for channel in self.channels.values():
+				for name in channel.forwards:
+					if not name in self.channels:
+						continue
+					channel_to = self.channels[name]
+					if not channel.operators <= channel_to.operators:
+						channel_to.operators |= channel.operators
+						changed = True
+					for attr in ('ban', 'ban_ip', 'bridged_ban', 'mutelist'):
+						entries_from = getattr(channel, attr)
+						entries_to = getattr(channel_to, attr)
+						for key in entries_from:
+							if not key in entries_to:
+								entries_to[key] = entries_from[key]
+								changed = True
+
+	def snapshot_state(self):
+		# the registered channels in the form of ChannelsHandler.load_all
+		# leaves out what ChannelsHandler.clean would delete from the db
+		now = datetime.datetime.now()
+		inactive = now - datetime.timedelta(days=180)
+		state = {'channels': [], 'operators': [], 'bans': [], 'bridged_bans': [], 'mutes': [], 'forwards': []}
+		for name, channel in self.channels.items():
+			if not channel.id or not channel.last_used or channel.last_used < inactive:
+				continue
+			state['channels'].append({
+					'id': channel.id,
+					'name': name,
+					'owner_user_id': channel.owner_user_id,
+					'key': channel.key,
+					'topic': channel.topic or '',
+					'topic_user_id': channel.topic_user_id,
+					'antispam': channel.antispam,
+					'store_history': channel.store_history,
+					'last_used': channel.last_used,
+				})
+			for user_id in channel.operators:
+				state['operators'].append({'channel_id': channel.id, 'user_id': user_id})
+			for user_id, ban in channel.ban.items():
+				if ban['expires'] < now: continue
+				state['bans'].append({'channel_id': channel.id, 'issuer_user_id': ban['issuer_user_id'], 'user_id': user_id, 'ip_address': ban['ip_address'], 'expires': ban['expires'], 'reason': ban['reason']})
+			for bridged_id, ban in channel.bridged_ban.items():
+				if ban['expires'] < now: continue
+				state['bridged_bans'].append({'channel_id': channel.id, 'bridged_id': bridged_id, 'issuer_user_id': ban['issuer_user_id'], 'expires': ban['expires'], 'reason': ban['reason']})
+			for user_id, mute in channel.mutelist.items():
+				if mute['expires'] < now: continue
+				state['mutes'].append({'channel_id': channel.id, 'issuer_user_id': mute['issuer_user_id'], 'user_id': user_id, 'expires': mute['expires'], 'reason': mute['reason']})
+			for name_to in channel.forwards:
+				if name_to in self.channels and self.channels[name_to].id:
+					state['forwards'].append({'channel_from_id': channel.id, 'channel_to_id': self.channels[name_to].id})
+		state['min_spring_version'] = self.min_spring_version
+		return state
+
+	def write_snapshot(self):
+		# the change count is read behind all queued db writes, changes made meanwhile can only make the snapshot stale, not wrong
+		if not self.snapshotfile:
+			return
+		d = self.channeldb_queue.change_count()
+		d.addCallback(self.save_snapshot)
+
+	def save_snapshot(self, changes):
+		if not self.snapshotfile:
+			return
+		state = self.snapshot_state()
+		state['changes'] = changes
+		for key in ('channels', 'bans', 'bridged_bans', 'mutes'):
+			for entry in state[key]:
+				for field in ('last_used', 'expires'):
+					if entry.get(field):
+						entry[field] = entry[field].strftime(SNAPSHOT_TIME_FORMAT)
+		tmpfile = self.snapshotfile + '.tmp'
+		with open(tmpfile, 'w') as f:
+			json.dump(state, f, separators=(',', ':'))
+		os.replace(tmpfile, self.snapshotfile) # a crash leaves the old snapshot or the new one, never half of one
+
+	def load_snapshot(self):
+		# returns the state from the last snapshot, or None if state in the db was changed since
+		if not self.snapshotfile or not os.path.isfile(self.snapshotfile):
+			return None
+		try:
+			with open(self.snapshotfile, 'r') as f:
+				state = json.load(f)
+			changes = self.channeldb.change_count()
+			if state['changes'] != changes:
+				logging.info("Snapshot %s is stale (taken at %d db changes, now %d)" % (self.snapshotfile, state['changes'], changes))
+				return None
+			for key in ('channels', 'bans', 'bridged_bans', 'mutes'):
+				for entry in state[key]:
+					for field in ('last_used', 'expires'):
+						if entry.get(field):
+							entry[field] = datetime.datetime.strptime(entry[field], SNAPSHOT_TIME_FORMAT)
+		except Exception as e:
+			logging.error("Could not load snapshot %s: %s" % (self.snapshotfile, str(e)))
+			return None
+		logging.info("Loaded state from snapshot %s" % self.snapshotfile)
+		return state
 
 	def logout_stale_sessions(self):
 		to_logout = []
@@ -277,22 +442,70 @@ class DataHandler:
 	def scheduled_clean(self):
 		logging.info("scheduled clean...")
 		self.ip_type_cache = {}
+		if self.purges:
+			logging.warning("previous scheduled clean is still running at: %s" % self.purges[0].report())
+			return
 		try:
 			self.logout_stale_sessions()
-			self.userdb.audit_access()
-			self.userdb.clean()
-			self.bridgeduserdb.clean()
-			self.channeldb.clean()
-			self.verificationdb.clean()
-			self.bandb.clean()
+			self.dbpool.write(self.userdb.audit_access)
+			self.purges = self.userdb.purges() + self.bridgeduserdb.purges() + self.channeldb.purges() + self.verificationdb.purges() + self.bandb.purges()
 		except:
 			logging.error(traceback.format_exc())
-		logging.info("scheduled clean finished")
+			self.session_manager.rollback_guard()
+		finally:
+			self.session_manager.close_guard()
+		self.run_purge()
+
+	def run_purge(self):
+		# one batch at a time on the db write thread, other db writes queue up in between
+		if not self.purges:
+			logging.info("scheduled clean finished")
+			return
+		d = self.dbpool.write(self.purges[0].run_batch)
+		d.addCallback(self.purge_batch_done)
+
+	def purge_batch_done(self, more):
+		purge = self.purges[0]
+		if not more: # done, or failed (already logged by dbpool.write)
+			logging.info(purge.report())
+			self.purges.pop(0)
+		elif purge.batches % 20 == 0:
+			logging.info("still cleaning, " + purge.report())
+		reactor.callLater(self.purge_pause, self.watchdog.wrap('run_purge', self.run_purge))
+
+	def flush_ended_sessions(self):
+		# write the end of all sessions that closed since the last call, so that a mass disconnect costs one UPDATE
+		if not self.ended_sessions:
+			return
+		sessions = self.ended_sessions
+		self.ended_sessions = []
+		try:
+			self.userdb.end_sessions(sessions)
+		except:
+			logging.error(traceback.format_exc())
+			self.session_manager.rollback_guard()
+		finally:
+			self.session_manager.close_guard()
 
 	def shutdown(self):
+		if self.watchdog.running:
+			self.watchdog.stop()
 		if self.chanserv and self.protocol:
 			self.protocol.in_STATS(self.chanserv)
+		if self.userdb:
+			self.flush_ended_sessions()
+		if self.dbpool:
+			self.dbpool.stop() # all queued writes are in the db now, so the snapshot can be taken at the final count
+			try:
+				self.save_snapshot(self.channeldb.change_count())
+			except:
+				logging.error(traceback.format_exc())
+			finally:
+				self.session_manager.close_guard()
 		self.running = False
+		if self.capture:
+			self.capture.close()
+		self.logwriter.stop() # last, everything above may still log
 
 	def showhelp(self):
 		print('Usage: server.py [OPTIONS]...')
@@ -303,8 +516,40 @@ class DataHandler:
 		print('      { Displays this screen then exits }')
 		print('  -p, --port number')
 		print('      { Server will host on this port (default is 8200) }')
+		print('  --ip address')
+		print('      { Public IP of the server, skips asking springrts.com for it (default is detected) }')
+		print('  --local_ip address')
+		print('      { LAN IP of the server (default is detected) }')
 		print('  -n, --natport number')
 		print('      { Server will use this port for NAT transversal (default is 8201) }')
+		print('  --httpport number')
+		print('      { Serves battles, channels and user counts as json at http://host:port/state (default is off) }')
+		print('  --metricsport number')
+		print('      { Serves prometheus metrics at http://127.0.0.1:port/metrics (default is off) }')
+		print('  --slowlog filename')
+		print('      { Writes sql statements slower than 100ms to this file (default is slow_queries.log) }')
+		print('  --capture filename')
+		print('      { Appends every inbound line (passwords redacted) to this file, for replay with tests/replay.py }')
+		print('  --cluster /path/to/socket')
+		print('      { Shares logged in users, broadcasts and battle listings with the other servers connected to this broker socket }')
+		print('  --cluster_broker')
+		print('      { Runs the cluster broker in this server, on the --cluster socket }')
+		print('  --node number')
+		print('      { Number of this server in the cluster, unique per server (default is 0) }')
+		print('  --compress_level number')
+		print('      { Highest zlib level clients can ask for with COMPRESS, 1-9 (default is 6, 0 disables COMPRESS) }')
+		print('  --resume_grace seconds')
+		print('      { How long clients with the rs compat flag can RESUME a lost connection (default is 30, 0 is off) }')
+		print('  --workers number')
+		print('      { Starts this many worker processes sharing the lobby port, they do tls, framing and flood control (default is 0) }')
+		print('  --workersocket /path/to/socket')
+		print('      { Unix socket the workers connect to (default is workers.sock) }')
+		print('  --login_timeout seconds')
+		print('      { Disconnects connections that did not log in within this time (default is 60) }')
+		print('  --idle_timeout seconds')
+		print('      { Disconnects logged in clients that sent nothing for this long (default is 60) }')
+		print('  --handoff /path/to/socket')
+		print('      { Zero downtime restarts: takes over connections and state from the server on this socket, then waits there for the next one }')
 		print('  -g, --loadargs filename')
 		print('      { Reads additional command-line arguments from file }')
 		print('  -o, --output /path/to/file.log')
@@ -329,6 +574,8 @@ class DataHandler:
 		print('     { redirects connecting clients to the given ip and port')
 		print('   -ds Message')
 		print('     Forbid lobby signup with specified url')
+		print('   --snapshot /path/to/state_snapshot.json')
+		print('     { where to keep the channel state snapshot for fast restarts, without a path snapshots are disabled }')
 		print('SQLURL Examples:')
 		#print('  "sqlite:///:memory:" or "sqlite:///"')
 		#print('     { both make a temporary database in memory }')
@@ -385,6 +632,12 @@ class DataHandler:
 			if arg in ['p', 'port']:
 				try: self.port = int(argp[0])
 				except: print('Invalid port specification')
+			elif arg == 'ip':
+				try: self.online_ip = argp[0]
+				except: print('Invalid IP specification')
+			elif arg == 'local_ip':
+				try: self.local_ip = argp[0]
+				except: print('Invalid local IP specification')
 			elif arg in ['n', 'natport']:
 				try: self.natport = int(argp[0])
 				except: print('Invalid NAT port specification')
@@ -423,6 +676,49 @@ class DataHandler:
 				self.keyfile = argp[0]
 			elif arg == "ds":
 				self.disableSignupURL = argp[0]
+			elif arg == 'httpport':
+				try: self.httpport = int(argp[0])
+				except: print('Invalid HTTP port specification')
+			elif arg == 'metricsport':
+				try: self.metricsport = int(argp[0])
+				except: print('Invalid metrics port specification')
+			elif arg == 'slowlog':
+				try: self.slowlogfile = argp[0]
+				except: print('Error specifying slow query log location')
+			elif arg == 'capture':
+				try: self.capturefile = argp[0]
+				except: print('Error specifying capture file')
+			elif arg == 'cluster':
+				try: self.clusterpath = argp[0]
+				except: print('Error specifying cluster broker socket')
+			elif arg == 'compress_level':
+				try: self.compress_level = max(0, min(Compression.MAX_LEVEL, int(argp[0])))
+				except: print('Invalid compression level')
+			elif arg == 'resume_grace':
+				try: self.resume_grace = int(argp[0])
+				except: print('Invalid resume grace period')
+			elif arg == 'workers':
+				try: self.workers = int(argp[0])
+				except: print('Invalid number of workers')
+			elif arg == 'workersocket':
+				try: self.workersocket = argp[0]
+				except: print('Error specifying worker socket')
+			elif arg == 'login_timeout':
+				try: self.login_timeout = int(argp[0])
+				except: print('Invalid login timeout')
+			elif arg == 'idle_timeout':
+				try: self.idle_timeout = int(argp[0])
+				except: print('Invalid idle timeout')
+			elif arg == 'handoff':
+				try: self.handoffpath = argp[0]
+				except: print('Error specifying handoff socket')
+			elif arg == 'cluster_broker':
+				self.cluster_broker = True
+			elif arg == 'node':
+				try: self.node = int(argp[0])
+				except: print('Invalid node number')
+			elif arg == "snapshot":
+				self.snapshotfile = argp[0] if argp else None
 
 	def loadCertificates(self):
 		if not os.path.isfile(self.certfile) and not os.path.isfile(self.keyfile):
@@ -430,7 +726,7 @@ class DataHandler:
 			certificate.create_self_signed_cert(self.certfile, self.keyfile)
 		os.chmod(self.certfile, 0o600)
 		os.chmod(self.keyfile, 0o600)
-		self.sslFactory = certificateOptionsFromFiles(self.certfile, self.keyfile)
+		self.sslFactory = TLSOptions.load(self.certfile, self.keyfile) # with session resumption
 
 	def parseFiles(self):
 		self.loadCertificates()
@@ -486,12 +782,31 @@ class DataHandler:
 		except Exception as e:
 			logging.error("error whilst loading %s: %s" % (self.trusted_proxyfile, str(e)))		
 
+	@property
+	def server_version(self):
+		return self._server_version or "unknown"
+
+	def detectServerVersion(self):
+		# git describe may take a while on a cold disk, it runs on a thread and clients see "unknown" until it returns
+		d = threads.deferToThread(self.get_server_version)
+		d.addCallback(self.serverVersionDetected)
+		return d
+
+	def serverVersionDetected(self, version):
+		logging.info('Server version: %s' % version)
+		self._server_version = version
+
 	def get_server_version(self):
+		# git describe of the server checkout, runs on a thread
+		path = os.path.dirname(os.path.abspath(__file__))
+		if not os.path.exists(os.path.join(path, '.git')):
+			logging.error("Failed to get server version: not a git checkout")
+			return "unknown"
 		try:
-			self.server_version = subprocess.check_output(["git", "describe"], universal_newlines=True).strip()
+			return subprocess.check_output(["git", "describe"], cwd=path, universal_newlines=True, timeout=5).strip()
 		except:
-			self.server_version = "unknown"			
 			logging.error("Failed to get server version")
+			return "unknown"
 
 	def getUserDB(self):
 		return self.userdb
@@ -505,15 +820,16 @@ class DataHandler:
 	def getContentDB(self):
 		return self.contentdb
 
+	# with fromdb, users logged in on another cluster node come from the db too: a Cluster.RemoteClient has no db fields
 	def clientFromID(self, user_id, fromdb=False):
-		if user_id in self.user_ids: 
+		if user_id in self.user_ids and not (fromdb and self.user_ids[user_id].remote):
 			return self.user_ids[user_id]
 		if not fromdb: 
 			return None
 		return self.userdb.clientFromID(user_id)
 			
 	def clientFromUsername(self, username, fromdb=False):
-		if username in self.usernames: 
+		if username in self.usernames and not (fromdb and self.usernames[username].remote):
 			return self.usernames[username]
 		if not fromdb: 
 			return None
@@ -574,8 +890,7 @@ class DataHandler:
 					target = self.protocol.clientFromID(user_id, True)
 					if not target:
 						continue
-					channel.unmuteUser(chanserv, target, 'mute expired')
-					self.channeldb.unmuteUser(channel, target)
+					channel.unmuteUser(chanserv, target, 'mute expired') # queues the db write
 
 				to_unban = []
 				for user_id in channel.ban:
@@ -587,7 +902,6 @@ class DataHandler:
 					target = self.protocol.clientFromID(user_id, True)
 					if not target:
 						continue
-					self.channeldb.unbanUser(channel, target)
 					channel.unbanUser(chanserv, target)
 
 				to_unban_bridged = []
@@ -600,8 +914,7 @@ class DataHandler:
 					target = self.bridgedClientFromID(bridged_id)
 					if not target:
 						continue
-					channel.unbanBridgedUser(chanserv, bridged_id)
-					self.channeldb.unbanBridgedUser(channel, bridged_id)
+					channel.unbanBridgedUser(chanserv, target)
 		except:
 			logging.error(traceback.format_exc())
 			self.session_manager.rollback_guard()
@@ -631,8 +944,51 @@ class DataHandler:
 	def decrement_recent_renames(self):
 		self.decrement_dict(self.recent_renames)
 
+	def expire_detached(self):
+		# ends the sessions that were not resumed in time, or queued too much meanwhile
+		now = time.time()
+		try:
+			for username, (client, expires) in list(self.detached.items()):
+				if now >= expires:
+					self.protocol._expire(client, 'not resumed')
+				elif len(client.buffer) > self.resume_buffer_limit:
+					self.protocol._expire(client, 'too much data queued while detached')
+			self.session_manager.commit_guard()
+		except:
+			logging.error(traceback.format_exc())
+			self.session_manager.rollback_guard()
+		finally:
+			self.session_manager.close_guard()
+
+	def queue_status(self, client):
+		self.pending_statuses[client.username] = client
+		if not self.status_flush:
+			self.status_flush = reactor.callLater(0, self.flush_statuses)
+
+	def flush_statuses(self):
+		# one CLIENTSTATUSES per 'bm' client for the status changes since the last reactor iteration, latest status of each user
+		self.status_flush = None
+		pending, self.pending_statuses = self.pending_statuses, {}
+		try:
+			# the entries and the lines for clients that know everyone are built once, 'lu' clients get those of the users they know
+			entries = [(client.user_id, '%s %d' % (client.username, client.status)) for client in pending.values() if self.usernames.get(client.username) is client]
+			lines = self.protocol._batch('CLIENTSTATUSES', [entry for user_id, entry in entries])
+			for client in self.clients.values():
+				if not client.logged_in or not 'bm' in client.compat:
+					continue
+				if client.known_users is not None:
+					known = client.known_users
+					client_lines = self.protocol._batch('CLIENTSTATUSES', [entry for user_id, entry in entries if user_id in known])
+				else:
+					client_lines = lines
+				for line in client_lines:
+					client.Send(line)
+		except:
+			logging.error(traceback.format_exc())
+
 	# the sourceClient is only sent for SAY*, and RING commands
-	def multicast(self, session_ids, msg, ignore=(), sourceClient=None, flag=None, not_flag=None):
+	# user is the client msg is about, clients with the 'lu' compat flag only get it if they know that user
+	def multicast(self, session_ids, msg, ignore=(), sourceClient=None, flag=None, not_flag=None, user=None):
 		assert(type(ignore) == set)
 		static = []
 		for session_id in session_ids:
@@ -649,6 +1005,8 @@ class DataHandler:
 				continue
 			if not_flag and not_flag in client.compat: # send to users without compat flag
 				continue
+			if user and client.known_users is not None and not user.user_id in client.known_users:
+				continue
 
 			if client.static:
 				static.append(client)
@@ -660,16 +1018,19 @@ class DataHandler:
 			client.Send(msg)
 
 	# the sourceClient is only sent for SAY*, and RING commands
-	def broadcast(self, msg, chan=None, ignore=set(), sourceClient=None, flag=None, not_flag=None):
+	def broadcast(self, msg, chan=None, ignore=set(), sourceClient=None, flag=None, not_flag=None, user=None):
 		assert(type(ignore) == set)
 		try:
 			if not chan in self.channels:
-				self.multicast(self.clients, msg, ignore, sourceClient, flag, not_flag)
+				self.multicast(self.clients, msg, ignore, sourceClient, flag, not_flag, user)
 				return
 			channel = self.channels[chan]
-			self.multicast(channel.users, msg, ignore, sourceClient, flag, not_flag)
+			self.multicast(channel.users, msg, ignore, sourceClient, flag, not_flag, user)
 		except:
 			logging.error(traceback.format_exc())
+		finally:
+			if self.cluster: # ignore is per session, which doesn't cross nodes
+				self.cluster.broadcast(msg, chan if chan in self.channels else None, sourceClient, flag, not_flag, user)
 
 	# the sourceClient is only sent for SAY*, and RING commands
 	def broadcast_battle(self, msg, battle_id, ignore=set(), sourceClient=None, flag=None, not_flag=None):
@@ -681,6 +1042,7 @@ class DataHandler:
 		self.multicast(battle.users, msg, ignore, sourceClient, flag, not_flag)
 
 	def admin_broadcast(self, msg):
+		# admins on other cluster nodes too, each node broadcasts its own events once
 		for user in self.usernames:
 			client = self.usernames[user]
 			if user == "ChanServ": # needed to allow "reload"
@@ -690,8 +1052,9 @@ class DataHandler:
 
 	def get_ip_address(self):
 		try:
+			# a udp "connect" sends nothing, it only picks the outgoing interface; an ip literal needs no dns
 			s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-			s.connect(("springrts.com", 80))
+			s.connect(("192.0.2.1", 80))
 			res = s.getsockname()[0]
 			s.close()
 			return res
@@ -705,25 +1068,34 @@ class DataHandler:
 		return '127.0.0.1'
 
 	def detectIp(self):
-		logging.info('Detecting local IP:')
-		local_addr = self.get_ip_address()
-		logging.info(local_addr)
-
-		logging.info('Detecting online IP:')
-
+		self.local_ip = self.get_ip_address()
+		logging.info('Local IP: %s' % self.local_ip)
+
+	def detectOnlineIp(self):
+		# asks springrts.com on a thread once the server listens, unless --ip was given
+		# until it answers online_ip is None, i.e. no client is treated as connecting from this host's public ip
+		if self.online_ip:
+			logging.info('Online IP: %s (configured)' % self.online_ip)
+			return
+		d = threads.deferToThread(self.fetchOnlineIp)
+		d.addCallback(self.onlineIpDetected)
+		return d
 
+	def fetchOnlineIp(self):
 		try:
-			timeout = socket.getdefaulttimeout()
-			socket.setdefaulttimeout(5)
-			web_addr = urlopen('https://springrts.com/lobby/getip.php').read().decode("utf-8")
-			socket.setdefaulttimeout(timeout)
-			logging.info(web_addr)
+			return urlopen('https://springrts.com/lobby/getip.php', timeout=5).read().decode("utf-8").strip()
 		except:
-			web_addr = local_addr
-			logging.info('not online')
+			return None
 
-		self.local_ip = local_addr
+	def onlineIpDetected(self, web_addr):
+		if not web_addr:
+			web_addr = self.local_ip
+			logging.info('Online IP: not online, using %s' % web_addr)
+		else:
+			logging.info('Online IP: %s' % web_addr)
 		self.online_ip = web_addr
+		if self.chanserv:
+			self.chanserv.ip_address = web_addr
 
 	def createSocket(self):
 		backlog = 100
@@ -740,9 +1112,16 @@ class DataHandler:
 		logging.info("Command counts (inbound):")
 		for k in sorted(self.inbound_command_stats):
 			logging.info(" %s %d" % (k, self.inbound_command_stats[k]))
+		logging.info("Command time on reactor thread (inbound, total seconds, avg ms, p99 ms):")
+		command_seconds = self.metrics.command_seconds
+		for k in sorted(command_seconds.series):
+			t = command_seconds.sum(k)
+			logging.info(" %s %.3f %.2f %.1f" % (k, t, 1000 * t / command_seconds.count(k), 1000 * command_seconds.quantile(0.99, k)))
 		logging.info("Command counts (outbound):")
 		for k in sorted(self.outbound_command_stats):
 			logging.info(" %s %d" % (k, self.outbound_command_stats[k]))
+		if self.dbpool:
+			self.dbpool.log_stats()
 		logging.info("Number of logins: %d" % self.n_login_stats)
 		logging.info("TLS logins: %d" % self.tls_stats)
 		logging.info("Agents:")
@@ -753,6 +1132,7 @@ class DataHandler:
 		for k in sorted(self.flag_stats):
 			count = self.flag_stats[k]
 			logging.info(" %s %d" % (k, count))
+		logging.info("Log queue: %d records waiting, %d written, %d dropped" % (self.logwriter.queue_length(), self.logwriter.written, self.logwriter.handler.dropped))
 		logging.info(" -- END STATS -- ")		
 		
 	def client_LoginStats(self, client):
@@ -776,7 +1156,8 @@ class DataHandler:
 
 		try:
 			self.parseFiles()
-			self.get_server_version()
+			self.detectServerVersion() # the old one is shown until it returns
+			reactor.callInThread(ip2country.reloaddb) # swaps the db in once it is loaded
 			importlib.reload(sys.modules['Client'])
 			importlib.reload(sys.modules['BridgedClient'])
 			importlib.reload(sys.modules['Channel'])
@@ -789,7 +1170,7 @@ class DataHandler:
 			self.protocol = proto.Protocol(self)
 			self.SayHooks = sayhooks
 			
-			self.chanserv = chanserv.ChanServClient(self, (self.online_ip, 0), self.chanserv.session_id)
+			self.chanserv = chanserv.ChanServClient(self, (self.online_ip or self.local_ip, 0), self.chanserv.session_id)
 			for chan in self.channels:
 				channel = self.channels[chan]
 				if channel.registered():
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# coding=utf-8
+# This file is part of the uberserver (GPL v2 or later), see LICENSE
+# front end worker: accepts lobby connections on a SO_REUSEPORT port shared with the other workers,
+# does TLS, line framing and flood control, and passes complete lines to the state process (server.py --workers N)
+#
+# worker and state process talk over a unix socket in frames: kind (1 byte), session (4 bytes), length (4 bytes), payload
+# sessions are numbered per worker, the state process gives each its own session_id
+
+import os
+import sys
+import time
+import struct
+import socket
+import logging
+import argparse
+import collections
+
+from twisted.internet import reactor, protocol
+
+HEADER = struct.Struct('!BII')
+
+# worker -> state
+CONNECT = 1 # payload: "host port"
+DATA = 2 # payload: complete utf-8 lines, each ending in \n
+CLOSE = 3 # connection is gone
+FLOOD = 4 # payload: "bytes reason", a flood limit was breached, for the moderators
+# state -> worker
+SEND = 11 # payload: bytes to write
+KICK = 12 # close the connection
+STARTTLS = 13 # switch to tls after the bytes sent so far
+LIMITS = 14 # payload: "bytespersecond seconds msglength"
+
+Peer = collections.namedtuple('Peer', ('host', 'port'))
+
+FRESH_LIMITS = (1000, 2, 1000) # DataHandler.flood_limits['fresh'], until the state process sends others
+
+def frame(kind, session, payload=b''):
+	return HEADER.pack(kind, session, len(payload)) + payload
+
+class FrameReceiver(protocol.Protocol):
+	'splits the stream into frames, calls frameReceived(kind, session, payload)'
+	def connectionMade(self):
+		self.buffer = b''
+
+	def dataReceived(self, data):
+		self.buffer += data
+		pos = 0
+		while len(self.buffer) - pos >= HEADER.size:
+			kind, session, length = HEADER.unpack_from(self.buffer, pos)
+			if len(self.buffer) - pos - HEADER.size < length:
+				break
+			start = pos + HEADER.size
+			self.frameReceived(kind, session, self.buffer[start:start + length])
+			pos = start + length
+		self.buffer = self.buffer[pos:]
+
+	def sendFrame(self, kind, session, payload=b''):
+		self.transport.write(frame(kind, session, payload))
+
+class FrontendConnection(protocol.Protocol):
+	'one lobby client on this worker'
+	def connectionMade(self):
+		if not self.factory.link:
+			self.transport.abortConnection() # not connected to the state process (yet)
+			return
+		self.factory.next_session += 1
+		self.session = self.factory.next_session
+		self.factory.sessions[self.session] = self
+		self.data = b''
+		self.history = {} # second -> bytes received, like Client.msg_length_history
+		self.bytespersecond, self.seconds, self.msglength = FRESH_LIMITS
+		peer = self.transport.getPeer()
+		self.factory.link.sendFrame(CONNECT, self.session, ('%s %d' % (peer.host, peer.port)).encode('utf-8'))
+
+	def connectionLost(self, reason):
+		if not hasattr(self, 'session'):
+			return
+		if self.factory.sessions.pop(self.session, None) and self.factory.link:
+			self.factory.link.sendFrame(CLOSE, self.session)
+
+	def flood(self, reason, count, msg):
+		self.transport.write(('SERVERMSG %s\n' % msg).encode('utf-8'))
+		self.factory.link.sendFrame(FLOOD, self.session, ('%d %s' % (count, reason)).encode('utf-8'))
+
+	def dataReceived(self, data):
+		now = int(time.time())
+		self.history[now] = self.history.get(now, 0) + len(data)
+		total = 0
+		for second in list(self.history):
+			if second < now - (self.seconds - 1):
+				del self.history[second]
+			else:
+				total += self.history[second]
+		if total > self.bytespersecond * self.seconds:
+			self.flood('flood limit', total, 'No flooding (over %s per second for %s seconds)' % (self.bytespersecond, self.seconds))
+			self.transport.abortConnection()
+			return
+
+		self.data += data
+		end = self.data.rfind(b'\n')
+		if end < 0:
+			# if far too much data has accumulated without a newline, just clear it
+			if len(self.data) > self.msglength * 16:
+				self.flood('max client data cache', len(self.data), 'Max client data cache was exceeded, some of your data was dropped by the server')
+				self.data = b''
+			return
+		lines, self.data = self.data[:end + 1], self.data[end + 1:]
+		if len(lines) > self.msglength: # rare, only then look at single lines
+			kept = []
+			for line in lines.split(b'\n'):
+				if len(line) > self.msglength:
+					self.flood('max message length', len(line), 'message length limit of %i chars was exceeded: command "%s..." dropped.' % (self.msglength, line[:16].decode('utf-8', 'replace')))
+				elif line:
+					kept.append(line + b'\n')
+			lines = b''.join(kept)
+		if lines:
+			self.factory.link.sendFrame(DATA, self.session, lines)
+
+class FrontendFactory(protocol.Factory):
+	protocol = FrontendConnection
+
+	def __init__(self, tls_options):
+		self.tls_options = tls_options
+		self.sessions = {}
+		self.next_session = 0
+		self.link = None
+
+class StateLink(FrameReceiver):
+	'connection of a worker to the state process'
+	def connectionMade(self):
+		FrameReceiver.connectionMade(self)
+		self.factory.frontend.link = self
+		logging.info("Worker connected to the state process")
+
+	def connectionLost(self, reason):
+		# without the state process the clients can't be served
+		self.factory.frontend.link = None
+		for connection in list(self.factory.frontend.sessions.values()):
+			connection.transport.abortConnection()
+		logging.error("Lost the state process, exiting")
+		if reactor.running:
+			reactor.stop()
+
+	def frameReceived(self, kind, session, payload):
+		connection = self.factory.frontend.sessions.get(session)
+		if not connection:
+			return # closed meanwhile, its CLOSE is on the way
+		if kind == SEND:
+			connection.transport.write(payload)
+		elif kind == KICK:
+			connection.transport.abortConnection()
+		elif kind == STARTTLS:
+			connection.transport.startTLS(self.factory.frontend.tls_options)
+		elif kind == LIMITS:
+			connection.bytespersecond, connection.seconds, connection.msglength = [int(x) for x in payload.split(b' ')]
+
+class StateLinkFactory(protocol.ClientFactory):
+	protocol = StateLink
+
+	def __init__(self, frontend):
+		self.frontend = frontend
+
+	def clientConnectionFailed(self, connector, reason):
+		logging.error("Could not connect to the state process: %s" % reason.value)
+		reactor.stop()
+
+def reuseport_socket(port, interface=''):
+	# every worker binds its own listening socket to the port, the kernel spreads new connections over them
+	sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+	sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+	sock.bind((interface, port))
+	sock.listen(128)
+	sock.setblocking(False)
+	return sock
+
+def main():
+	parser = argparse.ArgumentParser(description='uberserver front end worker, started by server.py --workers N')
+	parser.add_argument('--port', type=int, default=8200)
+	parser.add_argument('--state', required=True, help='unix socket of the state process')
+	parser.add_argument('--cert', default='server.crt')
+	parser.add_argument('--key', default='server.key')
+	parser.add_argument('--worker', type=int, default=0)
+	args = parser.parse_args()
+	logging.basicConfig(level=logging.INFO, format='%(asctime)s worker ' + str(args.worker) + ' %(levelname)s %(message)s')
+
+	import TLSOptions
+	frontend = FrontendFactory(TLSOptions.load(args.cert, args.key)) # the same tls setup as DataHandler.loadCertificates
+	sock = reuseport_socket(args.port)
+	reactor.connectUNIX(args.state, StateLinkFactory(frontend))
+	reactor.adoptStreamPort(sock.fileno(), socket.AF_INET, frontend)
+	sock.close() # the reactor has its own copy
+	logging.info("Worker %d accepting on port %d" % (args.worker, args.port))
+	reactor.run()
+
+def spawn(root, count, path):
+	# starts the workers of server.py --workers N, they exit when the state process is gone
+	import subprocess
+	script = os.path.abspath(__file__)
+	return [subprocess.Popen([sys.executable, script, '--port', str(root.port), '--state', path, '--cert', root.certfile, '--key', root.keyfile, '--worker', str(i)])
+		for i in range(count)]
+
+if __name__ == '__main__':
+	main()
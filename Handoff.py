@@ -0,0 +1,442 @@
+# coding=utf-8
+# This file is part of the uberserver (GPL v2 or later), see LICENSE
+# zero downtime restarts: a new server process takes over the lobby port, the connections and the state of the running one
+#
+# both are started with the same --handoff socket. the running server listens there, a new one connects
+# once its init is done and before it listens anywhere else. the old server stops reading, waits for logins
+# and db calls in flight, then sends its clients, channels and battles as json, followed by the file
+# descriptors of the lobby port and of every connection. the new server adopts them and replies OK, the old
+# one writes its last db changes and exits without closing a connection, the clients notice nothing.
+#
+# tls and COMPRESS connections can't be moved, their tls / zlib state is in the old process: they are closed,
+# clients with the 'rs' compat flag RESUME on the new server, others have to log in again.
+# not supported with --workers (the connections are in the worker processes) or --cluster
+
+import os
+import json
+import time
+import base64
+import socket
+import struct
+import logging
+import datetime
+import traceback
+
+from twisted.internet import reactor, protocol
+from twisted.protocols.basic import LineReceiver
+
+import Client
+import Compression
+import Channel
+import Battle
+import BridgedClient
+
+MAX_FDS = 253 # SCM_MAX_FD, file descriptors per message
+WAIT = 10 # seconds the old server waits for logins and db calls in flight before it cancels
+TIMEOUT = 60 # seconds either side waits for the other
+HEADER = struct.Struct('!I') # length of the json state
+
+CLIENT_FIELDS = tuple(field for field in Client.Client.__slots__ if field != '_root')
+
+def encode(value):
+	# json for client, channel and battle attributes: sets, tuples, datetimes, bytes and dicts are tagged
+	if value is None or isinstance(value, (bool, int, float, str)):
+		return value
+	if isinstance(value, list):
+		return [encode(v) for v in value]
+	if isinstance(value, dict):
+		return {'d': [[encode(k), encode(v)] for k, v in value.items()]}
+	if isinstance(value, frozenset):
+		return {'f': [encode(v) for v in value]}
+	if isinstance(value, set):
+		return {'s': [encode(v) for v in value]}
+	if isinstance(value, tuple):
+		return {'t': [encode(v) for v in value]}
+	if isinstance(value, datetime.datetime):
+		return {'dt': value.isoformat()}
+	if isinstance(value, datetime.timedelta):
+		return {'td': [value.days, value.seconds, value.microseconds]}
+	if isinstance(value, bytes):
+		return {'b': base64.b64encode(value).decode('ascii')}
+	raise TypeError('cannot hand off a %s' % type(value).__name__)
+
+def decode(value):
+	if isinstance(value, list):
+		return [decode(v) for v in value]
+	if not isinstance(value, dict):
+		return value
+	tag, data = next(iter(value.items()))
+	if tag == 'd':
+		return {decode(k): decode(v) for k, v in data}
+	if tag == 'f':
+		return frozenset(decode(v) for v in data)
+	if tag == 's':
+		return set(decode(v) for v in data)
+	if tag == 't':
+		return tuple(decode(v) for v in data)
+	if tag == 'dt':
+		return datetime.datetime.fromisoformat(data)
+	if tag == 'td':
+		return datetime.timedelta(*data)
+	if tag == 'b':
+		return base64.b64decode(data)
+	raise ValueError('unknown tag %s' % tag)
+
+def encode_object(obj, fields):
+	state = {}
+	for field in fields:
+		if field == '_root' or not hasattr(obj, field):
+			continue
+		try:
+			state[field] = encode(getattr(obj, field))
+		except TypeError as e:
+			logging.error("Handoff leaves out %s.%s: %s" % (type(obj).__name__, field, str(e)))
+	return state
+
+def decode_object(obj, state):
+	for field, value in state.items():
+		setattr(obj, field, decode(value))
+	return obj
+
+def pending_output(transport):
+	# what twisted buffered for a connection and did not write to its socket yet
+	data = bytes(getattr(transport, 'dataBuffer', b'')[getattr(transport, 'offset', 0):])
+	return data + b''.join(getattr(transport, '_tempDataBuffer', []))
+
+def frame(state):
+	data = json.dumps(state, separators=(',', ':')).encode('utf-8')
+	return HEADER.pack(len(data)) + data
+
+def recv_exact(sock, size):
+	data = b''
+	while len(data) < size:
+		chunk = sock.recv(size - len(data))
+		if not chunk:
+			raise ConnectionError('the other server went away')
+		data += chunk
+	return data
+
+def family(fd):
+	sock = socket.socket(fileno=fd)
+	try:
+		return sock.family
+	finally:
+		sock.detach()
+
+class Handoff:
+	'''
+	hands the lobby port, the connections and the state of root to the new server behind transport
+	(its connection to the --handoff socket), then ends this process
+	'''
+	def __init__(self, root, factory, transport):
+		self._root = root
+		self.factory = factory
+		self.transport = transport
+		self.paused = [] # clients that stopped reading, their connections are handed off
+		self.closing = [] # tls and compressed clients, resumable on the new server
+		self.quiet = 0
+		self.deadline = 0
+
+	def detached(self, client):
+		entry = self._root.detached.get(client.username)
+		return entry is not None and entry[0] is client
+
+	def start(self):
+		root = self._root
+		if root.workers or root.cluster or not root.listener:
+			self.cancel('not supported with frontend workers or in a cluster')
+			return
+		logging.info("Handing off to a new server process")
+		root.listener.stopReading() # new connections wait in the backlog for the new server
+		for client in list(root.clients.values()):
+			if client.static or self.detached(client):
+				continue
+			if client.TLS or isinstance(client.transport, Compression.CompressingTransport):
+				self.closing.append(client)
+				client.transport.loseConnection() # Protocol._detach keeps the session if it can be resumed
+			else:
+				client.transport.stopReading()
+				self.paused.append(client)
+		root.flush_statuses()
+		root.flush_ended_sessions()
+		self.deadline = time.time() + WAIT
+		self.wait()
+
+	def busy(self):
+		root = self._root
+		closing = [client for client in self.closing if client.session_id in root.clients and not self.detached(client)]
+		if closing:
+			return '%d tls or compressed connections closing' % len(closing)
+		logins = [client for client in root.clients.values() if client.login_pending]
+		if logins:
+			return '%d logins waiting for the db' % len(logins)
+		if not root.dbpool.idle():
+			return 'db calls in flight'
+		return None
+
+	def wait(self):
+		busy = self.busy()
+		self.quiet = 0 if busy else self.quiet + 1
+		if self.quiet >= 2: # a second look, for db results that were on their way to the reactor thread
+			self.send()
+		elif busy and time.time() > self.deadline:
+			self.cancel('still busy after %d seconds: %s' % (WAIT, busy))
+		else:
+			reactor.callLater(0.05, self.wait)
+
+	def resume(self):
+		root = self._root
+		if root.listener:
+			root.listener.startReading()
+		for client in self.paused:
+			if client.session_id in root.clients:
+				client.transport.startReading()
+		self.factory.handoff = None
+
+	def cancel(self, reason):
+		logging.error("Handoff cancelled: %s" % reason)
+		self.resume()
+		self.transport.write(frame({'error': reason}))
+		self.transport.loseConnection()
+
+	def state(self):
+		# the json state and the file descriptors it refers to, the lobby port first
+		root = self._root
+		fds = [root.listener.fileno()]
+		clients = []
+		for client in root.clients.values():
+			if client.static:
+				continue
+			entry = {'fields': encode_object(client, CLIENT_FIELDS), 'fd': None}
+			if self.detached(client):
+				entry['detached'] = root.detached[client.username][1]
+			elif client.transport.connected:
+				entry['fd'] = len(fds)
+				entry['output'] = encode(pending_output(client.transport))
+				fds.append(client.transport.fileno())
+			else:
+				continue
+			clients.append(entry)
+		state = {
+			'fds': len(fds),
+			'session_id': root.session_id,
+			'nextbattle': root.nextbattle,
+			'chanserv': root.chanserv.session_id,
+			'clients': clients,
+			'channels': [encode_object(channel, list(vars(channel))) for channel in root.channels.values()],
+			'bridged': [encode_object(bridged, list(vars(bridged))) for bridged in root.bridged_ids.values()],
+			'bridged_locations': encode(root.bridged_locations),
+			'recent_registrations': encode(root.recent_registrations),
+			'recent_renames': encode(root.recent_renames),
+			'nonres_registrations': encode(root.nonres_registrations),
+		}
+		return state, fds
+
+	def send(self):
+		root = self._root
+		start = time.time()
+		try:
+			state, fds = self.state()
+			data = frame(state)
+		except:
+			logging.error(traceback.format_exc())
+			self.cancel('could not serialize the state')
+			return
+
+		# blocking from here on, nothing else should run in this process anymore
+		sock = self.transport.socket
+		self.transport.stopReading()
+		try:
+			sock.settimeout(TIMEOUT)
+			sock.sendall(data)
+			for i in range(0, len(fds), MAX_FDS):
+				socket.send_fds(sock, [b'F'], fds[i:i + MAX_FDS])
+			reply = recv_exact(sock, 3)
+		except OSError as e:
+			reply = str(e).encode('utf-8')
+		if reply != b'OK\n':
+			logging.error("Handoff failed, the new server did not take over: %s" % reply.decode('utf-8', 'replace'))
+			sock.setblocking(False)
+			self.resume()
+			self.transport.loseConnection()
+			return
+
+		logging.info("Handed off %d connections and %d detached sessions (%d bytes of state) in %.2fs, exiting" % (
+			len(fds) - 1, len(state['clients']) - len(fds) + 1, len(data), time.time() - start))
+		root.shutdown()
+		# the new server listens on the other ports once the handoff socket closed, at exit that one could go
+		# before them: close everything else first. this only drops our descriptors of the handed off connections
+		fd = sock.fileno()
+		os.closerange(3, fd)
+		os.closerange(fd + 1, os.sysconf('SC_OPEN_MAX'))
+		os._exit(0) # not through the reactor, which would close the connections
+
+class HandoffRequest(LineReceiver):
+	'a new server process asking for a handoff'
+	delimiter = b'\n'
+
+	def lineReceived(self, line):
+		if line != b'HANDOFF' or self.factory.handoff:
+			self.transport.loseConnection()
+			return
+		self.factory.handoff = Handoff(self.factory.root, self.factory, self.transport)
+		self.factory.handoff.start()
+
+class HandoffFactory(protocol.Factory):
+	protocol = HandoffRequest
+
+	def __init__(self, root):
+		self.root = root
+		self.handoff = None # the one in progress
+
+def listen(root, path):
+	if os.path.exists(path):
+		os.unlink(path)
+	reactor.listenUNIX(path, HandoffFactory(root), mode=0o600) # whoever connects gets all connections
+	logging.info("Listening for handoffs on %s" % path)
+
+class RestoreFactory(protocol.Factory):
+	'builds the client of one handed off connection with factory, Chat.connectionMade then restores it from entry'
+	def __init__(self, factory, entry):
+		self.factory = factory
+		self.entry = entry
+
+	def buildProtocol(self, addr):
+		client = self.factory.buildProtocol(addr)
+		client.restore = self.entry
+		return client
+
+def restore_client(root, client, entry):
+	decode_object(client, entry['fields'])
+	client._root = root
+	root.clients[client.session_id] = client
+	output = decode(entry.get('output'))
+	if output:
+		client.transport.write(output)
+
+class Takeover:
+	'the state and file descriptors handed off by the running server, see connect'
+	def __init__(self, sock, state, fds):
+		self.sock = sock
+		self.state = state
+		self.fds = fds
+
+	def restore(self, root, factory):
+		# rebuilds the state in root (after its init), adopts the connections with factory (a ChatFactory)
+		# returns the adopted lobby port
+		start = time.time()
+		state = self.state
+		root.session_id = max(root.session_id, state['session_id'])
+		root.nextbattle = state['nextbattle']
+		root.recent_registrations = decode(state['recent_registrations'])
+		root.recent_renames = decode(state['recent_renames'])
+		root.nonres_registrations = decode(state['nonres_registrations'])
+
+		root.channels = {}
+		for fields in state['channels']:
+			cls = Battle.Battle if decode(fields.get('identity')) == 'battle' else Channel.Channel
+			channel = decode_object(cls(root, decode(fields['name'])), fields)
+			if state['chanserv'] in channel.users and state['chanserv'] != root.chanserv.session_id:
+				channel.users.remove(state['chanserv'])
+				channel.users.add(root.chanserv.session_id)
+			root.channels[channel.name] = channel
+		root.battles = dict((channel.battle_id, channel) for channel in root.channels.values() if channel.identity == 'battle' and channel.battle_id is not None)
+		root.chanserv.channels = set(name for name, channel in root.channels.items() if root.chanserv.session_id in channel.users)
+
+		for fields in state['bridged']:
+			bridged = decode_object(BridgedClient.BridgedClient(), fields)
+			root.bridged_ids[bridged.bridged_id] = bridged
+			root.bridged_usernames[bridged.username] = bridged
+		root.bridged_locations = decode(state['bridged_locations'])
+
+		port = reactor.adoptStreamPort(self.fds[0], family(self.fds[0]), factory)
+		os.close(self.fds[0]) # twisted adopts a duplicate
+		for entry in state['clients']:
+			if entry['fd'] is None:
+				client = factory.buildProtocol(None)
+				restore_client(root, client, entry)
+				root.detached[client.username] = (client, entry['detached'])
+				continue
+			fd = self.fds[entry['fd']]
+			reactor.adoptStreamConnection(fd, family(fd), RestoreFactory(factory, entry))
+			os.close(fd)
+		for client in root.clients.values():
+			if client.logged_in and not client.static:
+				root.usernames[client.username] = client
+				root.user_ids[client.user_id] = client
+		logging.info("Took over %d connections and %d detached sessions, %d channels and %d battles in %.2fs" % (
+			len(self.fds) - 1, len(root.detached), len(root.channels), len(root.battles), time.time() - start))
+		return port
+
+	def finish(self):
+		# lets the old server exit and waits until it did, so the ports it still holds (nat, http) are free
+		self.sock.sendall(b'OK\n')
+		try:
+			while self.sock.recv(4096):
+				pass
+		except OSError:
+			pass
+		self.sock.close()
+
+def connect(path):
+	'''
+	asks the server listening on path to hand off to this process
+	returns a Takeover, or None if no server listens there (a normal start)
+	'''
+	sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	try:
+		sock.connect(path)
+	except (FileNotFoundError, ConnectionRefusedError):
+		sock.close()
+		return None
+	logging.info("Taking over from the server on %s" % path)
+	sock.settimeout(TIMEOUT)
+	sock.sendall(b'HANDOFF\n')
+	size, = HEADER.unpack(recv_exact(sock, HEADER.size))
+	state = json.loads(recv_exact(sock, size).decode('utf-8'))
+	if 'error' in state:
+		sock.close()
+		raise RuntimeError('the running server cancelled the handoff: %s' % state['error'])
+	fds = []
+	while len(fds) < state['fds']:
+		data, received, flags, address = socket.recv_fds(sock, 1, MAX_FDS)
+		fds += received
+		if not data:
+			raise ConnectionError('the running server went away')
+		if flags & socket.MSG_CTRUNC:
+			raise RuntimeError('file descriptors were cut off, raise the open file limit (ulimit -n)')
+	return Takeover(sock, state, fds)
+
+if __name__ == '__main__':
+	now = datetime.datetime.now()
+	values = [None, 1, 'a', [1, {2, 3}], {1: 'a', 'b': (2, 3)}, frozenset(), now, datetime.timedelta(minutes=5), b'\x00\xff', {'d': 1}]
+	for value in values:
+		assert(decode(json.loads(json.dumps(encode(value)))) == value)
+	assert(type(decode(encode(frozenset()))) is frozenset)
+
+	class Transport:
+		dataBuffer = b'SAID main alice hi\nSAID'
+		offset = 19
+		_tempDataBuffer = [b' main bob hi\n']
+	assert(pending_output(Transport()) == b'SAID main bob hi\n')
+
+	# file descriptors over a socket pair, more than fit in one message
+	old, new = socket.socketpair()
+	pipes = [os.pipe() for i in range(300)]
+	old.sendall(frame({'fds': len(pipes)}))
+	for i in range(0, len(pipes), MAX_FDS):
+		socket.send_fds(old, [b'F'], [r for r, w in pipes[i:i + MAX_FDS]])
+	size, = HEADER.unpack(recv_exact(new, HEADER.size))
+	state = json.loads(recv_exact(new, size).decode('utf-8'))
+	fds = []
+	while len(fds) < state['fds']:
+		data, received, flags, address = socket.recv_fds(new, 1, MAX_FDS)
+		fds += received
+	os.write(pipes[299][1], b'x')
+	assert(os.read(fds[299], 1) == b'x')
+	for fd in fds:
+		os.close(fd)
+	for r, w in pipes:
+		os.close(r)
+		os.close(w)
+	print("Tests went ok")
@@ -0,0 +1,210 @@
+# coding=utf-8
+# This file is part of the uberserver (GPL v2 or later), see LICENSE
+# counters, gauges and histograms, served in the prometheus text format and summarized by STATS
+
+import time
+import bisect
+import logging
+
+from twisted.internet import reactor
+from twisted.web import server, resource
+
+# seconds
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+class Counter:
+	def __init__(self, name, help, label=None):
+		self.name = name
+		self.help = help
+		self.label = label
+		self.values = {} # label value -> count, None without label
+
+	def inc(self, amount=1, value=None):
+		self.values[value] = self.values.get(value, 0) + amount
+
+	def render(self, out):
+		out.append('# HELP %s %s' % (self.name, self.help))
+		out.append('# TYPE %s counter' % self.name)
+		for value in sorted(self.values, key=str):
+			out.append('%s%s %s' % (self.name, _labels(self.label, value), self.values[value]))
+
+class Gauge:
+	# read from func when scraped, so it costs nothing before
+	type = 'gauge'
+
+	def __init__(self, name, help, func):
+		self.name = name
+		self.help = help
+		self.func = func
+
+	def render(self, out):
+		out.append('# HELP %s %s' % (self.name, self.help))
+		out.append('# TYPE %s %s' % (self.name, self.type))
+		out.append('%s %s' % (self.name, self.func()))
+
+class CounterFunc(Gauge):
+	# a count kept by another module, e.g. AsyncLog's dropped records, read from func when scraped
+	type = 'counter'
+
+class Histogram:
+	'''
+	observe() adds to one bucket (plus count and sum), the buckets are made cumulative when rendered
+	observations from other threads (db pool) are not locked, a lost increment now and then is fine here
+	'''
+	def __init__(self, name, help, label=None, buckets=DEFAULT_BUCKETS):
+		self.name = name
+		self.help = help
+		self.label = label
+		self.buckets = buckets
+		self.series = {} # label value -> [count per bucket..., count above the last bucket, total count, sum]
+
+	def observe(self, amount, value=None):
+		series = self.series.get(value)
+		if series is None:
+			series = self.series[value] = [0] * (len(self.buckets) + 2) + [0.0]
+		series[bisect.bisect_left(self.buckets, amount)] += 1
+		series[-2] += 1
+		series[-1] += amount
+
+	def count(self, value=None):
+		return self.series[value][-2] if value in self.series else 0
+
+	def sum(self, value=None):
+		return self.series[value][-1] if value in self.series else 0.0
+
+	def quantile(self, q, value=None):
+		# upper bound of the bucket the q-quantile falls into
+		if not self.count(value):
+			return 0.0
+		series = self.series[value]
+		rank = q * series[-2]
+		seen = 0
+		for i, bound in enumerate(self.buckets):
+			seen += series[i]
+			if seen >= rank:
+				return bound
+		return float('inf')
+
+	def render(self, out):
+		out.append('# HELP %s %s' % (self.name, self.help))
+		out.append('# TYPE %s histogram' % self.name)
+		for value in sorted(self.series, key=str):
+			series = self.series[value]
+			cumulative = 0
+			for i, bound in enumerate(self.buckets):
+				cumulative += series[i]
+				out.append('%s_bucket%s %d' % (self.name, _labels(self.label, value, 'le', repr(bound)), cumulative))
+			out.append('%s_bucket%s %d' % (self.name, _labels(self.label, value, 'le', '+Inf'), series[-2]))
+			out.append('%s_count%s %d' % (self.name, _labels(self.label, value), series[-2]))
+			out.append('%s_sum%s %f' % (self.name, _labels(self.label, value), series[-1]))
+
+def _labels(label, value, extra_label=None, extra_value=None):
+	labels = []
+	if label:
+		labels.append('%s="%s"' % (label, str(value).replace('\\', '\\\\').replace('"', '\\"')))
+	if extra_label:
+		labels.append('%s="%s"' % (extra_label, extra_value))
+	return '{%s}' % ','.join(labels) if labels else ''
+
+class Metrics:
+	def __init__(self):
+		self.metrics = []
+
+	def counter(self, name, help, label=None):
+		return self._add(Counter(name, help, label))
+
+	def gauge(self, name, help, func):
+		return self._add(Gauge(name, help, func))
+
+	def counter_func(self, name, help, func):
+		return self._add(CounterFunc(name, help, func))
+
+	def histogram(self, name, help, label=None, buckets=DEFAULT_BUCKETS):
+		return self._add(Histogram(name, help, label, buckets))
+
+	def _add(self, metric):
+		self.metrics.append(metric)
+		return metric
+
+	def render(self):
+		out = []
+		for metric in self.metrics:
+			metric.render(out)
+		return '\n'.join(out) + '\n'
+
+class ServerMetrics(Metrics):
+	# the metrics of DataHandler, as root.metrics
+	def __init__(self, root):
+		Metrics.__init__(self)
+		self._root = root
+		self.command_seconds = self.histogram('uberserver_command_seconds', 'Time spent handling inbound commands on the reactor thread', 'command')
+		self.bytes_received = self.counter('uberserver_bytes_received_total', 'Bytes received from lobby clients')
+		self.bytes_sent = self.counter('uberserver_bytes_sent_total', 'Bytes sent to lobby clients')
+		self.db_query_seconds = self.histogram('uberserver_db_query_seconds', 'Time of single sql statements, on any thread')
+		self.compress_bytes_in = self.counter('uberserver_compress_bytes_in_total', 'Bytes written to COMPRESS clients before compression')
+		self.compress_bytes_out = self.counter('uberserver_compress_bytes_out_total', 'Bytes written to COMPRESS clients after compression')
+		self.compress_seconds = self.counter('uberserver_compress_seconds_total', 'Time spent compressing output')
+		self.reactor_lag_seconds = self.histogram('uberserver_reactor_lag_seconds', 'How late the watchdog timer on the reactor ran')
+		self.gauge('uberserver_clients', 'Connected clients', lambda: len(root.clients))
+		self.gauge('uberserver_logged_in_clients', 'Logged in clients', lambda: len(root.usernames))
+		self.gauge('uberserver_battles', 'Open battles', lambda: len(root.battles))
+		self.gauge('uberserver_channels', 'Channels', lambda: len(root.channels))
+		self.gauge('uberserver_log_queue_length', 'Log records waiting for the writer thread', lambda: root.logwriter.queue_length())
+		self.counter_func('uberserver_log_dropped_total', 'Log records dropped because the queue was full', lambda: root.logwriter.handler.dropped)
+		self.gauge('uberserver_db_queue_length', 'Calls waiting for a db pool thread', lambda: root.dbpool.queue_length() if root.dbpool else 0)
+
+	def summary(self, top=10):
+		# short text for STATS
+		lines = []
+		lines.append('clients: %d connected, %d logged in, %d battles' % (len(self._root.clients), len(self._root.usernames), len(self._root.battles)))
+		lines.append('traffic: %d bytes in, %d bytes out' % (self.bytes_received.values.get(None, 0), self.bytes_sent.values.get(None, 0)))
+		compressed = self.compress_bytes_in.values.get(None, 0)
+		if compressed:
+			lines.append('compression: %d bytes to %d (%.0f%%), %.3fs cpu' % (compressed, self.compress_bytes_out.values.get(None, 0), 100.0 * self.compress_bytes_out.values.get(None, 0) / compressed, self.compress_seconds.values.get(None, 0)))
+		lag = self.reactor_lag_seconds
+		lines.append('reactor lag: p50 <= %.4fs, p99 <= %.4fs' % (lag.quantile(0.5), lag.quantile(0.99)))
+		db = self.db_query_seconds
+		lines.append('db queries: %d, avg %.2fms, p99 <= %.4fs' % (db.count(), 1000 * db.sum() / max(db.count(), 1), db.quantile(0.99)))
+		commands = self.command_seconds
+		busiest = sorted(commands.series, key=lambda c: commands.sum(c), reverse=True)[:top]
+		for command in busiest:
+			lines.append('%s: %d calls, %.3fs total, avg %.2fms, p99 <= %.4fs' % (command, commands.count(command), commands.sum(command), 1000 * commands.sum(command) / commands.count(command), commands.quantile(0.99, command)))
+		return lines
+
+class MetricsResource(resource.Resource):
+	isLeaf = True
+
+	def __init__(self, metrics):
+		resource.Resource.__init__(self)
+		self.metrics = metrics
+
+	def render_GET(self, request):
+		request.setHeader(b'content-type', b'text/plain; version=0.0.4')
+		return self.metrics.render().encode()
+
+def listen(metrics, port, interface='127.0.0.1'):
+	site_root = resource.Resource()
+	site_root.putChild(b'metrics', MetricsResource(metrics))
+	reactor.listenTCP(port, server.Site(site_root), interface=interface)
+	logging.info("Serving metrics on http://%s:%d/metrics" % (interface, port))
+
+if __name__ == '__main__':
+	metrics = Metrics()
+	h = metrics.histogram('test_seconds', 'test', 'command')
+	for amount in (0.0002, 0.0002, 0.003, 7):
+		h.observe(amount, 'SAY')
+	assert(h.count('SAY') == 4)
+	assert(h.quantile(0.5, 'SAY') == 0.00025)
+	assert(h.quantile(1, 'SAY') == float('inf'))
+	c = metrics.counter('test_total', 'test')
+	c.inc(5)
+	text = metrics.render()
+	assert('test_seconds_bucket{command="SAY",le="0.00025"} 2' in text)
+	assert('test_seconds_bucket{command="SAY",le="+Inf"} 4' in text)
+	assert('test_total 5' in text)
+	metrics.counter_func('test_dropped_total', 'test', lambda: 3)
+	metrics.gauge('test_queue_length', 'test', lambda: 2)
+	text = metrics.render()
+	assert('# TYPE test_dropped_total counter\ntest_dropped_total 3' in text)
+	assert('# TYPE test_queue_length gauge\ntest_queue_length 2' in text)
+	print("Tests went ok")
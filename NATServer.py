@@ -1,47 +1,45 @@
-from socketserver import UDPServer,DatagramRequestHandler
-import sys, logging
-
-class CustomUDPServer(UDPServer):
-	def Bind(self, root):
+from twisted.internet.protocol import DatagramProtocol
+from twisted.internet import reactor, task
+import logging
+
+class NATServer(DatagramProtocol):
+	'''
+	UDP hole punching: a logged in client sends its username from the port it is going to use,
+	the client (and its battle host) are told which source port arrived here
+	runs on the reactor, each source ip may send up to max_packets per second, more are dropped
+	'''
+	def __init__(self, root, max_packets=10):
 		self._root = root
-
-	def finish_request(self, request, client_address):
-		if '_root' in dir(self):
-			self.RequestHandlerClass(request, client_address, self, self._root)
-		else:
-			pass # not bound to _root yet, no point in handling UDP
-
-class handler(DatagramRequestHandler):
-	def __init__(self, request, client_address, server, root):
-		self._root = root
-		self.request = request
-		self.client_address = client_address
-		self.server = server
-		try:
-			self.setup()
-			self.handle()
-			self.finish()
-		finally:
-			sys.exc_traceback = None    # Help garbage collection
-
-	def handle(self):
-		addr = self.client_address
-		msg = self.rfile.readline().rstrip()
-		#print "%s from %s(%d)" % (msg, addr[0], addr[1])
-		self.wfile.write(b'PONG')
-		if msg in self._root.usernames:
-			self._root.usernames[msg]._protocol._udp_packet(msg, addr[0], addr[1])
-
-class NATServer:
-	def __init__(self, port):
-		self.s = CustomUDPServer(('',port), handler)
-		logging.info("Awaiting UDP messages on port %d" % port)
-
-	def bind(self, root):
-		self.s.Bind(root)
-
-	def start(self):
-		self.s.serve_forever()
-
-	def close(self):
-		self.s.close()
+		self.max_packets = max_packets
+		self.packets = {} # ip -> packets in the current second
+		self.received = 0
+		self.dropped = 0
+
+	def startProtocol(self):
+		self.reset_loop = task.LoopingCall(self.packets.clear)
+		self.reset_loop.start(1)
+
+	def stopProtocol(self):
+		self.reset_loop.stop()
+
+	def datagramReceived(self, data, addr):
+		self.received += 1
+		ip = addr[0]
+		count = self.packets.get(ip, 0)
+		if count >= self.max_packets:
+			self.dropped += 1
+			return
+		self.packets[ip] = count + 1
+
+		username = data.split(b'\n', 1)[0].strip().decode('utf-8', 'replace')
+		client = self._root.usernames.get(username)
+		if not client or client.remote:
+			return # no reply to unknown senders, so this can't be used for reflection
+		self.transport.write(b'PONG', addr)
+		self._root.protocol._udp_packet(username, ip, addr[1])
+
+def listen(root, port):
+	natserver = NATServer(root)
+	reactor.listenUDP(port, natserver)
+	logging.info("Awaiting UDP messages on port %d" % port)
+	return natserver
@@ -0,0 +1,136 @@
+# coding=utf-8
+# This file is part of the uberserver (GPL v2 or later), see LICENSE
+# times every sql statement, grouped by normalized sql and by what ran it
+
+import os
+import re
+import sys
+import time
+import logging
+import threading
+from logging.handlers import TimedRotatingFileHandler
+
+_literals = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_lists = re.compile(r"\((?:\s*(?:\?|%s|%\(\w+\)s|:\w+)\s*,)+\s*(?:\?|%s|%\(\w+\)s|:\w+)\s*\)")
+_spaces = re.compile(r'\s+')
+
+def normalize(statement):
+	# bind parameters are already placeholders, this folds literals, IN lists and whitespace
+	statement = _spaces.sub(' ', statement).strip()
+	statement = _literals.sub('?', statement)
+	return _lists.sub('(?, ...)', statement)
+
+class QueryProfiler:
+	'''
+	statement timings from sqlalchemy's cursor events, on any thread
+	the caller is the label of the last tag() on the thread: the command, db callback or loop on the
+	reactor (see Watchdog.begin), the SQLUsers method on db threads (see AsyncDB), so a commit after a
+	command counts for that command. it stays set until the next tag(), walking the stack per statement was too slow
+	statements slower than threshold seconds are written to the slow query log, with the innermost SQLUsers method
+	'''
+	def __init__(self, histogram=None, threshold=0.1, slowlogfile=None, max_statements=5000):
+		self.histogram = histogram
+		self.threshold = threshold
+		self.max_statements = max_statements
+		self.lock = threading.Lock()
+		self.local = threading.local() # .label, see tag()
+		self.normalized = {} # raw statement -> normalized, raw statements repeat so this is mostly hits
+		self.by_statement = {} # normalized -> [count, total seconds, max seconds]
+		self.by_caller = {} # Class.method -> [count, total seconds, max seconds]
+		self.slow = 0
+		self.watched_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'SQLUsers.py')
+		self.slowlog = logging.getLogger('slowqueries')
+		if slowlogfile:
+			fh = TimedRotatingFileHandler(slowlogfile, when="midnight", backupCount=6)
+			fh.setFormatter(logging.Formatter(fmt='%(asctime)s %(message)s', datefmt='%Y-%m-%d %H:%M:%S'))
+			self.slowlog.addHandler(fh)
+			self.slowlog.propagate = False
+
+	def instrument(self, engine):
+		from sqlalchemy import event
+		event.listen(engine, 'before_cursor_execute', self.before_cursor_execute)
+		event.listen(engine, 'after_cursor_execute', self.after_cursor_execute)
+
+	def tag(self, label):
+		self.local.label = label
+
+	def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+		conn.info.setdefault('query_start', []).append(time.time())
+
+	def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+		self.record(statement, time.time() - conn.info['query_start'].pop())
+
+	def record(self, statement, seconds):
+		if self.histogram:
+			self.histogram.observe(seconds)
+		normalized = self.normalized.get(statement)
+		if normalized is None:
+			normalized = normalize(statement)
+			if len(self.normalized) < self.max_statements:
+				self.normalized[statement] = normalized
+		caller = getattr(self.local, 'label', 'unknown')
+		with self.lock:
+			for stats, key in ((self.by_statement, normalized), (self.by_caller, caller)):
+				s = stats.get(key)
+				if s is None:
+					if len(stats) >= self.max_statements:
+						continue
+					s = stats[key] = [0, 0.0, 0.0]
+				s[0] += 1
+				s[1] += seconds
+				if seconds > s[2]:
+					s[2] = seconds
+		if seconds >= self.threshold:
+			self.slow += 1
+			self.slowlog.warning('%.3fs %s in %s [%s] %s' % (seconds, caller, self.method(), threading.current_thread().name, normalized))
+
+	def method(self):
+		# the innermost SQLUsers method on the stack, e.g. UsersHandler.check_banned, session_manager only runs the commits
+		frame = sys._getframe(1)
+		while frame:
+			code = frame.f_code
+			if code.co_filename == self.watched_file:
+				name = getattr(code, 'co_qualname', code.co_name) # qualname is python 3.11+
+				if not name.startswith('session_manager.'):
+					return name
+			frame = frame.f_back
+		return 'unknown'
+
+	def top(self, n=10):
+		# the statements and callers that took the most db time
+		with self.lock:
+			statements = sorted(self.by_statement.items(), key=lambda s: s[1][1], reverse=True)[:n]
+			callers = sorted(self.by_caller.items(), key=lambda s: s[1][1], reverse=True)[:n]
+		return statements, callers
+
+	def summary(self, n=10, width=200):
+		# short text for STATS
+		statements, callers = self.top(n)
+		lines = ['%d slow queries over %.0fms' % (self.slow, 1000 * self.threshold)]
+		for caller, (count, total, longest) in callers:
+			lines.append('%s: %d queries, %.3fs total, avg %.2fms, worst %.3fs' % (caller, count, total, 1000 * total / count, longest))
+		for statement, (count, total, longest) in statements:
+			lines.append('%d queries, %.3fs total, worst %.3fs: %s' % (count, total, longest, statement[:width]))
+		return lines
+
+if __name__ == '__main__':
+	assert(normalize("SELECT users.id \n FROM users WHERE users.id IN (?, ?, ?) AND name = 'x''y' LIMIT 10") ==
+		"SELECT users.id FROM users WHERE users.id IN (?, ...) AND name = ? LIMIT ?")
+	assert(normalize("SELECT a FROM b WHERE c IN (%s,%s)") == "SELECT a FROM b WHERE c IN (?, ...)")
+	profiler = QueryProfiler(threshold=0.5)
+	profiler.record("SELECT 1", 0.01)
+	profiler.record("SELECT 2", 0.03)
+	profiler.record("SELECT * FROM users", 0.6)
+	statements, callers = profiler.top()
+	assert(statements[0][0] == "SELECT * FROM users")
+	assert(statements[1] == ("SELECT ?", [2, 0.04, 0.03]))
+	assert(callers == [('unknown', [3, 0.64, 0.6])])
+	assert(profiler.slow == 1)
+	profiler.tag('LOGIN')
+	profiler.record("SELECT 3", 0.02)
+	thread = threading.Thread(target=profiler.record, args=("SELECT 4", 0.01)) # untagged thread
+	thread.start()
+	thread.join()
+	statements, callers = profiler.top()
+	assert(dict(callers)['LOGIN'] == [1, 0.02, 0.02] and dict(callers)['unknown'][0] == 4)
+	print("Tests went ok")
@@ -12,11 +12,12 @@ import smtplib
 from email.mime.text import MIMEText
 
 import _thread as thread
+import threading
 
 	
 try:
-	from sqlalchemy import create_engine, Table, Column, Integer, String, MetaData, ForeignKey, Boolean, Text, DateTime, ForeignKeyConstraint, UniqueConstraint
-	from sqlalchemy.orm import mapper, sessionmaker, relation
+	from sqlalchemy import create_engine, Table, Column, Integer, String, MetaData, ForeignKey, Boolean, Text, DateTime, ForeignKeyConstraint, UniqueConstraint, Index, inspect
+	from sqlalchemy.orm import mapper, sessionmaker, relation, aliased
 	from sqlalchemy.exc import IntegrityError
 except ImportError as e:
 	print("ERROR: sqlalchemy isn't installed: " + str(e))
@@ -104,6 +105,7 @@ logins_table = Table('logins', metadata,
 	Column('end', DateTime),
 	mysql_charset='utf8',
 	)
+logins_user_id_index = Index('ix_logins_user_id', logins_table.c.user_id)
 
 class Login(object):
 	def __init__(self, now, user_id, ip_address, agent, last_sys_id, last_mac_id, local_ip, country):
@@ -428,14 +430,45 @@ class MinSpringVersion(object):
 		return "<Version: %d (since %s)>" % (self.min_spring_version, self.start_time)
 mapper(MinSpringVersion, min_spring_version_table)
 ##########################################
+state_changes_table = Table('state_changes', metadata,
+	Column('id', Integer, primary_key=True),
+	Column('changes', Integer),
+	)
+class StateChanges(object):
+	def __init__(self, changes):
+		self.changes = changes
+
+	def __repr__(self):
+		return "<StateChanges: %d>" % (self.changes)
+mapper(StateChanges, state_changes_table)
+##########################################
 
 class session_manager():
-	# on-demand sessionmaker
+	# on-demand sessionmaker, each thread (reactor or db pool) gets its own session
 	def __init__(self, root, engine):
 		self._root = root
 		metadata.create_all(engine)
+		self.create_indexes(engine)
 		self.sessionmaker = sessionmaker(bind=engine, autoflush=True)
-		self.session = None
+		self.local = threading.local()
+
+	def create_indexes(self, engine):
+		# create_all only creates missing tables, indexes added later to existing tables are created here
+		# (mysql has one already when the column is a foreign key)
+		for index in (logins_user_id_index,):
+			column_names = [c.name for c in index.columns]
+			existing = inspect(engine).get_indexes(index.table.name)
+			if not any(i['column_names'][:len(column_names)] == column_names for i in existing):
+				logging.info("creating index %s" % index.name)
+				index.create(engine)
+
+	@property
+	def session(self):
+		return getattr(self.local, 'session', None)
+
+	@session.setter
+	def session(self, session):
+		self.local.session = session
 	
 	def sess(self):
 		if not self.session:
@@ -454,6 +487,64 @@ class session_manager():
 			self.session.close()
 			self.session = None
 
+	def guarded(self, func, *args, **kwargs):
+		# run func in a transaction of the current thread's session, used by the db thread pool
+		try:
+			ret = func(*args, **kwargs)
+			self.commit_guard()
+			return ret
+		except:
+			self.rollback_guard()
+			raise
+		finally:
+			self.close_guard()
+
+class Purge():
+	'''
+	deletes the rows of model that match criteria, in batches of ascending primary key ranges,
+	so that no single DELETE keeps a big table locked for long
+	run_batch() deletes the next batch and returns False once there is nothing left
+	'''
+	def __init__(self, root, name, model, criteria, changes_state=False, batch_size=1000):
+		self._root = root
+		self.name = name
+		self.model = model
+		self.criteria = criteria
+		self.changes_state = changes_state # see ChannelsHandler.changed
+		self.batch_size = batch_size
+		self.last_id = 0
+		self.deleted = 0
+		self.batches = 0
+		self.duration = 0.0
+		self.max_duration = 0.0
+
+	def run_batch(self):
+		start = time.time()
+		sess = self._root.session_manager.sess()
+		ids = sess.query(self.model.id).filter(self.model.id > self.last_id).filter(*self.criteria).order_by(self.model.id).limit(self.batch_size).all()
+		if not ids:
+			return False
+		first_id, last_id = ids[0][0], ids[-1][0]
+		deleted = sess.query(self.model).filter(self.model.id >= first_id).filter(self.model.id <= last_id).filter(*self.criteria).delete(synchronize_session=False)
+		if deleted and self.changes_state:
+			self._root.channeldb.changed()
+		sess.commit()
+		duration = time.time() - start
+		self.last_id = last_id
+		self.deleted += deleted
+		self.batches += 1
+		self.duration += duration
+		self.max_duration = max(self.max_duration, duration)
+		return len(ids) == self.batch_size
+
+	def run(self):
+		while self.run_batch():
+			pass
+		logging.info(self.report())
+
+	def report(self):
+		return "deleted %i %s in %i batches, %.2fs (slowest batch %.2fs), up to id %i" % (self.deleted, self.name, self.batches, self.duration, self.max_duration, self.last_id)
+
 ##########################################
 			
 			
@@ -531,9 +622,11 @@ class UsersHandler:
 		return True, ""
 		
 	def login_user(self, username, password, ip, agent, last_sys_id, last_mac_id, local_ip, country):
+		# returns the db user and the id of the new login row, which end_session needs later
 		now = datetime.now()
 		dbuser = self.sess().query(User).filter(User.username == username).first()
-		dbuser.logins.append(Login(now, dbuser.id, ip, agent, last_sys_id, last_mac_id, local_ip, country))
+		login = Login(now, dbuser.id, ip, agent, last_sys_id, last_mac_id, local_ip, country)
+		self.sess().add(login) # don't append to dbuser.logins, that loads the whole login history
 		dbuser.last_ip = ip
 		dbuser.last_agent = agent
 		dbuser.last_sys_id = last_sys_id
@@ -541,7 +634,20 @@ class UsersHandler:
 		dbuser.last_login = now 
 		
 		self.sess().commit()
-		return dbuser
+		return dbuser, login.id
+
+	def check_and_login_user(self, username, password, ip, agent, last_sys_id, last_mac_id, local_ip, country):
+		# check_login_user + check_banned + login_user in one db round trip, for LOGIN on the db thread pool
+		# returns good, reason, OfflineClient, login_id, friend user_ids
+		good, reason = self.check_login_user(username, password)
+		if not good:
+			return False, reason, None, None, None
+		banned, reason = self.check_banned(username, ip)
+		if banned:
+			assert (type(reason) == str)
+			return False, reason, None, None, None
+		dbuser, login_id = self.login_user(username, password, ip, agent, last_sys_id, last_mac_id, local_ip, country)
+		return True, "", OfflineClient(dbuser), login_id, self.get_friend_user_ids(dbuser.id)
 
 	def set_user_password(self, username, password):
 		ph = PasswordHasher()
@@ -549,12 +655,21 @@ class UsersHandler:
 		dbuser.password = ph.hash(password)
 		self.sess().commit()
 
-	def end_session(self, user_id):
-		entry = self.sess().query(User).filter(User.id==user_id).first()
-		if entry and not entry.logins[-1].end:
-			entry.logins[-1].end = datetime.now()
-			entry.last_login = datetime.now() # in real its last online / last seen
-			self.sess().commit()
+	def end_session(self, user_id, login_id):
+		self.end_sessions([(user_id, login_id)])
+
+	def end_sessions(self, sessions, chunk_size=500):
+		# sessions is a list of (user_id, login_id), one UPDATE per table and chunk
+		now = datetime.now()
+		for i in range(0, len(sessions), chunk_size):
+			chunk = sessions[i:i+chunk_size]
+			login_ids = [login_id for user_id, login_id in chunk if login_id]
+			user_ids = [user_id for user_id, login_id in chunk if user_id]
+			if login_ids:
+				self.sess().query(Login).filter(Login.id.in_(login_ids)).filter(Login.end == None).update({Login.end: now}, synchronize_session=False)
+			if user_ids:
+				self.sess().query(User).filter(User.id.in_(user_ids)).update({User.last_login: now}, synchronize_session=False) # in real its last online / last seen
+		self.sess().commit()
 
 	def check_user_name(self, user_name):
 		if len(user_name) > 20: return False, 'Username too long'
@@ -590,9 +705,23 @@ class UsersHandler:
 		entry.access = access
 
 		self.sess().add(entry)
-		self.sess().commit()
+		try:
+			self.sess().commit()
+		except IntegrityError:
+			self.sess().rollback() # taken by a concurrent REGISTER since check_register_user
+			return False, 'Username or email address is already in use.'
 		return True, 'Account registered successfully.'
 
+	def register_and_verify(self, username, password, ip, email, verif_reason):
+		# register_user + sending the verification code in one db round trip, for REGISTER on the db thread pool
+		# returns good, reason, OfflineClient
+		good, reason = self.register_user(username, password, ip, email)
+		if not good:
+			return False, reason, None
+		dbuser = self.clientFromUsername(username)
+		good, reason = self._root.verificationdb.check_and_send(dbuser.user_id, email, 4, verif_reason)
+		return good, reason, dbuser
+
 	def rename_user(self, username, newname):
 		if newname == username:
 			return False, 'You already have that username.'
@@ -686,33 +815,27 @@ class UsersHandler:
 		if not entry:
 			return False, 'User not found.'
 		self.sess().delete(entry)
+		self._root.channeldb.changed()
 		self.sess().commit()
 		return True, 'Success.'
 
-	def clean(self):
+	def purges(self):
 		now = datetime.now()
-		#delete users:
-		# which didn't accept agreement after three days
-		response = self.sess().query(User).filter(User.register_date < now - timedelta(days=3)).filter(User.access == "agreement")
-		logging.info("deleting %i users who failed to verify registration", response.count())
-		response.delete(synchronize_session=False)
-
-		# which have no ingame time, last login > 1 month ago, not bot, not mod
-		response = self.sess().query(User).filter(User.ingame_time == 0).filter(User.last_login < now - timedelta(days=28)).filter(User.bot == 0).filter(User.access == "user")
-		logging.info("deleting %i inactive users with no ingame time", response.count())
-		response.delete(synchronize_session=False)
-
-		# last login > 5 years
-		response = self.sess().query(User).filter(User.last_login < now - timedelta(days=1825))
-		logging.info("deleting %i very inactive users", response.count())
-		response.delete(synchronize_session=False)
-
-		# old messages > 2 weeks
-		response = self.sess().query(ChannelHistory).filter(ChannelHistory.time < now - timedelta(days=14))
-		logging.info("deleting %i channel history messages", response.count())
-		response.delete(synchronize_session=False)
-		
-		self.sess().commit()
+		# deleted users take their channel ops, bans and mutes with them, so these change state
+		return [
+			# which didn't accept agreement after three days
+			Purge(self._root, "users who failed to verify registration", User, [User.register_date < now - timedelta(days=3), User.access == "agreement"], True),
+			# which have no ingame time, last login > 1 month ago, not bot, not mod
+			Purge(self._root, "inactive users with no ingame time", User, [User.ingame_time == 0, User.last_login < now - timedelta(days=28), User.bot == 0, User.access == "user"], True),
+			# last login > 5 years
+			Purge(self._root, "very inactive users", User, [User.last_login < now - timedelta(days=1825)], True),
+			# old messages > 2 weeks
+			Purge(self._root, "channel history messages", ChannelHistory, [ChannelHistory.time < now - timedelta(days=14)]),
+		]
+
+	def clean(self):
+		for purge in self.purges():
+			purge.run()
 
 	def audit_access(self):
 		now = datetime.now()
@@ -896,15 +1019,17 @@ class BridgedUsersHandler:
 		self.sess().commit()
 		return True, OfflineBridgedClient(bridgedUser)
 
-	def clean(self):
+	def purges(self):
 		# remove any bridged user that wasn't seen for 30 days and isn't banned from any channels
-		bridge_bans = self.sess().query(ChannelBridgedBan.bridged_id).distinct()
-		ignore_ids = set(b.bridged_id for b in bridge_bans)		
 		now = datetime.now()
-		response = self.sess().query(BridgedUser).filter(BridgedUser.last_bridged < now - timedelta(days=30)).filter(not BridgedUser.id in ignore_ids)
-		logging.info("deleting %i inactive bridged users", response.count())
-		response.delete(synchronize_session=False)
-		self.sess().commit()
+		banned_ids = self.sess().query(ChannelBridgedBan.bridged_id)
+		return [
+			Purge(self._root, "inactive bridged users", BridgedUser, [BridgedUser.last_bridged < now - timedelta(days=30), ~BridgedUser.id.in_(banned_ids)]),
+		]
+
+	def clean(self):
+		for purge in self.purges():
+			purge.run()
 
 class BansHandler:
 	def __init__(self, root):
@@ -1067,13 +1192,16 @@ class BansHandler:
 			})
 		return blacklist
 
-	def clean(self):
+	def purges(self):
 		# remove all expired bans
 		now = datetime.now()
-		response = self.sess().query(Ban).filter(Ban.end_date < now)
-		logging.info("deleting %i expired bans", response.count())
-		response.delete(synchronize_session=False)
-		self.sess().commit()
+		return [
+			Purge(self._root, "expired bans", Ban, [Ban.end_date < now]),
+		]
+
+	def clean(self):
+		for purge in self.purges():
+			purge.run()
 
 class VerificationsHandler:
 	def __init__(self, root):
@@ -1224,13 +1352,16 @@ class VerificationsHandler:
 		self.sess().query(Verification).filter(Verification.user_id == user_id).delete(synchronize_session=False)
 		self.sess().commit()
 
-	def clean(self):
+	def purges(self):
 		# remove all expired entries
 		now = datetime.now()
-		response = self.sess().query(Verification).filter(Verification.expiry < now)
-		logging.info("deleting %i expired verifications", response.count())
-		response.delete(synchronize_session=False)
-		self.sess().commit()
+		return [
+			Purge(self._root, "expired verifications", Verification, [Verification.expiry < now]),
+		]
+
+	def clean(self):
+		for purge in self.purges():
+			purge.run()
 
 	def reset_password(self, user_id, email_to_user):
 		# reset pw, email to user
@@ -1354,6 +1485,74 @@ class ChannelsHandler:
 			})
 		return forwards
 		
+	def changed(self):
+		# counts writes to the state DataHandler keeps in a snapshot (channels, ops, bans, ...), a snapshot is only valid at the count it was taken at
+		# recordUse doesn't count, last_used in a snapshot is at least as recent as in the db
+		self.sess().query(StateChanges).update({StateChanges.changes: StateChanges.changes + 1}, synchronize_session=False)
+
+	def change_count(self):
+		entry = self.sess().query(StateChanges).first()
+		if not entry:
+			entry = StateChanges(0)
+			self.sess().add(entry)
+			self.sess().commit()
+		return entry.changes
+
+	def load_all(self):
+		# all channels with their ops, bans, mutes and forwards, one query per table, for DataHandler.init
+		# rows of users that no longer exist are skipped, owners/issuers that no longer exist become None
+		issuer = aliased(User)
+		state = {'channels': [], 'operators': [], 'bans': [], 'bridged_bans': [], 'mutes': [], 'forwards': []}
+		response = self.sess().query(Channel, User.id).outerjoin(User, User.id == Channel.owner_user_id)
+		for chan, owner_user_id in response:
+			state['channels'].append({
+					'id': chan.id,
+					'name': chan.name,
+					'owner_user_id': owner_user_id,
+					'key': chan.key,
+					'topic': chan.topic or '',
+					'topic_user_id': chan.topic_user_id,
+					'antispam': chan.antispam,
+					'store_history': chan.store_history,
+					'last_used': chan.last_used,
+				})
+		response = self.sess().query(ChannelOp.channel_id, ChannelOp.user_id).join(User, User.id == ChannelOp.user_id)
+		for channel_id, user_id in response:
+			state['operators'].append({
+					'channel_id': channel_id,
+					'user_id': user_id,
+				})
+		response = self.sess().query(ChannelBan, User.last_ip, issuer.id).join(User, User.id == ChannelBan.user_id).outerjoin(issuer, issuer.id == ChannelBan.issuer_user_id)
+		for ban, last_ip, issuer_user_id in response:
+			state['bans'].append({
+					'channel_id': ban.channel_id,
+					'issuer_user_id': issuer_user_id,
+					'user_id': ban.user_id,
+					'ip_address': last_ip, # in memory bans are by the target's last ip, as in Channel.banUser
+					'expires': ban.expires,
+					'reason': ban.reason,
+				})
+		response = self.sess().query(ChannelBridgedBan, issuer.id).join(BridgedUser, BridgedUser.id == ChannelBridgedBan.bridged_id).outerjoin(issuer, issuer.id == ChannelBridgedBan.issuer_user_id)
+		for ban, issuer_user_id in response:
+			state['bridged_bans'].append({
+					'channel_id': ban.channel_id,
+					'bridged_id': ban.bridged_id,
+					'issuer_user_id': issuer_user_id,
+					'expires': ban.expires,
+					'reason': ban.reason,
+				})
+		response = self.sess().query(ChannelMute, issuer.id).join(User, User.id == ChannelMute.user_id).outerjoin(issuer, issuer.id == ChannelMute.issuer_user_id)
+		for mute, issuer_user_id in response:
+			state['mutes'].append({
+					'channel_id': mute.channel_id,
+					'issuer_user_id': issuer_user_id,
+					'user_id': mute.user_id,
+					'expires': mute.expires,
+					'reason': mute.reason,
+				})
+		state['forwards'] = self.all_forwards()
+		return state
+
 	def recordUse(self, channel):
 		now = datetime.now()
 		entry = self.sess().query(Channel).filter(Channel.name == channel.name).first()
@@ -1367,80 +1566,95 @@ class ChannelsHandler:
 		if entry:
 			entry.topic = topic
 			entry.topic_user_id = target.user_id
+			self.changed()
 			self.sess().commit()
 
 	def setKey(self, channel, key):
 		entry = self.sess().query(Channel).filter(Channel.name == channel.name).first()
 		if entry:
 			entry.key = key
+			self.changed()
 			self.sess().commit()
 
 	def setFounder(self, channel, target):
 		entry = self.sess().query(Channel).filter(Channel.name == channel.name).first()
 		if entry:
 			entry.owner_user_id = target.user_id
+			self.changed()
 			self.sess().commit()
 
 	def setAntispam(self, channel, antispam):
 		entry = self.sess().query(Channel).filter(Channel.name == channel.name).first()
 		if entry:
 			entry.antispam = antispam
+			self.changed()
 			self.sess().commit()
 
 	def opUser(self, channel, target):
 		entry = ChannelOp(channel.id, target.user_id)
 		self.sess().add(entry)
+		self.changed()
 		self.sess().commit()
 
 	def deopUser(self, channel, target):
 		response = self.sess().query(ChannelOp).filter(ChannelOp.user_id == target.user_id).filter(ChannelOp.channel_id == channel.id)
 		response.delete()
+		self.changed()
 		self.sess().commit()
 
 	def banBridgedUser(self, channel, issuer, target, expires, reason):
 		entry = ChannelBridgedBan(channel.id, issuer.user_id, target.bridged_id, expires, reason)
 		self.sess().add(entry)
+		self.changed()
 		self.sess().commit()
 
 	def unbanBridgedUser(self, channel, target):
 		response = self.sess().query(ChannelBridgedBan).filter(ChannelBridgedBan.bridged_id == target.bridged_id).filter(ChannelBridgedBan.channel_id == channel.id)
 		response.delete()
+		self.changed()
 		self.sess().commit()
 
 	def banUser(self, channel, issuer, target, expires, reason):
 		entry = ChannelBan(channel.id, issuer.user_id, target.user_id, target.last_ip, expires, reason)
 		self.sess().add(entry)
+		self.changed()
 		self.sess().commit()
 
 	def unbanUser(self, channel, target):
 		response = self.sess().query(ChannelBan).filter(ChannelBan.user_id == target.user_id).filter(ChannelBan.channel_id == channel.id)
 		response.delete()
+		self.changed()
 		self.sess().commit()
 
 	def muteUser(self, channel, issuer, target, expires, reason):
 		entry = ChannelMute(channel.id, issuer.user_id, target.user_id, expires, reason)
 		self.sess().add(entry)
+		self.changed()
 		self.sess().commit()
 
 	def unmuteUser(self, channel, target):
 		response = self.sess().query(ChannelMute).filter(ChannelMute.user_id == target.user_id).filter(ChannelMute.channel_id == channel.id)
 		response.delete()
+		self.changed()
 		self.sess().commit()
 
 	def setHistory(self, chan, enable):
 		entry = self.sess().query(Channel).filter(Channel.name == chan.name).first()
 		if entry:
 			entry.store_history = enable
+			self.changed()
 			self.sess().commit()
 
 	def addForward(self, channel_from, channel_to):
 		entry = ChannelForward(channel_from.id, channel_to.id)
 		self.sess().add(entry)
+		self.changed()
 		self.sess().commit()
 
 	def removeForward(self, channel_from, channel_to):
 		response = self.sess().query(ChannelForward).filter(ChannelForward.channel_from_id == channel_from.id).filter(ChannelForward.channel_to_id == channel_to.id)
 		response.delete()
+		self.changed()
 		self.sess().commit()
 
 	def register(self, channel, target):
@@ -1453,39 +1667,33 @@ class ChannelsHandler:
 		entry.owner_user_id = target.user_id
 		entry.last_used = datetime.now()
 		self.sess().add(entry)
+		self.changed()
 		self.sess().commit()
 		entry = self.sess().query(Channel).filter(Channel.name == channel.name).first()
 		channel.id = entry.id
 
 	def unRegister(self, channel):
 		entry = self.sess().query(Channel).filter(Channel.name == channel.name).delete()
+		self.changed()
 		self.sess().commit()
 
 	def registered(self, channel):
 		entry = self.sess().query(Channel).filter(Channel.name == channel.name).first()
 		return bool(entry)
 		
-	def clean(self):
-		#delete all expired channel bans/mutes:
+	def purges(self):
+		#delete all expired channel bans/mutes, and inactive channels
 		now = datetime.now()
+		return [
+			Purge(self._root, "expired channel mutes", ChannelMute, [ChannelMute.expires < now], True),
+			Purge(self._root, "expired channel bans", ChannelBan, [ChannelBan.expires < now], True),
+			Purge(self._root, "expired channel bridged bans", ChannelBridgedBan, [ChannelBridgedBan.expires < now], True),
+			Purge(self._root, "inactive channels", Channel, [Channel.last_used < now - timedelta(days=180)], True),
+		]
 
-		response = self.sess().query(ChannelMute).filter(ChannelMute.expires < now)
-		logging.info("deleting %i expired channel mutes", response.count())
-		response.delete(synchronize_session=False)
-
-		response = self.sess().query(ChannelBan).filter(ChannelBan.expires < now)
-		logging.info("deleting %i expired channel bans", response.count())
-		response.delete(synchronize_session=False)
-
-		response = self.sess().query(ChannelBridgedBan).filter(ChannelBridgedBan.expires < now)
-		logging.info("deleting %i expired channel bridged bans", response.count())
-		response.delete(synchronize_session=False)
-
-		response = self.sess().query(Channel).filter(Channel.last_used < now - timedelta(days=180))
-		logging.info("deleting %i inactive channels", response.count())
-		response.delete(synchronize_session=False)
-		
-		self.sess().commit()
+	def clean(self):
+		for purge in self.purges():
+			purge.run()
 
 
 class ContentHandler:
@@ -1501,6 +1709,7 @@ class ContentHandler:
 		now = datetime.now()
 		entry = MinSpringVersion(version, now)
 		self.sess().add(entry)
+		self._root.channeldb.changed()
 		self.sess().commit()	
 	
 	def get_min_spring_version(self):
@@ -1567,6 +1776,16 @@ if __name__ == '__main__':
 	channeldb.register(channel, client)
 	assert(channel.id > 0)
 
+	# test bulk load of channel state
+	channeldb.opUser(channel, client)
+	channeldb.muteUser(channel, client, client2, datetime.now() + timedelta(1), "test")
+	state = channeldb.load_all()
+	assert([c for c in state['channels'] if c['name'] == channelname][0]['owner_user_id'] == client.id)
+	assert({'channel_id': channel.id, 'user_id': client.id} in state['operators'])
+	assert(state['mutes'][0]['user_id'] == client2.id)
+	assert(state['mutes'][0]['issuer_user_id'] == client.id)
+	channeldb.unmuteUser(channel, client2)
+
 	# test setHistory
 	assert(channel.store_history == False)
 	channel.store_history = True
@@ -1599,6 +1818,26 @@ if __name__ == '__main__':
 	userdb.add_channel_message(channel.id, 99, None, "test", False)
 	userdb.add_channel_message(channel.id, 99, 99, "test", False)
 
+	# test login from another thread, as the db thread pool does it
+	results = []
+	t = threading.Thread(target=lambda: results.append(root.session_manager.guarded(userdb.check_and_login_user, username, u"pass", "192.168.1.1", "test agent", "0", "0", "", "??")))
+	t.start()
+	t.join()
+	good, reason, dbclient, login_id, friends = results[0]
+	assert(friends == [])
+	assert(good)
+	assert(dbclient.username == username)
+	assert(login_id > 0)
+	userdb.end_session(dbclient.id, login_id)
+
+	# test purging in batches
+	for i in range(0, 25):
+		userdb.add_channel_message(channel.id, client.id, None, "old", False, now - timedelta(days=30))
+	purge = Purge(root, "old test messages", ChannelHistory, [ChannelHistory.time < now - timedelta(days=14)], batch_size=10)
+	purge.run()
+	assert(purge.deleted == 25)
+	assert(purge.batches == 3)
+
 	userdb.clean()
 	verificationdb.clean()
 	bandb.clean()
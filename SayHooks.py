@@ -134,6 +134,7 @@ def _spam_enum(client, chan):
 
 def _spam_rec(client, chan, msg):
 	now = str(time.time())
+	if client.lastsaid is None: client.lastsaid = {}
 	if not chan in client.lastsaid: client.lastsaid[chan] = {}
 	if not now in client.lastsaid[chan]:
 		client.lastsaid[chan][now] = [msg]
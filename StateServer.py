@@ -0,0 +1,155 @@
+# coding=utf-8
+# This file is part of the uberserver (GPL v2 or later), see LICENSE
+# read-only http/json view of the server state, for web dashboards and stats bots that don't need a lobby login
+
+import time
+import json
+import hashlib
+import logging
+
+from twisted.internet import reactor
+from twisted.web import server, resource, http
+
+class StateSnapshot:
+	'''
+	battles, channels and user counts as json, rebuilt at most once per interval
+	version and etag change only when the content does
+	'''
+	def __init__(self, root, interval):
+		self._root = root
+		self.interval = interval
+		self.version = 0
+		self.etag = None
+		self.body = b''
+		self.created = 0
+
+	def get(self):
+		now = time.time()
+		if now - self.created >= self.interval:
+			self.update(now)
+		return self
+
+	def update(self, now):
+		state = self.state()
+		data = json.dumps(state, sort_keys=True, separators=(',', ':')).encode()
+		etag = ('"%s"' % hashlib.sha1(data).hexdigest()[:16]).encode()
+		if etag != self.etag:
+			self.version += 1
+			self.etag = etag
+			state['version'] = self.version
+			state['time'] = int(now)
+			self.body = json.dumps(state, separators=(',', ':')).encode()
+		self.created = now
+
+	def state(self):
+		root = self._root
+		online = ingame = bots = 0
+		for client in root.clients.values():
+			if not client.logged_in:
+				continue
+			online += 1
+			if client.bot:
+				bots += 1
+			if client.is_ingame:
+				ingame += 1
+
+		battles = []
+		for battle in root.battles.values():
+			host = root.clientFromSession(battle.host)
+			if not host:
+				continue
+			players = []
+			for session_id in battle.users:
+				client = root.clientFromSession(session_id)
+				if not client:
+					continue
+				players.append({
+					'username': client.username,
+					'country': client.country_code,
+					'spectator': client.is_spectator(),
+				})
+			battles.append({
+				'id': battle.battle_id,
+				'title': battle.title,
+				'host': host.username,
+				'map': battle.map,
+				'game': battle.modname,
+				'engine': battle.engine,
+				'version': battle.version,
+				'maxplayers': battle.maxplayers,
+				'spectators': battle.spectators,
+				'locked': bool(battle.locked),
+				'passworded': battle.passworded() == 1,
+				'rank': battle.rank,
+				'ingame': host.is_ingame,
+				'bots': len(battle.bots),
+				'players': players,
+			})
+
+		channels = []
+		for channel in root.channels.values():
+			if channel.identity != 'channel' or channel.hasKey():
+				continue
+			channels.append({
+				'name': channel.name,
+				'users': len(channel.users),
+				'topic': channel.topic or '',
+			})
+
+		return {
+			'users': {'online': online, 'ingame': ingame, 'bots': bots},
+			'battles': battles,
+			'channels': channels,
+		}
+
+class StateResource(resource.Resource):
+	isLeaf = True
+
+	def __init__(self, snapshot):
+		resource.Resource.__init__(self)
+		self.snapshot = snapshot
+
+	def render_GET(self, request):
+		snapshot = self.snapshot.get()
+		request.setHeader(b'content-type', b'application/json')
+		request.setHeader(b'access-control-allow-origin', b'*')
+		request.setHeader(b'cache-control', b'max-age=%d' % self.snapshot.interval)
+		if request.setETag(snapshot.etag) == http.CACHED:
+			return b''
+		return snapshot.body
+
+def listen(root, port, interval):
+	site_root = resource.Resource()
+	site_root.putChild(b'state', StateResource(StateSnapshot(root, interval)))
+	reactor.listenTCP(port, server.Site(site_root))
+	logging.info("Serving state over http on port %d" % port)
+	return site_root
+
+if __name__ == '__main__':
+	class DummyRoot:
+		clients = {}
+		battles = {}
+		channels = {}
+		def clientFromSession(self, session_id):
+			return self.clients.get(session_id)
+	class DummyClient:
+		logged_in = True
+		bot = False
+		is_ingame = False
+	root = DummyRoot()
+	snapshot = StateSnapshot(root, 0)
+	snapshot.get()
+	assert(snapshot.version == 1)
+	assert(json.loads(snapshot.body.decode())['users']['online'] == 0)
+	etag = snapshot.etag
+	snapshot.get()
+	assert(snapshot.version == 1 and snapshot.etag == etag) # unchanged content keeps its etag
+	root.clients[1] = DummyClient()
+	snapshot.get()
+	assert(snapshot.version == 2 and snapshot.etag != etag)
+	assert(json.loads(snapshot.body.decode())['users']['online'] == 1)
+	snapshot.interval = 3600
+	root.clients[2] = DummyClient()
+	snapshot.get()
+	assert(snapshot.version == 2) # not rebuilt within the interval
+	print("Tests went ok")
@@ -0,0 +1,21 @@
+# coding=utf-8
+# This file is part of the uberserver (GPL v2 or later), see LICENSE
+# tls options for STLS, with session resumption so reconnecting clients skip the full handshake
+#
+# clients resume either by session id (server side cache, per process) or by session ticket
+# (the state is kept by the client, encrypted with a key of this process)
+
+from pem.twisted import certificateOptionsFromFiles
+from OpenSSL import SSL
+
+SESSION_ID = b'uberserver' # the cache is keyed by this context id
+SESSION_TIMEOUT = 60 * 60 # seconds a session can be resumed
+
+def load(certfile, keyfile, session_timeout=SESSION_TIMEOUT):
+	options = certificateOptionsFromFiles(certfile, keyfile, enableSessionTickets=True)
+	# CertificateOptions builds its context once and reuses it for every connection, so the cache set up here is shared
+	context = options.getContext()
+	context.set_session_id(SESSION_ID)
+	context.set_session_cache_mode(SSL.SESS_CACHE_SERVER)
+	context.set_timeout(session_timeout)
+	return options
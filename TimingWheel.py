@@ -0,0 +1,82 @@
+# coding=utf-8
+# This file is part of the uberserver (GPL v2 or later), see LICENSE
+# login and idle timeouts of all connections on one hashed timing wheel, swept once a second
+#
+# TimeoutMixin keeps a DelayedCall per connection and cancels and reschedules it for every line received,
+# with many chatty clients that is constant churn in the reactor's timer heap. here receiving data only
+# updates client.lastdata: a connection is looked at when its bucket comes round, and put into a later
+# bucket if it was active meanwhile, so an active client moves at most once per timeout period
+
+import math
+import time
+
+class TimingWheel:
+	'''
+	buckets of connections by the second their timeout may be due, slots seconds round
+	deadline(client) returns the time its timeout is due now, expire(client) is called once that passed
+	'''
+	def __init__(self, deadline, expire, slots=64):
+		self.deadline = deadline
+		self.expire = expire
+		self.buckets = [set() for i in range(slots)]
+		self.slot = {} # client -> index of its bucket
+		self.tick = int(time.time()) # the last second swept
+
+	def __len__(self):
+		return len(self.slot)
+
+	def add(self, client):
+		self.discard(client)
+		due = max(int(math.ceil(self.deadline(client))), self.tick + 1) # up: the sweep of a second only expires deadlines up to it
+		index = due % len(self.buckets)
+		self.buckets[index].add(client)
+		self.slot[client] = index
+
+	def discard(self, client):
+		index = self.slot.pop(client, None)
+		if index is not None:
+			self.buckets[index].discard(client)
+
+	def sweep(self, now=None):
+		# the buckets of every second since the last sweep, at most one round of them after a stall
+		now = int(time.time() if now is None else now)
+		expired = 0
+		for second in range(max(self.tick + 1, now - len(self.buckets) + 1), now + 1):
+			index = second % len(self.buckets)
+			bucket, self.buckets[index] = self.buckets[index], set()
+			for client in bucket:
+				del self.slot[client]
+				if self.deadline(client) <= now:
+					expired += 1
+					self.expire(client)
+				else:
+					self.add(client)
+		self.tick = max(self.tick, now)
+		return expired
+
+if __name__ == '__main__':
+	class Conn:
+		def __init__(self, lastdata):
+			self.lastdata = lastdata
+	expired = []
+	wheel = TimingWheel(lambda conn: conn.lastdata + 60, expired.append, slots=16)
+	start = wheel.tick
+	idle, active, late = Conn(start), Conn(start), Conn(start + 100)
+	for conn in (idle, active, late):
+		wheel.add(conn)
+	for second in range(start + 1, start + 60):
+		active.lastdata = second # data received, nothing is rescheduled
+		assert(wheel.sweep(second) == 0)
+	assert(wheel.sweep(start + 60) == 1 and expired == [idle])
+	assert(len(wheel) == 2)
+	wheel.add(idle) # and gone again, as in Chat.connectionLost
+	wheel.discard(idle)
+	assert(wheel.sweep(start + 160) == 2 and set(expired[1:]) == set([active, late])) # a stall longer than one round
+	assert(len(wheel) == 0)
+
+	# deadlines between two seconds expire in the sweep of the next one, not a round later
+	halfway = Conn(start + 200.5)
+	wheel.add(halfway)
+	assert(wheel.sweep(start + 260) == 0)
+	assert(wheel.sweep(start + 261) == 1 and expired[-1] is halfway)
+	print("Tests went ok")
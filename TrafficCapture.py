@@ -0,0 +1,91 @@
+# coding=utf-8
+# This file is part of the uberserver (GPL v2 or later), see LICENSE
+# append-only capture of inbound client lines, to be replayed by tests/replay.py
+#
+# one event per line: <ms since capture start> <session id> <kind> [line]
+# kind is + (connected), - (disconnected) or > (inbound line, passwords redacted)
+
+import time
+import logging
+
+# command -> positions of password arguments, counted after the command
+PASSWORD_ARGS = {
+	'LOGIN': (1,),
+	'REGISTER': (1,),
+	'CHANGEPASSWORD': (0, 1),
+	'CREATEBOTACCOUNT': (1,),
+}
+REDACTED = '*'
+
+def redact(line):
+	# replaces passwords in one protocol line (with or without a #msg_id prefix) by *
+	words = line.split(' ')
+	i = 1 if words[0].startswith('#') else 0
+	if len(words) <= i:
+		return line
+	positions = PASSWORD_ARGS.get(words[i].upper())
+	if not positions:
+		return line
+	for pos in positions:
+		if len(words) > i + 1 + pos:
+			words[i + 1 + pos] = REDACTED
+	return ' '.join(words)
+
+class TrafficCapture:
+	def __init__(self, filename):
+		self.filename = filename
+		self.file = open(filename, 'a', encoding='utf-8', buffering=1 << 16)
+		self.start = time.time()
+		self.events = 0
+		self.file.write('%d 0 # capture started %s\n' % (0, time.strftime('%Y-%m-%d %H:%M:%S')))
+
+	def write(self, session_id, kind, line=None):
+		ms = int((time.time() - self.start) * 1000)
+		if line is None:
+			self.file.write('%d %d %s\n' % (ms, session_id, kind))
+		else:
+			self.file.write('%d %d %s %s\n' % (ms, session_id, kind, redact(line)))
+		self.events += 1
+
+	def connected(self, session_id):
+		self.write(session_id, '+')
+
+	def disconnected(self, session_id):
+		self.write(session_id, '-')
+
+	def line(self, session_id, line):
+		self.write(session_id, '>', line)
+
+	def flush(self):
+		self.file.flush()
+
+	def close(self):
+		self.file.close()
+		logging.info("Captured %d events to %s" % (self.events, self.filename))
+
+def read(filename):
+	# yields (seconds, session_id, kind, line) of a capture, line is None for + and -
+	with open(filename, encoding='utf-8') as f:
+		for row in f:
+			parts = row.rstrip('\n').split(' ', 3)
+			if len(parts) < 3 or parts[2] == '#':
+				continue
+			yield int(parts[0]) / 1000.0, int(parts[1]), parts[2], parts[3] if len(parts) > 3 else None
+
+if __name__ == '__main__':
+	import os, tempfile
+	assert(redact('LOGIN user secret 0 * lobby') == 'LOGIN user * 0 * lobby')
+	assert(redact('#12 LOGIN user secret') == '#12 LOGIN user *')
+	assert(redact('CHANGEPASSWORD old new') == 'CHANGEPASSWORD * *')
+	assert(redact('REGISTER user') == 'REGISTER user')
+	assert(redact('SAY main LOGIN user secret') == 'SAY main LOGIN user secret')
+	filename = os.path.join(tempfile.mkdtemp(), 'capture.txt')
+	capture = TrafficCapture(filename)
+	capture.connected(1)
+	capture.line(1, 'REGISTER user secret user@example.com')
+	capture.line(1, 'SAY main hello  world')
+	capture.disconnected(1)
+	capture.close()
+	events = list(read(filename))
+	assert([e[1:] for e in events] == [(1, '+', None), (1, '>', 'REGISTER user * user@example.com'), (1, '>', 'SAY main hello  world'), (1, '-', None)])
+	print("Tests went ok")
@@ -0,0 +1,183 @@
+# coding=utf-8
+# This file is part of the uberserver (GPL v2 or later), see LICENSE
+# reactor stall watchdog: finds out which command or loop blocked the event loop, and where
+
+import os
+import sys
+import time
+import logging
+import threading
+import traceback
+import collections
+
+from twisted.internet import task
+
+class Stall:
+	def __init__(self, seconds, label, username, stack):
+		self.seconds = seconds
+		self.label = label # command or loop that was running, 'unknown' if nothing tracked was
+		self.username = username
+		self.stack = stack # compact stack of the reactor thread, sampled while it was stuck
+		self.time = time.time()
+
+	def __str__(self):
+		who = ' <%s>' % self.username if self.username else ''
+		where = ' at %s' % self.stack if self.stack else ''
+		return '%.3fs in %s%s%s' % (self.seconds, self.label, who, where)
+
+class Watchdog:
+	'''
+	a timer on the reactor ticks every interval seconds, a thread watches the ticks
+	while the reactor hasn't ticked for threshold seconds the thread samples its stack once
+	commands (Protocol._handle), loops and db callbacks mark what is running with begin()/end(),
+	so a stall is recorded against them when they end, or against the sampled stack when the next tick comes late
+	'''
+	def __init__(self, metrics=None, threshold=0.2, interval=0.05, history=1000):
+		self.metrics = metrics
+		self.threshold = threshold
+		self.interval = interval
+		self.stalls = collections.deque(maxlen=history) # recent stalls, the top-N is taken from these
+		self.current = None # (label, username, start) of what runs on the reactor now
+		self.sample = None # (current, stack) sampled during the ongoing stall
+		self.recorded = False # the ongoing stall was already recorded by end()
+		self.last_tick = time.time()
+		self.running = False
+		self.on_begin = None # called with the label of every begin(), e.g. QueryProfiler.tag
+
+	def start(self):
+		# to be called on the reactor thread
+		self.reactor_thread = threading.get_ident()
+		self.last_tick = time.time()
+		self.tick_loop = task.LoopingCall(self.tick)
+		self.tick_loop.start(self.interval, False)
+		self.running = True
+		thread = threading.Thread(target=self.watch, name='watchdog')
+		thread.daemon = True
+		thread.start()
+
+	def stop(self):
+		self.running = False
+		if self.tick_loop.running:
+			self.tick_loop.stop()
+
+	def begin(self, label, username=None):
+		if self.on_begin:
+			self.on_begin(label)
+		prev = self.current
+		self.current = (label, username, time.time())
+		return prev
+
+	def end(self, prev):
+		current = self.current
+		self.current = prev
+		seconds = time.time() - current[2]
+		if seconds < self.threshold:
+			return
+		sample = self.sample
+		stack = sample[1] if sample and sample[0] is current else None
+		self.record(Stall(seconds, current[0], current[1], stack))
+		self.recorded = True
+
+	def wrap(self, label, func):
+		# for LoopingCalls and other timed calls
+		def wrapped(*args, **kwargs):
+			prev = self.begin(label)
+			try:
+				return func(*args, **kwargs)
+			finally:
+				self.end(prev)
+		return wrapped
+
+	def tick(self):
+		now = time.time()
+		lag = max(0.0, now - self.last_tick - self.interval)
+		self.last_tick = now
+		if self.metrics:
+			self.metrics.reactor_lag_seconds.observe(lag)
+		if lag >= self.threshold and not self.recorded:
+			# nothing tracked ended slow, e.g. twisted internals or an untracked callback
+			sample = self.sample
+			if sample and sample[0]:
+				label, username = sample[0][0], sample[0][1]
+			else:
+				label, username = 'unknown', None
+			self.record(Stall(lag, label, username, sample[1] if sample else None))
+		self.sample = None
+		self.recorded = False
+
+	def watch(self):
+		while self.running:
+			time.sleep(self.interval)
+			if self.sample is None and time.time() - self.last_tick > self.threshold + self.interval:
+				current = self.current
+				frame = sys._current_frames().get(self.reactor_thread)
+				self.sample = (current, compact_stack(frame))
+
+	def record(self, stall):
+		self.stalls.append(stall)
+		logging.warning('Reactor stalled %s' % stall)
+
+	def top(self, n=10):
+		# worst recent stalls, and per label: count, total and worst seconds
+		worst = sorted(self.stalls, key=lambda s: s.seconds, reverse=True)[:n]
+		offenders = {}
+		for stall in self.stalls:
+			o = offenders.setdefault(stall.label, [0, 0.0, 0.0])
+			o[0] += 1
+			o[1] += stall.seconds
+			o[2] = max(o[2], stall.seconds)
+		offenders = sorted(offenders.items(), key=lambda o: o[1][1], reverse=True)[:n]
+		return worst, offenders
+
+	def summary(self, n=10):
+		# short text for STATS
+		worst, offenders = self.top(n)
+		lines = ['%d stalls over %.0fms in the last %d recorded' % (len(self.stalls), 1000 * self.threshold, self.stalls.maxlen)]
+		for label, (count, total, longest) in offenders:
+			lines.append('%s: %d stalls, %.3fs total, worst %.3fs' % (label, count, total, longest))
+		for stall in worst:
+			lines.append('%s %s' % (time.strftime('%H:%M:%S', time.localtime(stall.time)), stall))
+		return lines
+
+def compact_stack(frame, depth=6):
+	# innermost frames first, as file:line function
+	if frame is None:
+		return None
+	frames = traceback.extract_stack(frame)[-depth:]
+	return ' < '.join('%s:%d %s' % (os.path.basename(f.filename), f.lineno, f.name) for f in reversed(frames))
+
+if __name__ == '__main__':
+	class DummyLoop:
+		running = False
+	watchdog = Watchdog(threshold=0.05, interval=0.01)
+	watchdog.tick_loop = DummyLoop()
+	watchdog.reactor_thread = threading.get_ident()
+	watchdog.running = True
+	thread = threading.Thread(target=watchdog.watch)
+	thread.daemon = True
+	thread.start()
+
+	def slow_command():
+		time.sleep(0.2)
+	watchdog.last_tick = time.time()
+	prev = watchdog.begin('LOGIN', 'tester')
+	slow_command()
+	watchdog.end(prev)
+	watchdog.tick() # late, but already recorded by end()
+	assert(len(watchdog.stalls) == 1)
+	stall = watchdog.stalls[0]
+	assert(stall.label == 'LOGIN' and stall.username == 'tester' and stall.seconds >= 0.2)
+	assert(stall.stack and 'slow_command' in stall.stack)
+
+	watchdog.last_tick = time.time()
+	time.sleep(0.2) # untracked
+	watchdog.tick()
+	assert(len(watchdog.stalls) == 2 and watchdog.stalls[1].label == 'unknown')
+
+	watchdog.wrap('clean', time.sleep)(0.01) # under the threshold
+	assert(len(watchdog.stalls) == 2)
+	worst, offenders = watchdog.top()
+	assert(worst[0].seconds >= worst[1].seconds)
+	assert(set(label for label, o in offenders) == {'LOGIN', 'unknown'})
+	watchdog.stop()
+	print("Tests went ok")
@@ -7,10 +7,13 @@
 #  - move SQLAlchemy calls to SQLUsers.py
 
 from xmlrpc.server import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+from socketserver import ThreadingMixIn
 from base64 import b64encode
 import os.path
 import logging
 import socket
+import threading
+import time
 import traceback
 import dbconfig
 from logging.handlers import TimedRotatingFileHandler
@@ -36,10 +39,17 @@ logger.addHandler(fh)
 sqlurl = dbconfig.sqlurl
 xmlhost = "localhost"
 xmlport = 8300
+pool_size = 10 # db connections, requests are handled on a thread each
+cache_ttl = 60 # seconds, for the username <-> account id lookups
+batch_limit = 1000 # max. names/ids per batch call
 
 class DummyRoot:
 	def __init__(self):
-		self.engine = sqlalchemy.create_engine(sqlurl, echo=False, pool_pre_ping=True)
+		# sessions are per thread, see SQLUsers.session_manager
+		if sqlurl.startswith('sqlite'):
+			self.engine = sqlalchemy.create_engine(sqlurl, echo=False)
+		else:
+			self.engine = sqlalchemy.create_engine(sqlurl, echo=False, pool_pre_ping=True, pool_size=pool_size)
 		self.session_manager = SQLUsers.session_manager(self, self.engine)
 		self.userdb = SQLUsers.UsersHandler(self)
 		self.bandb = SQLUsers.BansHandler(self)
@@ -50,10 +60,43 @@ class RequestHandler(SimpleXMLRPCRequestHandler):
 	def log_message(self, format, *args):
 		logger.info(format % args)
 
-class XmlRpcServer(SimpleXMLRPCServer):
+class TTLCache:
+	# key -> value for ttl seconds, shared by the request threads
+	def __init__(self, ttl):
+		self.ttl = ttl
+		self.entries = {}
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+
+	def get(self, key):
+		now = time.time()
+		with self.lock:
+			entry = self.entries.get(key)
+			if entry and entry[0] > now:
+				self.hits += 1
+				return True, entry[1]
+			self.misses += 1
+			return False, None
+
+	def set(self, key, value):
+		now = time.time()
+		with self.lock:
+			if len(self.entries) > 100000: # drop expired entries now and then
+				self.entries = {k: e for k, e in self.entries.items() if e[0] > now}
+			self.entries[key] = (now + self.ttl, value)
+
+account_ids = TTLCache(cache_ttl) # username -> account id
+usernames = TTLCache(cache_ttl) # account id -> username
+
+class XmlRpcServer(ThreadingMixIn, SimpleXMLRPCServer):
 	"""
 		XMLRPC service, exported functions are in class _RpcFuncs
+		each request is handled on its own thread
 	"""
+	daemon_threads = True
+	request_queue_size = 128 # listen backlog, 5 by default: concurrent clients got resets and 1s/3s SYN retries
+
 	def __init__(self, host, port):
 		super(XmlRpcServer, self).__init__((host, port), requestHandler=RequestHandler)
 		self.register_introspection_functions()
@@ -79,7 +122,8 @@ def validateLogin(username, raw_password):
 	db_user = session.query(User).filter(User.username == username).first()
 	renames = session.query(Rename.original).distinct(Rename.original).filter(Rename.user_id == db_user.id).all()
 	renames = [r[0] for r in renames]
-	country = session.query(Login.country).filter(Login.user_id == db_user.id).filter(sqlalchemy.and_(Login.country != '??', Login.country is not None, Login.country != '')).first()
+	# most recent known country, uses ix_logins_user_id
+	country = session.query(Login.country).filter(Login.user_id == db_user.id).filter(Login.country != None).filter(Login.country != '??').filter(Login.country != '').order_by(Login.id.desc()).first()
 	result = {"status": 0, "accountid": int(db_user.id), "username": str(db_user.username),
 			"ingame_time": int(db_user.ingame_time), "email": str(db_user.email),
 			"aliases": renames,
@@ -92,9 +136,60 @@ def validateLogin(username, raw_password):
 
 
 def user_id(username):
+	found, account_id = account_ids.get(username)
+	if found:
+		return account_id
 	session = root.userdb.sess()
 	db_user = session.query(User.id).filter(User.username == username).first()
+	account_ids.set(username, db_user.id)
+	usernames.set(db_user.id, username)
 	return db_user.id
+
+def user_ids(names):
+	# username -> account id for the names that exist
+	ret = {}
+	missing = []
+	for username in names:
+		found, account_id = account_ids.get(username)
+		if found:
+			ret[username] = account_id
+		else:
+			missing.append(username)
+	if missing:
+		session = root.userdb.sess()
+		for account_id, username in session.query(User.id, User.username).filter(User.username.in_(missing)):
+			ret[username] = account_id
+			account_ids.set(username, account_id)
+			usernames.set(account_id, username)
+	return ret
+
+def username(account_id):
+	found, name = usernames.get(account_id)
+	if found:
+		return name
+	session = root.userdb.sess()
+	db_user = session.query(User.username).filter(User.id == account_id).first()
+	usernames.set(account_id, db_user.username)
+	account_ids.set(db_user.username, account_id)
+	return db_user.username
+
+def usernames_from_ids(ids):
+	# account id -> username for the ids that exist
+	ret = {}
+	missing = []
+	for account_id in ids:
+		found, name = usernames.get(account_id)
+		if found:
+			ret[account_id] = name
+		else:
+			missing.append(account_id)
+	if missing:
+		session = root.userdb.sess()
+		for account_id, name in session.query(User.id, User.username).filter(User.id.in_(missing)):
+			ret[account_id] = name
+			usernames.set(account_id, name)
+			account_ids.set(name, account_id)
+	return ret
 	
 class _RpcFuncs(object):
 	"""
@@ -128,9 +223,33 @@ class _RpcFuncs(object):
 	def get_username(self, account_id):
 		ret = None
 		try:
-			session = root.userdb.sess()
-			db_user = session.query(User.username).filter(User.id == account_id).first()
-			ret = db_user.username
+			ret = username(account_id)
+			root.session_manager.commit_guard()
+		except Exception as e:
+			logger.error('Exception: {}: {}'.format(e, traceback.format_exc()))
+			root.session_manager.rollback_guard()
+		finally:
+			root.session_manager.close_guard()
+		return ret
+
+	def get_account_ids(self, usernames):
+		# batch get_account_id, returns {username: account id} for the users that exist
+		ret = {}
+		try:
+			ret = user_ids(usernames[:batch_limit])
+			root.session_manager.commit_guard()
+		except Exception as e:
+			logger.error('Exception: {}: {}'.format(e, traceback.format_exc()))
+			root.session_manager.rollback_guard()
+		finally:
+			root.session_manager.close_guard()
+		return ret
+
+	def get_usernames(self, account_ids):
+		# batch get_username, returns {str(account id): username} for the users that exist (xmlrpc keys are strings)
+		ret = {}
+		try:
+			ret = {str(account_id): name for account_id, name in usernames_from_ids([int(i) for i in account_ids[:batch_limit]]).items()}
 			root.session_manager.commit_guard()
 		except Exception as e:
 			logger.error('Exception: {}: {}'.format(e, traceback.format_exc()))
@@ -2,32 +2,138 @@
 # coding=utf-8
 # This file is part of the uberserver (GPL v2 or later), see LICENSE
 
+import os
+import csv
+import bisect
+import functools
+import ipaddress
+from array import array
+
 dbfile = "/usr/share/GeoIP/GeoIP.dat"
+# start,end,country per line (addresses or integers, IPv4 and IPv6), e.g. the db-ip.com / ip2location lite csv
+# used instead of dbfile if it exists
+csvfile = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ip2country.csv")
+cachesize = 65536
+
+class RangeDB():
+	'''
+	country ranges from a csv file, as sorted arrays of range starts/ends that are searched with bisect
+	each instance caches its own lookups, so swapping the db on reload swaps the cache with it
+	'''
+	def __init__(self, filename):
+		ranges = {4: [], 6: []}
+		with open(filename, 'r', newline='') as f:
+			for row in csv.reader(f):
+				if len(row) < 3 or row[0].startswith('#') or len(row[2]) != 2:
+					continue
+				version, start = _address(row[0])
+				_, end = _address(row[1])
+				ranges[version].append((start, end, row[2].upper()))
+
+		self.tables = {}
+		codes = {}
+		for version in (4, 6):
+			ranges[version].sort()
+			# 128 bit ints don't fit into an array
+			starts = array('L') if version == 4 else []
+			ends = array('L') if version == 4 else []
+			countries = []
+			for start, end, country in ranges[version]:
+				starts.append(start)
+				ends.append(end)
+				countries.append(codes.setdefault(country, country)) # one str per country
+			self.tables[version] = (starts, ends, countries)
+		self.lookup = functools.lru_cache(cachesize)(self._lookup)
+
+	def __len__(self):
+		return len(self.tables[4][0]) + len(self.tables[6][0])
+
+	def _lookup(self, ip):
+		try:
+			addr = ipaddress.ip_address(ip)
+		except ValueError:
+			return '??'
+		if addr.version == 6 and addr.ipv4_mapped:
+			addr = addr.ipv4_mapped
+		starts, ends, countries = self.tables[addr.version]
+		n = int(addr)
+		i = bisect.bisect_right(starts, n) - 1
+		if i < 0 or n > ends[i]:
+			return '??'
+		return countries[i]
+
+class GeoIPDB():
+	# the legacy GeoIP C binding, only used if there is no csv file
+	def __init__(self, filename):
+		import GeoIP
+		self.geoip = GeoIP.open(filename, GeoIP.GEOIP_STANDARD)
+		self.lookup = functools.lru_cache(cachesize)(self._lookup)
+
+	def _lookup(self, ip):
+		try:
+			addrinfo = self.geoip.country_code_by_addr(ip)
+		except Exception:
+			return '??' # e.g. IPv6
+		if not addrinfo: return '??'
+		return addrinfo
+
+def _address(s):
+	# (version, int) of an address or an integer string
+	s = s.strip()
+	if s.isdigit():
+		n = int(s)
+		return (4 if n < 2**32 else 6), n
+	addr = ipaddress.ip_address(s)
+	return addr.version, int(addr)
 
 def loaddb():
-	global geoip
+	global db
 	try:
-		import GeoIP
-		geoip = GeoIP.open(dbfile, GeoIP.GEOIP_STANDARD)
-		return True
+		if os.path.isfile(csvfile):
+			newdb = RangeDB(csvfile)
+		else:
+			newdb = GeoIPDB(dbfile)
 	except Exception as e:
-		print("Couldn't load %s: %s" % (dbfile, str(e)))
-		print("Hint: apt-get install geoip-database python-geoip")
+		print("Couldn't load %s: %s" % (csvfile if os.path.isfile(csvfile) else dbfile, str(e)))
+		print("Hint: put a start,end,country csv at %s, or apt-get install geoip-database python-geoip" % csvfile)
 		return False
+	db = newdb # lookups see either the old or the new db, never a half loaded one
+	return True
 
+db = None
 working = loaddb()
 
 def lookup(ip):
 	if not working: return '??'
-	addrinfo = geoip.country_code_by_addr(ip)
-	if not addrinfo: return '??'
-	return addrinfo
+	return db.lookup(ip)
 
 def reloaddb():
-	working = loaddb()
+	# safe to call from another thread, a failed reload keeps the old db
+	global working
+	working = loaddb() or working
 
 
 if __name__ == '__main__':
+	import tempfile
+	with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as f:
+		f.write('# test ranges\n')
+		f.write('"1.0.0.0","1.0.0.255","AU"\n')
+		f.write('16777472,16778239,CN\n') # 1.0.1.0 - 1.0.3.255
+		f.write('2001:200::,2001:200:ffff:ffff:ffff:ffff:ffff:ffff,JP\n')
+		f.write('3.0.0.0,3.255.255.255,-\n')
+	rangedb = RangeDB(f.name)
+	os.remove(f.name)
+	assert(len(rangedb) == 3)
+	assert(rangedb.lookup("1.0.0.0") == 'AU')
+	assert(rangedb.lookup("1.0.0.255") == 'AU')
+	assert(rangedb.lookup("1.0.2.3") == 'CN')
+	assert(rangedb.lookup("::ffff:1.0.2.3") == 'CN')
+	assert(rangedb.lookup("2001:200::1") == 'JP')
+	assert(rangedb.lookup("0.255.255.255") == '??')
+	assert(rangedb.lookup("1.0.4.0") == '??')
+	assert(rangedb.lookup("3.0.0.1") == '??')
+	assert(rangedb.lookup("not an ip") == '??')
+
 	assert(lookup("37.187.59.77")  == 'FR')
 	assert(lookup("77.64.139.108") == 'DE')
 	assert(lookup("78.46.100.157") == 'DE')
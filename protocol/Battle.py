@@ -26,6 +26,7 @@ class Battle(Channel):
 		self.maxplayers = 0
 		self.spectators = 0 # duplicated info?
 		self.locked = False
+		self.password = None # set by OPENBATTLE, separate from the key of a registered channel
 
 		self.pending_users = set() # users who asked to join, waiting for hosts response; managed by Protocol
 
@@ -48,7 +49,7 @@ class Battle(Channel):
 
 		host = self._root.clientFromSession(self.host)
 		if client!=host:
-			self._root.broadcast('JOINEDBATTLE %s %s' % (self.battle_id, client.username), ignore=set([self.host, client.session_id])) 
+			self._root.broadcast('JOINEDBATTLE %s %s' % (self.battle_id, client.username), ignore=set([self.host, client.session_id]), user=client)
 			scriptPassword = client.scriptPassword
 			if scriptPassword and 'sp' in host.compat:
 				host.Send('JOINEDBATTLE %s %s %s' % (self.battle_id, client.username, scriptPassword))
@@ -71,7 +72,7 @@ class Battle(Channel):
 		specs = 0
 		for sessionid in self.users:
 			battle_client = self._root.clientFromSession(sessionid)
-			if battle_client and battle_client.battlestatus['mode'] == '0':
+			if battle_client and battle_client.is_spectator():
 				specs += 1
 			battlestatus = self.calc_battlestatus(battle_client)
 			client.Send('CLIENTBATTLESTATUS %s %s %s' % (battle_client.username, battlestatus, battle_client.teamcolor))
@@ -84,7 +85,7 @@ class Battle(Channel):
 			rect = self.startrects[allyno]
 			client.Send('ADDSTARTRECT %s' % (allyno)+' %(left)s %(top)s %(right)s %(bottom)s' % (rect))
 
-		client.battlestatus = {'ready':'0', 'id':'0000', 'ally':'0000', 'mode':'0', 'sync':'00', 'side':'00', 'handicap':'0000000'}
+		client.battlestatus = 0
 		client.teamcolor = '0'
 		client.current_battle = self.battle_id
 		client.Send('REQUESTBATTLESTATUS')
@@ -102,7 +103,7 @@ class Battle(Channel):
 			if bot in self.bots:
 				del self.bots[bot]
 				self._root.broadcast_battle('REMOVEBOT %s %s' % (self.battle_id, bot), self.battle_id)
-		self._root.broadcast('LEFTBATTLE %s %s'%(self.battle_id, client.username))
+		self._root.broadcast('LEFTBATTLE %s %s'%(self.battle_id, client.username), user=client)
 		if client.session_id == self.host:
 			return #safety
 
@@ -110,7 +111,7 @@ class Battle(Channel):
 		specs = 0
 		for session_id in self.users:
 			user = self._root.clientFromSession(session_id)
-			if user and user.battlestatus['mode'] == '0':
+			if user and user.is_spectator():
 				specs += 1
 		self.spectators = specs
 		if oldspecs != specs:
@@ -141,12 +142,7 @@ class Battle(Channel):
 		self.__init__Battle__(self._root, self.name)		
 			
 	def calc_battlestatus(self, client):
-		battlestatus = client.battlestatus
-		status = self._root.protocol._bin2dec('0000%s%s0000%s%s%s%s%s0'%(battlestatus['side'],
-											battlestatus['sync'], battlestatus['handicap'],
-											battlestatus['mode'], battlestatus['ally'],
-											battlestatus['id'], battlestatus['ready']))
-		return status
+		return client.battlestatus # kept packed by Client
 
 
 	def kickUser(self, client, target):
@@ -164,5 +160,5 @@ class Battle(Channel):
 	def setKey():
 		return #todo: currently there is no way to inform clients when a new channel/battle key is set/unset
 	def passworded(self):
-		return 0 if self.key in ('*', None) else 1
+		return 0 if self.password in ('*', None) else 1
 
@@ -36,6 +36,10 @@ class Channel():
 	def db(self):
 		return self._root.channeldb
 
+	def db_queue(self):
+		# for writes, the in-memory state is already updated, the db catches up on the db write thread
+		return self._root.channeldb_queue
+
 	def broadcast(self, message, ignore=set(), flag=None, not_flag=None):
 		self._root.broadcast(message, self.name, ignore, None, flag, not_flag)
 
@@ -47,28 +51,34 @@ class Channel():
 
 	def register(self, client, target):
 		self.setFounder(client, target)
-		self.db().register(self, target)
+		if self.topic:
+			self.topic_user_id = target.user_id # as the db entry gets it
+		self.db_queue().register(self, target) # sets self.id on the db write thread, before later writes for the channel run there
 		self.recordUse()
 		
 	def recordUse(self):
 		self.last_used = datetime.now()
-		self.db().recordUse(self)
+		self.db_queue().recordUse(self)
 
 	def unregister(self, client):
 		self.owner_user_id = None
 		self.topic = None
+		self.topic_user_id = None
 		self.operators = set()
+		self.id = 0 # its db entry is deleted, nothing to snapshot
 		self.channelMessage('This channel has been unregistered by <%s>' % client.username)
-		self.db().unRegister(self)
+		self.db_queue().unRegister(self)
 
 	def registered(self):
-		return self.db().registered(self)
+		# from memory: channels in the db have their id since load or once register ran
+		return bool(self.id)
 
 	def addUser(self, client):
 		if client.session_id in self.users:
 			return
 		self.users.add(client.session_id)
 		client.channels.add(self.name)
+		self._root.protocol._introduce_members(self, client) # for clients with the 'lu' compat flag
 		if not client.static:
 			self.recordUse()
 		
@@ -164,7 +174,8 @@ class Channel():
 		if (self.topic and topic == self.topic) or (not self.topic and len(topic)==0):
 			return
 		self.topic = topic
-		self.db().setTopic(self, topic, client)
+		self.topic_user_id = client.user_id
+		self.db_queue().setTopic(self, topic, client)
 
 		self.broadcast('CHANNELTOPIC %s %s %s' % (self.name, client.username, topic), set())
 		if len(topic)==0:
@@ -174,21 +185,21 @@ class Channel():
 		
 	def setFounder(self, client, target):
 		self.owner_user_id = target.user_id
-		self.db().setFounder(self, target)
+		self.db_queue().setFounder(self, target)
 		self.channelMessage("<%s> has been set as this %s's founder by <%s>" % (target.username, self.identity, client.username))
 
 	def setAntispam(self, client, val):
 		self.antispam = val
-		self.db().setAntispam(self, val)
+		self.db_queue().setAntispam(self, val)
 		self.channelMessage('Anti-spam protection was set to %s by <%s>' % (str(val), client.username))
 
 	def setHistory(self, client, val):
 		self.store_history = val
-		self.db().setHistory(self, val)
+		self.db_queue().setHistory(self, val)
 		self.channelMessage('History retention was set to %s by <%s>' % (str(val), client.username))
 
 	def setKey(self, client, key):
-		self.db().setKey(self, key)
+		self.db_queue().setKey(self, key)
 		if key in ('*', None):
 			if self.key:
 				self.key = None
@@ -204,7 +215,7 @@ class Channel():
 		if target.user_id in self.operators:
 			return
 		self.operators.add(target.user_id)
-		self.db().opUser(self, target)
+		self.db_queue().opUser(self, target)
 		self.channelMessage("<%s> has been added to this %s's operator list by <%s>" % (target.username, self.identity, client.username))
 
 		for chan in self.forwards:
@@ -215,7 +226,7 @@ class Channel():
 		if not target.user_id in self.operators:
 			return
 		self.operators.remove(target.user_id)
-		self.db().deopUser(self, target)
+		self.db_queue().deopUser(self, target)
 		self.channelMessage("<%s> has been removed from this %s's operator list by <%s>" % (target.username, self.identity, client.username))
 
 		for chan in self.forwards:
@@ -236,7 +247,7 @@ class Channel():
 			return
 		self.ban[target.user_id] = {'user_id':target.user_id, 'ip_address':target.last_ip, 'expires':expires, 'reason':reason, 'issuer_user_id':client.user_id}
 		self.ban_ip[target.last_ip] = self.ban[target.user_id]
-		self.db().banUser(self, client, target, expires, reason)
+		self.db_queue().banUser(self, client, target, expires, reason)
 		self.kickUser(client, target)
 
 		for chan in self.forwards:
@@ -248,7 +259,7 @@ class Channel():
 			del self.ban[target.user_id]
 		if target.last_ip in self.ban_ip:
 			del self.ban_ip[target.last_ip]
-		self.db().unbanUser(self, target)
+		self.db_queue().unbanUser(self, target)
 
 		for chan in self.forwards:
 			if chan in self._root.channels:
@@ -262,7 +273,7 @@ class Channel():
 		except:
 			expires = datetime.max
 		self.bridged_ban[target.bridged_id] = {'bridged_id':target.bridged_id, 'expires':expires, 'reason':reason, 'issuer_user_id':client.user_id}
-		self.db().banBridgedUser(self, client, target, expires, reason)
+		self.db_queue().banBridgedUser(self, client, target, expires, reason)
 		self.removeBridgedUser(client, target)
 		if target.bridged_id in self.bridged_users:
 			self.channelMessage('<%s> has been removed from this %s by <%s>' % (target.username, self.identity, client.username))
@@ -284,7 +295,7 @@ class Channel():
 		if not target.bridged_id in self.bridged_ban:
 			return
 		del self.bridged_ban[target.bridged_id]
-		self.db().unbanBridgedUser(self, target)
+		self.db_queue().unbanBridgedUser(self, target)
 
 		for chan in self.forwards:
 			if chan in self._root.channels:
@@ -304,7 +315,7 @@ class Channel():
 		except:
 			expires = datetime.max
 		self.mutelist[target.user_id] = {'user_id':target.user_id, 'expires':expires, 'reason':reason, 'issuer_user_id':client.user_id}
-		self.db().muteUser(self, client, target, expires, reason)
+		self.db_queue().muteUser(self, client, target, expires, reason)
 		self.channelMessage('<%s> has been muted by <%s> for %s' % (client.username, target.username, self._root.protocol._pretty_time_delta(duration)))
 
 		for chan in self.forwards:
@@ -315,7 +326,7 @@ class Channel():
 		if not target.user_id in self.mutelist:
 			return
 		del self.mutelist[target.user_id]
-		self.db().unmuteUser(self, target)
+		self.db_queue().unmuteUser(self, target)
 		self.channelMessage('<%s> has been unmuted by <%s>' % (target.username, client.username))
 
 		for chan in self.forwards:
@@ -324,7 +335,7 @@ class Channel():
 
 	def addForward(self, client, channel_to):
 		self.forwards.add(channel_to.name)
-		self.db().addForward(self, channel_to)
+		self.db_queue().addForward(self, channel_to)
 
 		for user_id in self.operators:
 			channel_to.operators.add(user_id)
@@ -343,7 +354,7 @@ class Channel():
 		if not channel_to.name in self.forwards:
 			return
 		self.forwards.remove(channel_to.name)
-		self.db().removeForward(self, channel_to)
+		self.db_queue().removeForward(self, channel_to)
 
 		self.channelMessage('<%s> removed forwarding to #%s' % (client.username, channel_to.name))
 		channel_to.channelMessage('<%s> removed forwarding to #%s' % (client.username, channel_to.name))
\ No newline at end of file
@@ -20,7 +20,11 @@ import _thread as thread
 import Channel
 import Battle
 import hashlib
+import hmac
+import secrets
 import BridgedClient
+import Client
+import Compression
 
 # see https://springrts.com/dl/LobbyProtocol/ProtocolDescription.html#MYSTATUS:client
 # max. 8 ranks are possible (rank 0 isn't listed)
@@ -42,10 +46,12 @@ restricted = {
 	# encryption
 	'STARTTLS',
 	'STLS',
+	'COMPRESS',
 	]),
 'fresh':set([
 	'LOGIN',
 	'REGISTER',
+	'RESUME',
 	]),
 'agreement':set([
 	'CONFIRMAGREEMENT',
@@ -89,6 +95,7 @@ restricted = {
 	'SAYPRIVATE',
 	'SAYPRIVATEEX',
 	'GETCHANNELMESSAGES',
+	'FINDUSER',
 	########
 	# account management
 	'GETUSERINFO',
@@ -195,12 +202,24 @@ flag_map = {
 	'u':  'say2',            # SAYFROM, Battle<->Channel unification
 	'sp': 'scriptPassword',  # scriptPassword in JOINEDBATTLE
 	'b':  'battleAuth',      # JOINBATTLEACCEPT/JOINBATTLEDENIED (typically only sent by autohosts)
+	'rs': 'resume',          # RESUMETOKEN at login, RESUME after a lost connection
+	'lu': 'lazyUsers',       # ADDUSER/CLIENTSTATUS only for users sharing a channel or battle, friends and FINDUSER
+	'bm': 'batchedMulti',    # ADDUSERS, JOINEDBATTLES and CLIENTSTATUSES, many entries per line
 }
 # optional flags
 optional_flags = (
 	'b', # only useful to autohosts -> permanently optional
+	'rs',
+	'lu',
+	'bm',
 )
 
+BATCH_SIZE = 100 # entries per ADDUSERS / CLIENTSTATUSES line
+
+# Client fields that a RESUME takes over from the detached session, the rest belong to the new connection
+RESUMED_FIELDS = tuple(field for field in Client.Client.__slots__ if not field in (
+	'_root', 'ip_address', 'port', 'session_id', 'buffersend', 'buffer', 'msg_id', 'msg_length_history', 'data', 'held', 'held_size', 'lastdata'))
+
 # flags for functionality that is now either compulsory or was removed
 deprecated_flags = (
 	'cl',# BATTLEOPENED / OPENBATTLE with support for engine/version, now mandatory
@@ -310,17 +329,39 @@ class Protocol:
 			self.in_LEAVE(client, chan, 'disconnected')
 			
 		user = client.username
-		if user in self._root.usernames:
+		if self._root.usernames.get(user) is client:
 			del self._root.usernames[user]
-		if client.user_id in self._root.user_ids:
+		if self._root.user_ids.get(client.user_id) is client:
 			del self._root.user_ids[client.user_id]
 		#note: self._root.clients is managed by twistedserver.py
 
-		self.userdb.end_session(client.user_id)
+		self._root.ended_sessions.append((client.user_id, client.login_id)) # written in bulk by DataHandler.flush_ended_sessions
 
 		# inform that the client left
 		self.broadcast_RemoveUser(client)
 
+	def _detach(self, client, reason):
+		# a lost connection of a client with a resume token keeps its session (channels, battle, status) for the grace period,
+		# whatever is sent to it meanwhile is queued, see in_RESUME
+		if not client.logged_in or client.static or client.removing or not client.resume_token or not self._root.resume_grace:
+			return False
+		logging.info('[%s] <%s> connection lost from %s: %s, resumable for %d seconds' % (client.session_id, client.username, client.ip_address, reason, self._root.resume_grace))
+		client.buffersend = True
+		self._root.detached[client.username] = (client, time.time() + self._root.resume_grace)
+		return True
+
+	def _expire(self, client, reason):
+		# ends a detached session like a disconnect would have
+		del self._root.detached[client.username]
+		self._remove(client, 'Connection lost (%s)' % reason)
+		del self._root.clients[client.session_id]
+
+	def _sendResumeToken(self, client):
+		if not 'rs' in client.compat or not self._root.resume_grace:
+			return
+		client.resume_token = secrets.token_urlsafe(16)
+		client.RealSend('RESUMETOKEN %s %d' % (client.resume_token, self._root.resume_grace))
+
 
 	def get_function_args(self, client, command, function, numspaces, args):
 		function_info = inspect.getfullargspec(function)
@@ -403,7 +444,13 @@ class Protocol:
 		
 		if (ret_status):
 			# if fun_args is empty, this reduces to function(client)
-			function(*([client] + fun_args))
+			start = time.time()
+			prev = self._root.watchdog.begin(command, client.username)
+			try:
+				function(*([client] + fun_args))
+			finally:
+				self._root.watchdog.end(prev)
+				self._root.metrics.command_seconds.observe(time.time() - start, command)
 
 
 		# TODO: check the exception line... if it's "function(*([client] + fun_args))"
@@ -431,7 +478,7 @@ class Protocol:
 
 	def _udp_packet(self, username, ip, udpport):
 		client = self.clientFromUsername(username)
-		if not client:
+		if not client or client.remote: # a user of another node, its packets go to that node's nat server
 			return
 		if ip == client.local_ip or ip == client.ip_address:
 			client.Send('UDPSOURCEPORT %i'%udpport)
@@ -443,7 +490,7 @@ class Protocol:
 				client.hostport = udpport
 				host = battle.host
 				if not host == client.session_id:
-					self._root.usernames[host].SendBattle(battle, 'CLIENTIPPORT %s %s %s'%(username, ip, udpport))
+					self.clientFromSession(host).SendBattle(battle, 'CLIENTIPPORT %s %s %s'%(username, ip, udpport))
 			else:
 				client.udpport = udpport
 		else:
@@ -457,6 +504,59 @@ class Protocol:
 	
 	def clientFromSession(self, session_id):
 		return self._root.clientFromSession(session_id)
+
+	def _deferred(self, client, d, callback, *args):
+		# calls callback(client, result, *args) on the reactor thread once a db pool call returns
+		# replies carry the msg_id of the command that started it, nothing is sent if the client left meanwhile
+		msg_id = client.msg_id
+		def done(result):
+			if client.session_id not in self._root.clients:
+				return
+			prev_msg_id = client.msg_id
+			client.msg_id = msg_id
+			prev = self._root.watchdog.begin(callback.__name__, client.username)
+			try:
+				callback(client, result, *args)
+				self._root.session_manager.commit_guard()
+			except:
+				logging.error(traceback.format_exc())
+				self._root.session_manager.rollback_guard()
+			finally:
+				self._root.watchdog.end(prev)
+				client.msg_id = prev_msg_id
+				self._root.session_manager.close_guard()
+			self._replayHeld(client)
+		def failed(failure):
+			logging.error('[%s] db call for <%s> failed: %s' % (client.session_id, client.username, failure.getTraceback()))
+			client.login_pending = False
+			if client.session_id not in self._root.clients:
+				return
+			prev_msg_id = client.msg_id
+			client.msg_id = msg_id
+			if callback == self._login_done:
+				self.out_DENIED(client, args[0], 'Database error, please try again later')
+			elif callback in (self._register_checked, self._register_done):
+				client.Send('REGISTRATIONDENIED Database error, please try again later')
+			client.msg_id = prev_msg_id
+			self._replayHeld(client)
+		d.addCallbacks(done, failed)
+		return d
+
+	def _replayHeld(self, client):
+		# handles the lines that arrived while LOGIN or REGISTER waited for the db, in order; a LOGIN among them holds the rest again
+		if client.login_pending or not client.held:
+			return
+		held, client.held = client.held, []
+		client.held_size = 0
+		for cmd in held:
+			try:
+				Client.Client.HandleProtocolCommand(client, cmd)
+				self._root.session_manager.commit_guard()
+			except:
+				logging.error(traceback.format_exc())
+				self._root.session_manager.rollback_guard()
+			finally:
+				self._root.session_manager.close_guard()
 	
 	def _calc_access_status(self, client):
 		self._calc_access(client)
@@ -683,6 +783,8 @@ class Protocol:
 	def _getNextBattleId(self):
 		self._root.nextbattle += 1 
 		id = self._root.nextbattle
+		if self._root.cluster:
+			id = self._root.cluster.battle_id(id)
 		return id
 
 	def getCurrentBattle(self, client):
@@ -695,12 +797,22 @@ class Protocol:
 		return self._root.battles[battle_id]
 
 	def broadcast_AddBattle(self, battle):
+		host = self.clientFromSession(battle.host)
 		for cid, client in self._root.usernames.items():
+			if client.remote:
+				continue
+			self._introduce(client, host)
 			client.Send(self.client_AddBattle(client, battle))
+		if self._root.cluster:
+			self._root.cluster.battle_opened(battle)
 
 	def broadcast_RemoveBattle(self, battle):
 		for cid, client in self._root.usernames.items():
+			if client.remote:
+				continue
 			client.Send('BATTLECLOSED %s' % battle.battle_id)
+		if self._root.cluster:
+			self._root.cluster.battle_closed(battle.battle_id)
 
 	def broadcast_SendBattle(self, battle, data, sourceClient=None, flag=None, not_flag=None):
 		# the sourceClient is only sent for SAY*, and RING commands
@@ -724,23 +836,80 @@ class Protocol:
 
 	def broadcast_AddUser(self, client):
 		for name, receiver in self._root.usernames.items():
+			if receiver.remote: # other nodes get one login message
+				continue
 			if client.session_id == receiver.session_id: # don't send ADDUSER to self
 				continue
 			if client.username == receiver.username:
 				logging.error("Tried to send adduser to self: %s!"% client.username)
 				continue
+			if receiver.known_users is not None: # 'lu' clients are told about friends only
+				if client.user_id in receiver.friends:
+					self._introduce(receiver, client, False)
+				continue
 			receiver.Send(self.client_AddUser(receiver, client))
+		if self._root.cluster:
+			self._root.cluster.user_login(client)
 
 	def broadcast_RemoveUser(self, client):
 		for name, receiver in self._root.usernames.items():
-			if client.static:
+			if client.static or receiver.remote:
 				continue
+			if receiver.known_users is not None:
+				if not client.user_id in receiver.known_users:
+					continue
+				receiver.known_users.discard(client.user_id)
 			if not name == client.username:
 				self.client_RemoveUser(receiver, client)
+		if self._root.cluster:
+			self._root.cluster.user_logout(client)
+
+	def broadcast_ClientStatus(self, client):
+		# 'bm' clients get the status with the others of this reactor iteration in one CLIENTSTATUSES, see DataHandler.flush_statuses
+		msg = 'CLIENTSTATUS %s %d' % (client.username, client.status)
+		self._root.multicast(self._root.clients, msg, set(), None, None, 'bm', client)
+		self._root.queue_status(client)
+		if self._root.cluster:
+			self._root.cluster.client_status(client)
+
+	def _batch(self, command, entries, separator=' '):
+		# lines of command with BATCH_SIZE entries each
+		return [command + ' ' + separator.join(entries[i:i + BATCH_SIZE]) for i in range(0, len(entries), BATCH_SIZE)]
+
+	def client_ClientStatuses(self, users):
+		return self._batch('CLIENTSTATUSES', ['%s %d' % (user.username, user.status) for user in users])
+
+	def client_AddUsers(self, receiver, users):
+		return self._batch('ADDUSERS', [self.client_AddUser(receiver, user)[len('ADDUSER '):] for user in users], '\t')
 
 	def broadcast_Moderator(self, message):
 		self.in_SAY(self._root.chanserv, 'moderator', message)
 
+	def _knows(self, receiver, user):
+		# if receiver got ADDUSER for user, always true for clients without the 'lu' compat flag
+		return receiver.known_users is None or user.user_id in receiver.known_users
+
+	def _introduce(self, receiver, user, status=True):
+		# sends ADDUSER (and CLIENTSTATUS) of user to a 'lu' client that doesn't know user yet
+		if receiver.remote: # its node knows whether it does, and user is a remote user there
+			self._root.cluster.introduce(receiver, user, status)
+			return
+		if self._knows(receiver, user):
+			return
+		receiver.known_users.add(user.user_id)
+		receiver.Send(self.client_AddUser(receiver, user))
+		if status and user.status:
+			receiver.Send('CLIENTSTATUS %s %d' % (user.username, user.status))
+
+	def _introduce_members(self, channel, client):
+		# before JOINED and CLIENTS, a joining client and the channel's members get to know each other
+		for session_id in channel.users:
+			member = self.clientFromSession(session_id)
+			if member is client:
+				continue
+			self._introduce(member, client)
+			self._introduce(client, member)
+
 	def client_AddUser(self, receiver, user):
 		'sends the protocol for adding a user'
 		return 'ADDUSER %s %s %s %s' % (user.username, user.country_code, user.user_id, user.agent)
@@ -835,6 +1004,33 @@ class Protocol:
 		client.flushBuffer()
 		client.Send(' '.join((self._root.server, str(self._root.server_version), '*', str(self._root.natport), '0')))
 
+	def in_COMPRESS(self, client, level=''):
+		'''
+		Compress everything the server sends after the OK with zlib: one deflate stream,
+		with a sync flush after each batch of lines. Lines sent to the server stay uncompressed.
+
+		@optional.int level: zlib level 1-9, lower is less cpu for the server (default is the server's highest allowed level)
+		'''
+		if not self._root.compress_level:
+			self.out_FAILED(client, 'COMPRESS', 'Compression is disabled on this server')
+			return
+		if isinstance(client.transport, Compression.CompressingTransport):
+			self.out_FAILED(client, 'COMPRESS', 'Already compressing')
+			return
+		if self._root.compress_budget.over():
+			self.out_FAILED(client, 'COMPRESS', 'Server is busy, try again later')
+			return
+		try:
+			level = min(int(level), self._root.compress_level) if level else self._root.compress_level
+		except ValueError:
+			self.out_FAILED(client, 'COMPRESS', 'Invalid level: %s' % level)
+			return
+		if level < 1:
+			self.out_FAILED(client, 'COMPRESS', 'Invalid level: %s' % level)
+			return
+		self.out_OK(client, 'COMPRESS')
+		client.StartCompression(level)
+
 	def in_REGISTER(self, client, username, password, email = ''):
 		'''
 		Register a new user in the account database.
@@ -860,15 +1056,8 @@ class Protocol:
 			client.Send("REGISTRATIONDENIED %s" % (reason))
 			return
 
-		# test if user would be OK on db side (e.g. duplication)
-		email = email.lower()
-		good, reason = self.userdb.check_register_user(username, email, client.ip_address)
-		if (not good):
-			logging.info('[%s] Registration failed for user <%s>: %s' % (client.session_id, username, reason))
-			client.Send('REGISTRATIONDENIED %s' % reason)
-			return
-
 		# require a valid looking email address, if we are going to require verification
+		email = email.lower()
 		if self.verificationdb.active():
 			good, reason = self.verificationdb.valid_email_addr(email)
 			if not good:
@@ -878,6 +1067,19 @@ class Protocol:
 		else:
 			email = None # avoid triggering uniqueness constraint with empty strings
 
+		# test if user would be OK on db side (e.g. duplication)
+		client.login_pending = True # hold later lines, e.g. a LOGIN right behind, until the account is in the db
+		d = self._root.userdb_async.check_register_user(username, email, client.ip_address)
+		self._deferred(client, d, self._register_checked, username, password, email)
+
+	def _register_checked(self, client, result, username, password, email):
+		client.login_pending = False
+		good, reason = result
+		if (not good):
+			logging.info('[%s] Registration failed for user <%s>: %s' % (client.session_id, username, reason))
+			client.Send('REGISTRATIONDENIED %s' % reason)
+			return
+
 		# rate limit per ip
 		recent_regs = self._root.recent_registrations.get(client.ip_address, 0)
 		if recent_regs >= 3 and client.ip_address != self._root.online_ip:
@@ -885,13 +1087,18 @@ class Protocol:
 			return
 		self._root.recent_registrations[client.ip_address] = recent_regs + 1
 
-		#save user to db
-		self.userdb.register_user(username, password, client.ip_address, email)
-		client_fromdb = self.clientFromUsername(username, True)
-
-		# verification
+		#save user to db, verification
 		verif_reason = "registered an account on the SpringRTS lobbyserver (username: %s)" % username
-		good, reason = self.verificationdb.check_and_send(client_fromdb.user_id, email, 4, verif_reason)
+		client.login_pending = True
+		d = self._root.userdb_async.register_and_verify(username, password, client.ip_address, email, verif_reason)
+		self._deferred(client, d, self._register_done, username)
+
+	def _register_done(self, client, result, username):
+		client.login_pending = False
+		good, reason, client_fromdb = result
+		if not client_fromdb: # not registered
+			client.Send("REGISTRATIONDENIED %s" % reason)
+			return
 		if (not good):
 			client.Send("REGISTRATIONDENIED %s" % ("verification failed: " + reason))
 			return
@@ -966,7 +1173,7 @@ class Protocol:
 			self.out_DENIED(client, username, reason)
 			return
 
-		if username in self._root.usernames:
+		if username in self._root.usernames and not username in self._root.detached:
 			self.out_DENIED(client, username, 'Already logged in.')
 			return
 		
@@ -974,22 +1181,15 @@ class Protocol:
 			self.out_DENIED(client, username, "Invalid username: '%s'" % username)
 			return
 
-		good, reason = self.userdb.check_login_user(username, password)
-		if not good:
-			self.out_DENIED(client, username, reason)
+		if client.login_pending:
+			self.out_DENIED(client, username, 'Login already in progress.')
 			return
-		
+
 		delay, reason = self._check_delayed_registration(client)
 		if delay:
 			self.out_DENIED(client, username, reason)
 			return
- 		
-		banned, reason = self.userdb.check_banned(username, client.ip_address)
-		if banned:
-			assert (type(reason) == str)
-			self.out_DENIED(client, username, reason)
-			return			
-			
+
 		if self.SayHooks.isNasty(sentence_args):
 			self.out_DENIED(client, username, "Invalid sentence args")
 			return
@@ -1008,11 +1208,62 @@ class Protocol:
 			else:
 				last_mac_id = last_id 
 				last_sys_id = "0" # backwards compat for SL<0.269
-			for flag in compat_flags.split(' '):
-				client.compat.add(flag)
-		
-		# login checks complete
-		dbuser = self.userdb.login_user(username, password, client.ip_address, agent, last_sys_id, last_mac_id, local_ip, client.country_code)			
+			client.compat = set(compat_flags.split(' '))
+
+		# password hashing and the db round trips run on a db thread
+		client.login_pending = True
+		d = self._root.userdb_async.check_and_login_user(username, password, client.ip_address, agent, last_sys_id, last_mac_id, local_ip, client.country_code)
+		self._deferred(client, d, self._login_done, username, agent, local_ip)
+
+	def in_RESUME(self, client, username, token):
+		'''
+		Take over a session whose connection was lost, within the grace period after it.
+		Needs the 'rs' compatibility flag at login. Replies RESUMED followed by everything
+		sent to the session meanwhile, and a new RESUMETOKEN; or RESUMEFAILED, then LOGIN as usual.
+
+		@required.str username: The username of the lost session.
+		@required.str token: The token from the last RESUMETOKEN.
+		'''
+		entry = self._root.detached.get(username)
+		if not entry or not hmac.compare_digest(entry[0].resume_token.encode(), token.encode()): # str only compares ascii
+			client.Send('RESUMEFAILED Unknown or expired session')
+			return
+		detached = entry[0]
+		del self._root.detached[username]
+
+		# the new connection takes the place of the old one, under its session id
+		queued = detached.buffer
+		del self._root.clients[client.session_id]
+		if self._root.capture: # the following lines are captured under the old id
+			self._root.capture.disconnected(client.session_id)
+			self._root.capture.connected(detached.session_id)
+		client.session_id = detached.session_id
+		self._root.clients[client.session_id] = client
+		for field in RESUMED_FIELDS:
+			setattr(client, field, getattr(detached, field))
+		self._root.usernames[client.username] = client
+		self._root.user_ids[client.user_id] = client
+		logging.info('[%s] <%s> resumed from %s' % (client.session_id, client.username, client.ip_address))
+
+		client.Send('RESUMED %s' % client.username)
+		client.buffer = queued
+		client.flushBuffer()
+		self._sendResumeToken(client)
+
+	def _login_done(self, client, result, username, agent, local_ip):
+		client.login_pending = False
+		good, reason, dbuser, client.login_id, friends = result
+		if not good:
+			self.out_DENIED(client, username, reason)
+			return
+
+		if username in self._root.detached: # a new login instead of RESUME ends the old session
+			self._expire(self._root.detached[username][0], 'logged in again')
+
+		if username in self._root.usernames: # logged in from elsewhere while the db was busy
+			self._root.ended_sessions.append((dbuser.id, client.login_id))
+			self.out_DENIED(client, username, 'Already logged in.')
+			return
 
 		# update local client fields from DB User values
 		client.access = dbuser.access
@@ -1030,6 +1281,7 @@ class Protocol:
 		client.ingame_time = dbuser.ingame_time
 		client.email = dbuser.email
 		client.agent = agent
+		client.friends = set(friends)
 	
 		if (client.access == 'agreement'):
 			logging.info('[%s] Sent user <%s> the terms of service on session.' % (client.session_id, dbuser.username))
@@ -1075,33 +1327,56 @@ class Protocol:
 
 		self._sendMotd(client, self._get_motd_string(client))
 		self._checkCompat(client)
-
-		for sessid, addclient in self._root.clients.items():
-			if not addclient.logged_in:
-				continue
-			client.RealSend(self.client_AddUser(client, addclient))
+		self._sendResumeToken(client)
+
+		if 'lu' in client.compat:
+			# only itself, online friends and battle hosts, the users of channels and battles follow when they are joined
+			client.known_users = set([client.user_id])
+			client.known_users.update(user_id for user_id in client.friends if user_id in self._root.user_ids)
+			client.known_users.update(self.clientFromSession(battle.host).user_id for battle in self._root.battles.values())
+
+		batched = 'bm' in client.compat
+		users = [addclient for addclient in self._root.clients.values() if addclient.logged_in and self._knows(client, addclient)]
+		if batched:
+			for line in self.client_AddUsers(client, users):
+				client.RealSend(line)
+		else:
+			for addclient in users:
+				client.RealSend(self.client_AddUser(client, addclient))
 
 		for battleid, battle in self._root.battles.items():
 			client.RealSend(self.client_AddBattle(client, battle))
 			client.RealSend('UPDATEBATTLEINFO %s %i %i %s %s' % (battle.battle_id, battle.spectators, battle.locked, battle.maphash, battle.map))
+			members = []
 			for session_id in battle.users:
 				battleclient = self.clientFromSession(session_id)
-				if not battleclient.session_id == battle.host:
-					client.RealSend('JOINEDBATTLE %s %s' % (battle.battle_id, battleclient.username))
+				if not battleclient.session_id == battle.host and self._knows(client, battleclient):
+					members.append(battleclient.username)
+			if batched:
+				if members:
+					client.RealSend('JOINEDBATTLES %s %s' % (battle.battle_id, ' '.join(members)))
+			else:
+				for username in members:
+					client.RealSend('JOINEDBATTLE %s %s' % (battle.battle_id, username))
 
 		# client status is sent last, so battle status is calculated correctly updated at clients
-		for sessid, addclient in self._root.clients.items():
-			if not addclient.logged_in:
-				continue
-			if addclient.status == 0:
-				continue
-			client.RealSend('CLIENTSTATUS %s %d' % (addclient.username, addclient.status))
+		if batched:
+			for line in self.client_ClientStatuses([addclient for addclient in users if addclient.status]):
+				client.RealSend(line)
+		else:
+			for addclient in users:
+				if addclient.status == 0:
+					continue
+				client.RealSend('CLIENTSTATUS %s %d' % (addclient.username, addclient.status))
+
+		if self._root.cluster:
+			self._root.cluster.send_login_info(client)
 
 		client.RealSend('LOGININFOEND')
 		client.flushBuffer()
 		self.broadcast_AddUser(client) # send ADDUSER to all clients except self
 		if client.status != 0:
-			self._root.broadcast('CLIENTSTATUS %s %d'%(client.username, client.status)) # broadcast current client status
+			self.broadcast_ClientStatus(client) # broadcast current client status
 		if not client.bot and 'mod' in client.accesslevels:
 			self.in_JOIN(client, "moderator")
 
@@ -1215,7 +1490,7 @@ class Protocol:
 			client.Send('CHANNELMESSAGE %s You are %s.' % (chan, channel.getMuteMessage(client)))
 			return
 		if channel.store_history:
-			self.userdb.add_channel_message(channel.id, client.user_id, None, msg, False)
+			self._root.userdb_queue.add_channel_message(channel.id, client.user_id, None, msg, False, datetime.datetime.now())
 
 		self._root.broadcast('SAID %s %s %s' % (chan, client.username, msg), chan, set([]), client, 'u')
 		
@@ -1252,7 +1527,7 @@ class Protocol:
 			client.Send('CHANNELMESSAGE %s You are %s.' % (chan, channel.getMuteMessage(client)))
 			return
 		if channel.store_history: 
-			self.userdb.add_channel_message(channel.id, client.user_id, None, msg, True)
+			self._root.userdb_queue.add_channel_message(channel.id, client.user_id, None, msg, True, datetime.datetime.now())
 
 		self._root.broadcast('SAIDEX %s %s %s' % (chan, client.username, msg), chan, set([]), client, 'u')
 
@@ -1279,8 +1554,10 @@ class Protocol:
 		if not receiver:
 			logging.info('[%s] <%s>: user to pm is not online: %s' % (client.session_id, client.username, user))
 			return
+		self._introduce(client, receiver)
 		client.Send('SAYPRIVATE %s %s' % (user, msg))
 		if not self.is_ignored(receiver, client):
+			self._introduce(receiver, client)
 			receiver.Send('SAIDPRIVATE %s %s' % (client.username, msg))
 
 	def in_SAYPRIVATEEX(self, client, user, msg):
@@ -1295,8 +1572,10 @@ class Protocol:
 
 		receiver = self.clientFromUsername(user)
 		if receiver:
+			self._introduce(client, receiver)
 			client.Send('SAYPRIVATEEX %s %s' % (user, msg))
 			if not self.is_ignored(receiver, client):
+				self._introduce(receiver, client)
 				receiver.Send('SAIDPRIVATEEX %s %s' % (client.username, msg))
 
 	def in_BATTLEHOSTMSG(self, client, battle_name, username, msg):
@@ -1459,7 +1738,7 @@ class Protocol:
 			self.out_FAILED(client, "SAYFROM", "Bridged user <%s> not present in channel" % bridgedClient.username, False)
 			return
 		if channel.store_history: 
-			self.userdb.add_channel_message(channel.id, client.user_id, bridgedClient.bridged_id, msg, False)
+			self._root.userdb_queue.add_channel_message(channel.id, client.user_id, bridgedClient.bridged_id, msg, False, datetime.datetime.now())
 
 		self._root.broadcast('SAIDFROM %s %s %s' % (chan, bridgedClient.username, msg), chan, set([]), client, 'u')
 		
@@ -1570,11 +1849,12 @@ class Protocol:
 			return
 
 		self.userdb.add_friend_request(client.user_id, friendRequestClient.user_id, msg)
-		if self.clientFromID(friendRequestClient.user_id):
+		online = self.clientFromID(friendRequestClient.user_id) # the db record is not the online client
+		if online:
 			if msg:
-				friendRequestClient.Send('FRIENDREQUEST userName=%s\tmsg=%s' % (client.username, msg))
+				online.Send('FRIENDREQUEST userName=%s\tmsg=%s' % (client.username, msg))
 			else:
-				friendRequestClient.Send('FRIENDREQUEST userName=%s' % client.username)
+				online.Send('FRIENDREQUEST userName=%s' % client.username)
 
 
 	def in_ACCEPTFRIENDREQUEST(self, client, tags):
@@ -1592,10 +1872,18 @@ class Protocol:
 
 		self.userdb.friend_users(client.user_id, friendRequestClient.user_id)
 		self.userdb.remove_friend_request(friendRequestClient.user_id, client.user_id)
+		client.friends.add(friendRequestClient.user_id)
 
 		client.Send('FRIEND userName=%s' % username)
-		if self.clientFromID(friendRequestClient.user_id):
-			friendRequestClient.Send('FRIEND userName=%s' % client.username)
+		online = self.clientFromID(friendRequestClient.user_id)
+		if online:
+			if online.remote:
+				self._root.cluster.set_friend(online, client, True)
+			else:
+				online.friends.add(client.user_id)
+			self._introduce(client, online)
+			self._introduce(online, client)
+			online.Send('FRIEND userName=%s' % client.username)
 
 	def in_DECLINEFRIENDREQUEST(self, client, tags):
 		tags = self._parseTags(tags)
@@ -1622,10 +1910,16 @@ class Protocol:
 		friendRequestClient = self.clientFromUsername(username, True)
 
 		self.userdb.unfriend_users(client.user_id, friendRequestClient.user_id)
+		client.friends.discard(friendRequestClient.user_id)
 
 		client.Send('UNFRIEND userName=%s' % username)
-		if self.clientFromID(friendRequestClient.user_id):
-			friendRequestClient.Send('UNFRIEND userName=%s' % client.username)
+		online = self.clientFromID(friendRequestClient.user_id)
+		if online:
+			if online.remote:
+				self._root.cluster.set_friend(online, client, False)
+			else:
+				online.friends.discard(client.user_id)
+			online.Send('UNFRIEND userName=%s' % client.username)
 
 	def in_FRIENDREQUESTLIST(self, client):
 		client.Send('FRIENDREQUESTLISTBEGIN')
@@ -1818,7 +2112,7 @@ class Protocol:
 
 		battle.battle_id = battle_id
 		battle.host = client.session_id
-		battle.key = key
+		battle.password = key
 		battle.type = type
 		battle.natType = natType
 		battle.port = port
@@ -1869,7 +2163,7 @@ class Protocol:
 			return
 		host = self.clientFromSession(battle.host)
 		if not battle.isFounder(client) and not 'mod' in client.accesslevels:
-			if not battle.key in ('*', None) and not battle.key == key:
+			if not battle.password in ('*', None) and not battle.password == key:
 				client.Send('JOINBATTLEFAILED Incorrect password')
 				return
 			if client.user_id in battle.ban:
@@ -2047,26 +2341,24 @@ class Protocol:
 			self.out_FAILED(client, "MYBATTLESTATUS", "not inside a battle", True)
 			return
 
-		spectating = (client.battlestatus['mode'] == '0')
+		spectating = client.is_spectator()
 
 		clients = (self.clientFromSession(name) for name in battle.users)
-		spectators = len([user for user in clients if user and (user.battlestatus['mode'] == '0')])
+		spectators = len([user for user in clients if user and user.is_spectator()])
 
-		u, u, u, u, side1, side2, side3, side4, sync1, sync2, u, u, u, u, handicap1, handicap2, handicap3, handicap4, handicap5, handicap6, handicap7, mode, ally1, ally2, ally3, ally4, id1, id2, id3, id4, ready, u = self._dec2bin(battlestatus, 32)[-32:]
+		oldstatus = battle.calc_battlestatus(client)
+		oldcolor = client.teamcolor
+		client.set_battlestatus(battlestatus)
+		client.teamcolor = myteamcolor
 
 		if spectating:
 			if len(battle.users) - spectators >= int(battle.maxplayers):
-				mode = '0'
-			elif mode == '1':
+				client.set_battlestatus_field('mode', 0)
+			elif not client.is_spectator():
 				spectators -= 1
-		elif mode == '0':
+		elif client.is_spectator():
 			spectators += 1
 
-		oldstatus = battle.calc_battlestatus(client)
-		oldcolor = client.teamcolor
-		client.battlestatus.update({'ready':ready, 'id':id1+id2+id3+id4, 'ally':ally1+ally2+ally3+ally4, 'mode':mode, 'sync':sync1+sync2, 'side':side1+side2+side3+side4})
-		client.teamcolor = myteamcolor
-
 		oldspecs = battle.spectators
 		battle.spectators = spectators
 
@@ -2144,7 +2436,7 @@ class Protocol:
 			if ingame_time >= 1:
 				client.ingame_time += int(ingame_time)
 				self.userdb.save_user(client)
-		self._root.broadcast('CLIENTSTATUS %s %d'%(client.username, client.status))
+		self.broadcast_ClientStatus(client)
 
 	def in_CHANNELS(self, client):
 		'''
@@ -2190,7 +2482,10 @@ class Protocol:
 		except:
 			self.out_FAILED(client, "GETCHANNELMESSAGES", "Invalid id", True)
 			return
-		msgs = self.userdb.get_channel_messages(client.user_id, channel.id, last_msg_id)
+		d = self._root.userdb_async.get_channel_messages(client.user_id, channel.id, last_msg_id)
+		self._deferred(client, d, self._sendChannelMessages, chan)
+
+	def _sendChannelMessages(self, client, msgs, chan):
 		for msg in msgs:
 			timestamp = int(time.mktime(msg[0].timetuple()))
 			self.out_JSON(client,  'SAID', {"chanName": chan, "time": str(timestamp), "userName": msg[1], "msg": msg[2], "ex_msg":msg[3], "id": msg[4]})
@@ -2334,7 +2629,7 @@ class Protocol:
 
 		if not value.isdigit() or not int(value) in range(0, 101):
 			return
-		user.battlestatus['handicap'] = self._dec2bin(value, 7)
+		user.set_battlestatus_field('handicap', value)
 		battle = self.getCurrentBattle(client)
 		self._root.broadcast_battle('CLIENTBATTLESTATUS %s %s %s'%(username, battle.calc_battlestatus(user), user.teamcolor), user.current_battle)
 
@@ -2353,7 +2648,7 @@ class Protocol:
 		if not user or not user.session_id in battle.users:
 			return
 
-		user.battlestatus['id'] = self._dec2bin(teamno, 4)
+		user.set_battlestatus_field('id', teamno)
 		battle = self.getCurrentBattle(client)
 		if not battle: return
 		self._root.broadcast_battle('CLIENTBATTLESTATUS %s %s %s'%(username, battle.calc_battlestatus(user), user.teamcolor), user.current_battle)
@@ -2373,7 +2668,7 @@ class Protocol:
 		if not user or not user.session_id in battle.users:
 			return
 
-		user.battlestatus['ally'] = self._dec2bin(allyno, 4)
+		user.set_battlestatus_field('ally', allyno)
 		battle = self.getCurrentBattle(client)
 		if not battle: return
 		self._root.broadcast_battle('CLIENTBATTLESTATUS %s %s %s'%(username, battle.calc_battlestatus(user), user.teamcolor), user.current_battle)
@@ -2414,13 +2709,13 @@ class Protocol:
 		if not user or not user.session_id in battle.users:
 			return
 
-		if not user.battlestatus['mode'] == '1': # ??!
+		if user.is_spectator():
 			return
 		battle = self.getCurrentBattle(user)
 		if not battle:
 			return
 		battle.spectators += 1
-		user.battlestatus['mode'] = '0'
+		user.set_battlestatus_field('mode', 0)
 		self._root.broadcast_battle('CLIENTBATTLESTATUS %s %s %s'%(username, battle.calc_battlestatus(user), user.teamcolor), user.current_battle)
 		self._root.broadcast('UPDATEBATTLEINFO %s %i %i %s %s' %(battle.battle_id, battle.spectators, battle.locked, battle.maphash, battle.map))
 
@@ -2481,6 +2776,20 @@ class Protocol:
 				del battle.bots[name]
 				self._root.broadcast_battle('REMOVEBOT %s %s'%(battle.battle_id, name), battle.battle_id)
 
+	def in_FINDUSER(self, client, username):
+		'''
+		Get ADDUSER and CLIENTSTATUS of an online user, for clients with the 'lu'
+		compatibility flag that were not told about that user yet.
+
+		@required.str username: The user to look up.
+		'''
+		user = self.clientFromUsername(username)
+		if not user:
+			self.out_FAILED(client, 'FINDUSER', 'User not online')
+			return
+		self._introduce(client, user)
+		self.out_OK(client, 'FINDUSER')
+
 	def in_GETUSERID(self, client, username):
 		user = self.clientFromUsername(username, True)
 		if user:
@@ -2517,21 +2826,24 @@ class Protocol:
 			self.out_SERVERMSG(client, "external_id=%s,  location=%s,  external_username=%s" % (bridged_user.external_id, bridged_user.location, bridged_user.external_username))			
 		else:
 			# native username
+			online = self.clientFromUsername(username)
+			if online and online.remote:
+				self.out_SERVERMSG(client, "<%s> is online on cluster node %s,  user_id=%d" % (online.username, online.node, online.user_id))
 			user = self.clientFromUsername(username, True)
 			if not user:
 				self.out_SERVERMSG(client, "User '%s' does not exist" % username)
 				return
 			register_date = user.register_date.strftime('%b %d, %Y') if user.register_date else 'unknown'
 			last_login = user.last_login.strftime('%b %d, %Y, %H:%M:%S') if user.last_login else 'unknown'
-			if user.username in self._root.usernames:
+			ingame_time = int(user.ingame_time)
+			if online and not online.remote:
 				if user.static:
 					self.out_SERVERMSG(client, "User <%s> is static" % username)
 					return
 				self.out_SERVERMSG(client, "<%s> is online,  user_id=%d, session_id=%d" % (user.username, user.user_id, user.session_id))
 				ingame_time = int(self._root.usernames[user.username].ingame_time)	
-			else:
+			elif not online:
 				self.out_SERVERMSG(client, "<%s> is offline,  user_id=%s" % (user.username, user.user_id))
-				ingame_time = int(user.ingame_time)
 			self.out_SERVERMSG(client, "Agent: %s" % (user.last_agent))
 			self.out_SERVERMSG(client, "Registered %s" % register_date)
 			self.out_SERVERMSG(client, "Last login %s" % last_login)
@@ -2564,7 +2876,7 @@ class Protocol:
 		@required.str username: The target user.
 		'''
 		target = self.clientFromUsername(username)
-		if target:
+		if target and not target.remote: # the ip of a user on another node is in the db
 			if target.ip_address in self._root.trusted_proxies:
 				ip = "%s via proxy %s" % (target.local_ip, target.ip_address)
 			else:
@@ -2629,9 +2941,9 @@ class Protocol:
 		# set bot mode of target user
 		online = False
 		user = self.clientFromUsername(username)
-		if user:
+		if user and not user.remote:
 			online = True
-		else: # not online, try to load from db
+		else: # not online here, try to load from db
 			user = self.clientFromUsername(username, True)
 			if not user:
 				return
@@ -2641,9 +2953,11 @@ class Protocol:
 		self.userdb.save_user(user)
 		if online:
 			self._calc_status(user, user.status)
-			self._root.broadcast('CLIENTSTATUS %s %d'%(user.username, user.status))
+			self.broadcast_ClientStatus(user)
 
 		self.out_SERVERMSG(client, 'Botmode for <%s> successfully changed to %s' % (username, bot))
+		if username in self._root.usernames and not online:
+			self.out_SERVERMSG(client, '<%s> is logged in on another cluster node, the change shows once they log in again' % username)
 		if bot:
 			self.broadcast_Moderator('New bot: <%s> created by <%s>' % (username, client.username))
 		else:
@@ -2770,24 +3084,48 @@ class Protocol:
 			self.out_SERVERMSG(client, "Invalid access mode, only user, mod, admin is valid.")
 			return
 		user.access = access
-		if username in self._root.usernames:
+		online = self._root.usernames.get(username) is user # not for a user on another node, that is the db record
+		if online:
 			self._calc_access_status(user)
-			self._root.broadcast('CLIENTSTATUS %s %d' % (username, user.status))
+			self.broadcast_ClientStatus(user)
 		self.userdb.save_user(user)
 		self.out_OK(client, "SETACCESS")
+		if username in self._root.usernames and not online:
+			self.out_SERVERMSG(client, '<%s> is logged in on another cluster node, the change shows once they log in again' % username)
 		# remove the new mod/admin from everyones ignore list and notify affected users
 		if access in ('mod', 'admin'):
 			userIds = self.userdb.globally_unignore_user(user.user_id)
 			for userId in userIds:
 				userThatIgnored = self.clientFromID(userId)
 				if userThatIgnored:
-					userThatIgnored.ignored.pop(user.user_id)
+					if not userThatIgnored.remote:
+						userThatIgnored.ignored.pop(user.user_id)
 					userThatIgnored.Send('UNIGNORE userName=%s' % (username))
 
 	
-	def in_STATS(self, client):
+	def in_STATS(self, client, section=''):
+		'''
+		Print server statistics to the logfile.
+		STATS metrics sends a summary of the live metrics (traffic, reactor lag, slowest commands) instead,
+		STATS stalls the commands and loops that blocked the reactor the longest recently,
+		STATS queries the sql statements and SQLUsers methods that took the most db time.
+
+		@optional.str section: metrics, stalls or queries
+		'''
 		if not 'admin' in client.accesslevels:
-			return		
+			return
+		if section == 'metrics':
+			for line in self._root.metrics.summary():
+				self.out_SERVERMSG(client, line)
+			return
+		if section == 'stalls':
+			for line in self._root.watchdog.summary():
+				self.out_SERVERMSG(client, line)
+			return
+		if section == 'queries':
+			for line in self._root.query_profiler.summary():
+				self.out_SERVERMSG(client, line)
+			return
 		self._root.stats()
 		self.out_SERVERMSG(client, 'Stats were printed in the server logfile')
 		
@@ -1,11 +1,11 @@
 #!/usr/bin/env python3
 # coding=utf-8
 
-import _thread as thread
-
-import traceback, signal, socket, sys, logging
+import traceback, signal, socket, sys, os, logging, time
+startup_time = time.time()
 from twisted.internet import reactor
 from twisted.internet import task
+from twisted.internet.error import CannotListenError
 import coloredlogs
 coloredlogs.install(level='WARN')
 
@@ -14,14 +14,21 @@ sys.path.append(".")
 
 from DataHandler import DataHandler
 from Client import Client
-from NATServer import NATServer
+import NATServer
+import StateServer
+import Metrics
+import Cluster
+import Frontend
+import Handoff
 
 import ip2country # just to make sure it's downloaded
 import ChanServ
 import twistedserver
 
 _root = DataHandler()
+_root.phase_start = startup_time # imports (ip2country loads its db) count into the first phase
 _root.parseArgv(sys.argv)
+_root.startup_phase('imports, setup and arguments')
 
 try:
 	signal.SIGHUP
@@ -37,36 +44,91 @@ except AttributeError:
 
 logging.info('Starting uberserver...')
 
-try:
-	natport = _root.natport
-	natserver = NATServer(natport)
-	thread.start_new_thread(natserver.start,())
-	natserver.bind(_root)
-except socket.error:
-	logging.error("Could not start NAT server - hole punching will be unavailable.")
-
 try:
 	_root.init()
 except:
 	logging.error(traceback.format_exc())
 	logging.info('Exception caught, exiting...')
 
+if _root.handoffpath:
+	# before listening anywhere: the running server keeps its ports until it handed off and exited
+	try:
+		takeover = Handoff.connect(_root.handoffpath)
+		if takeover:
+			_root.listener = takeover.restore(_root, twistedserver.ChatFactory(_root))
+			takeover.finish()
+	except:
+		logging.error(traceback.format_exc())
+		logging.error('Could not take over from the running server, exiting...')
+		_root.shutdown()
+		sys.exit(1)
+	_root.startup_phase('takeover')
+
+try:
+	NATServer.listen(_root, _root.natport)
+except CannotListenError:
+	logging.error("Could not start NAT server - hole punching will be unavailable.")
+
+if _root.httpport:
+	try:
+		StateServer.listen(_root, _root.httpport, _root.http_interval)
+	except CannotListenError:
+		logging.error("Could not start the http state server.")
+
+_root.watchdog.start()
+if _root.metricsport:
+	try:
+		Metrics.listen(_root.metrics, _root.metricsport)
+	except CannotListenError:
+		logging.error("Could not start the metrics server.")
+
+if _root.clusterpath:
+	try:
+		Cluster.start(_root)
+	except CannotListenError:
+		logging.error("Could not start the cluster broker.")
+
 try:
-	reactor.listenTCP(_root.port, twistedserver.ChatFactory(_root))
+	if _root.workers:
+		if os.path.exists(_root.workersocket):
+			os.unlink(_root.workersocket)
+		reactor.listenUNIX(_root.workersocket, twistedserver.WorkerLinkFactory(_root))
+		_root.worker_processes = Frontend.spawn(_root, _root.workers, _root.workersocket)
+		logging.info("Started %d frontend workers on port %d" % (_root.workers, _root.port))
+	elif not _root.listener:
+		_root.listener = reactor.listenTCP(_root.port, twistedserver.ChatFactory(_root))
+	if _root.handoffpath:
+		Handoff.listen(_root, _root.handoffpath)
 	print('Started lobby server!')
 	print('Connect the lobby client to')
-	print('  public:  %s:%d' %(_root.online_ip, _root.port))
+	if _root.online_ip:
+		print('  public:  %s:%d' %(_root.online_ip, _root.port))
 	print('  private: %s:%d' %(_root.local_ip, _root.port))
 	
-	clean_loop = task.LoopingCall(_root.scheduled_clean)
+	clean_loop = task.LoopingCall(_root.watchdog.wrap('scheduled_clean', _root.scheduled_clean))
 	clean_loop.start(60*60*24)
 	
-	event_loop = task.LoopingCall(_root.channel_mute_ban_timeout)
+	event_loop = task.LoopingCall(_root.watchdog.wrap('channel_mute_ban_timeout', _root.channel_mute_ban_timeout))
 	event_loop.start(1)
-	recent_registration_loop = task.LoopingCall(_root.decrement_recent_registrations)
+	idle_loop = task.LoopingCall(_root.watchdog.wrap('idle_timeouts', _root.idle_wheel.sweep))
+	idle_loop.start(1, False)
+	detached_loop = task.LoopingCall(_root.watchdog.wrap('expire_detached', _root.expire_detached))
+	detached_loop.start(1, False)
+	session_end_loop = task.LoopingCall(_root.watchdog.wrap('flush_ended_sessions', _root.flush_ended_sessions))
+	session_end_loop.start(1)
+	snapshot_loop = task.LoopingCall(_root.watchdog.wrap('write_snapshot', _root.write_snapshot))
+	snapshot_loop.start(60*10, False)
+	recent_registration_loop = task.LoopingCall(_root.watchdog.wrap('decrement_recent_registrations', _root.decrement_recent_registrations))
 	recent_registration_loop.start(60*20)
-	recent_rename_loop = task.LoopingCall(_root.decrement_recent_renames)
+	recent_rename_loop = task.LoopingCall(_root.watchdog.wrap('decrement_recent_renames', _root.decrement_recent_renames))
 	recent_rename_loop.start(60*60*24*7)
+	if _root.capture:
+		capture_loop = task.LoopingCall(_root.capture.flush)
+		capture_loop.start(1, False)
+	_root.startup_phase('listeners')
+	_root.log_startup()
+	_root.detectOnlineIp()
+	_root.detectServerVersion()
 	
 	reactor.run()
 
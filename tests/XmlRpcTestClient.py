@@ -9,3 +9,5 @@ proxy = xmlrpc.client.ServerProxy("http://localhost:8300/")
 print(proxy.get_account_info("ubertest01", "t"))
 print(proxy.get_account_info("doesn'texist", "nope"))
 print(proxy.get_account_id("ubertest01"))
+print(proxy.get_account_ids(["ubertest01", "doesn'texist"]))
+print(proxy.get_usernames([proxy.get_account_id("ubertest01")]))
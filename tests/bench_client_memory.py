@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# coding=utf-8
+# This file is part of the uberserver (GPL v2 or later), see LICENSE
+# bytes per connected client, as allocated by Client.__init__ and a typical login + battle join
+#
+# usage: bench_client_memory.py [number of clients] [path/to/Client.py]
+# pass an older Client.py (e.g. from git show) to compare against it
+
+import os
+import sys
+import gc
+import time
+import tracemalloc
+import importlib.util
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'protocol'))
+
+NUM_CLIENTS = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+CLIENT_PY = sys.argv[2] if len(sys.argv) > 2 else os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'Client.py')
+
+spec = importlib.util.spec_from_file_location('bench_client', CLIENT_PY)
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+
+class DummyRoot:
+	online_ip = None
+	local_ip = None
+
+class Transport: # stands in for twisted's Protocol, a base without __slots__ like in twistedserver.Chat
+	pass
+
+class Chat(Transport, module.Client):
+	def __init__(self, root, address, session_id):
+		self.root = root
+		self.TLS = False
+		self.transport = None
+		module.Client.__init__(self, root, address, session_id)
+
+def login(client, i):
+	# the fields LOGIN and JOINBATTLE fill in
+	client.username = 'user%05d' % i
+	client.user_id = i
+	client.access = 'user'
+	client.accesslevels = ['user', 'everyone']
+	client.logged_in = True
+	client.compat = set(['b', 'sp', 'u', 'cl'])
+	client.agent = 'SpringLobby 0.270 (win x32)'
+	client.channels = set(['main', 'newbies'])
+	client.current_battle = 1
+	if isinstance(client.battlestatus, dict):
+		client.battlestatus.update({'ready': '1', 'id': '0010', 'ally': '0001', 'mode': '1', 'sync': '01', 'side': '0001'})
+	else:
+		client.set_battlestatus(0x1400c4a)
+
+def measure(create):
+	gc.collect()
+	tracemalloc.start()
+	before = tracemalloc.get_traced_memory()[0]
+	start = time.time()
+	clients = [create(i) for i in range(NUM_CLIENTS)]
+	duration = time.time() - start
+	after = tracemalloc.get_traced_memory()[0]
+	tracemalloc.stop()
+	return (after - before) / NUM_CLIENTS, duration, clients
+
+def connected(i):
+	return Chat(DummyRoot(), ('10.0.%d.%d' % (i // 256 % 256, i % 256), 50000 + i % 10000), i)
+
+def logged_in(i):
+	client = connected(i)
+	login(client, i)
+	return client
+
+print('%s, %d clients' % (CLIENT_PY, NUM_CLIENTS))
+for name, create in (('connected', connected), ('logged in, in battle', logged_in)):
+	per_client, duration, clients = measure(create)
+	print('%-22s %6.0f bytes/client  %.2fs' % (name, per_client, duration))
+
+client = clients[0]
+start = time.time()
+for i in range(1000000):
+	client.username
+	client.logged_in
+print('%-22s %6.0f ns/attribute read' % ('attribute access', (time.time() - start) * 1000 / 2))
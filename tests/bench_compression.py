@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# coding=utf-8
+# This file is part of the uberserver (GPL v2 or later), see LICENSE
+# bytes saved against cpu spent by COMPRESS, for a login burst and for chat, per zlib level
+#
+# usage: bench_compression.py [number of online users] [chat lines]
+#
+# the login burst is flushed once (one reactor iteration), chat is flushed after every line (the worst case)
+# and after every 10 lines (a busy channel)
+
+import os
+import sys
+import random
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Compression
+
+NUM_USERS = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+NUM_LINES = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+
+random.seed(1)
+AGENTS = ['SpringLobby 0.270 (win x32)', 'Chobby:0.10.22 (linux)', 'SPADS 0.12.30', 'SpringLobby 0.270-28-g4d6fe6b (lin x64)', 'Weblobby']
+WORDS = 'gg anyone up for a game on comet catcher redux need one more player for team game ready when you are spec me please'.split()
+
+def login_burst():
+	lines = []
+	names = ['Player%d' % i for i in range(NUM_USERS)]
+	for i, name in enumerate(names):
+		lines.append('ADDUSER %s %s %d %s' % (name, random.choice(['DE', 'US', 'RU', 'FR', 'PL', 'SE']), 100000 + i, random.choice(AGENTS)))
+	for battle_id in range(NUM_USERS // 20):
+		lines.append('BATTLEOPENED %d 0 0 %s 127.0.0.1 8452 16 0 0 -1223456 Spring\t105.0\tComet Catcher Redux\tTeam game, all welcome\tBalanced Annihilation V9.79\t__battle__%d' % (battle_id, names[battle_id], battle_id))
+		lines.append('UPDATEBATTLEINFO %d 0 0 -1223456 Comet Catcher Redux' % battle_id)
+		for j in range(8):
+			lines.append('JOINEDBATTLE %d %s' % (battle_id, random.choice(names)))
+	for name in names:
+		if random.random() < 0.3:
+			lines.append('CLIENTSTATUS %s %d' % (name, random.choice([1, 2, 3, 16, 32])))
+	return [('\n'.join(lines) + '\n').encode()]
+
+def chat(per_flush):
+	batches = []
+	batch = []
+	for i in range(NUM_LINES):
+		batch.append('SAID main Player%d %s' % (random.randrange(NUM_USERS), ' '.join(random.choice(WORDS) for j in range(random.randrange(2, 12)))))
+		if len(batch) == per_flush:
+			batches.append(('\n'.join(batch) + '\n').encode())
+			batch = []
+	return batches
+
+def measure(batches, level):
+	compressor = Compression.Compressor(level)
+	for data in batches:
+		compressor.write(data)
+		compressor.flush()
+	return compressor
+
+print('%d users, %d chat lines' % (NUM_USERS, NUM_LINES))
+print('%-22s %5s %10s %10s %6s %10s' % ('workload', 'level', 'bytes in', 'bytes out', 'ratio', 'us/KB in'))
+for name, batches in (('login burst', login_burst()), ('chat, flush per line', chat(1)), ('chat, 10 lines/flush', chat(10))):
+	for level in (1, 3, 6, 9):
+		compressor = measure(batches, level)
+		print('%-22s %5d %10d %10d %5.0f%% %10.2f' % (name, level, compressor.bytes_in, compressor.bytes_out, 100.0 * compressor.bytes_out / compressor.bytes_in, 1e6 * compressor.seconds / (compressor.bytes_in / 1024.0)))
@@ -0,0 +1,41 @@
+#!/usr/bin/python3
+# lookups/sec of the csv range db against the GeoIP binding, uncached and with the LRU cache
+import sys
+import os
+import time
+import random
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import ip2country
+
+if len(sys.argv) > 1:
+	ip2country.csvfile = sys.argv[1]
+
+n = 200000
+random.seed(0)
+ips = ["%d.%d.%d.%d" % (random.randint(1, 223), random.randint(0, 255), random.randint(0, 255), random.randint(1, 254)) for i in range(n)]
+hot_ips = [random.choice(ips[:1000]) for i in range(n)] # reconnecting clients
+
+def bench(name, func, ips):
+	start = time.time()
+	for ip in ips:
+		func(ip)
+	duration = time.time() - start
+	print("%-30s %10.0f lookups/sec" % (name, len(ips) / duration))
+
+dbs = []
+if os.path.isfile(ip2country.csvfile):
+	start = time.time()
+	rangedb = ip2country.RangeDB(ip2country.csvfile)
+	print("loaded %d ranges from %s in %.2fs" % (len(rangedb), ip2country.csvfile, time.time() - start))
+	dbs.append(("csv", rangedb))
+else:
+	print("no csv at %s, usage: %s [ranges.csv]" % (ip2country.csvfile, sys.argv[0]))
+try:
+	dbs.append(("GeoIP", ip2country.GeoIPDB(ip2country.dbfile)))
+except Exception as e:
+	print("GeoIP binding unavailable: %s" % str(e))
+
+for name, db in dbs:
+	bench(name + " uncached", db._lookup, ips)
+	bench(name + " cached, random ips", db.lookup, ips)
+	bench(name + " cached, hot ips", db.lookup, hot_ips)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# coding=utf-8
+# This file is part of the uberserver (GPL v2 or later), see LICENSE
+# handshake storm against a running server: many clients connect, send STLS and do the tls handshake
+#
+# usage: bench_tls_handshake.py [--host localhost] [--port 8200] [--connections 1000] [--concurrency 20] [--no-resume]
+#
+# every client thread offers the session of its previous connection, as a reconnecting lobby client would,
+# so the handshakes/s with and without --no-resume (or against an older server) show what resumption saves
+
+import ssl
+import time
+import socket
+import argparse
+import threading
+
+def readline(sock):
+	line = b''
+	while not line.endswith(b'\n'):
+		data = sock.recv(1)
+		if not data:
+			raise ConnectionError('closed by the server')
+		line += data
+	return line.decode('utf-8').rstrip('\n')
+
+class Storm:
+	def __init__(self, address, connections, resume):
+		self.address = address
+		self.remaining = connections
+		self.resume = resume
+		self.lock = threading.Lock()
+		self.handshakes = [] # seconds per handshake
+		self.resumed = 0
+		self.failed = 0
+		self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+		self.context.check_hostname = False
+		self.context.verify_mode = ssl.CERT_NONE # the server's certificate is usually self signed
+
+	def take(self):
+		with self.lock:
+			if self.remaining <= 0:
+				return False
+			self.remaining -= 1
+			return True
+
+	def connect(self, session):
+		sock = socket.create_connection(self.address)
+		try:
+			readline(sock) # TASSERVER ...
+			sock.sendall(b'STLS\n')
+			while not readline(sock).startswith('OK'):
+				pass
+			start = time.time()
+			tls = self.context.wrap_socket(sock, session=session if self.resume else None)
+			duration = time.time() - start
+			readline(tls) # the greeting again, over tls; tls 1.3 tickets arrive with it
+			with self.lock:
+				self.handshakes.append(duration)
+				self.resumed += tls.session_reused
+			session = tls.session
+			tls.close()
+			return session
+		except (OSError, ssl.SSLError):
+			with self.lock:
+				self.failed += 1
+			sock.close()
+			return None
+
+	def client(self):
+		session = None
+		while self.take():
+			session = self.connect(session)
+
+	def run(self, concurrency):
+		threads = [threading.Thread(target=self.client) for i in range(concurrency)]
+		start = time.time()
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		return time.time() - start
+
+def percentile(values, q):
+	if not values:
+		return 0.0
+	values = sorted(values)
+	return values[min(len(values) - 1, int(q * len(values)))]
+
+def main():
+	parser = argparse.ArgumentParser(description='tls handshake storm against a running server')
+	parser.add_argument('--host', default='localhost')
+	parser.add_argument('--port', type=int, default=8200)
+	parser.add_argument('--connections', type=int, default=1000)
+	parser.add_argument('--concurrency', type=int, default=20)
+	parser.add_argument('--no-resume', dest='resume', action='store_false', help='never offer a session, every handshake is a full one')
+	args = parser.parse_args()
+
+	storm = Storm((args.host, args.port), args.connections, args.resume)
+	duration = storm.run(args.concurrency)
+	handshakes = storm.handshakes
+	print('%d handshakes (%d resumed, %d failed) in %.2fs: %.0f handshakes/s' % (len(handshakes), storm.resumed, storm.failed, duration, len(handshakes) / duration if duration else 0.0))
+	print('handshake time: p50 %.2fms, p90 %.2fms, p99 %.2fms' % tuple(1000 * percentile(handshakes, q) for q in (0.5, 0.9, 0.99)))
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# coding=utf-8
+# This file is part of the uberserver (GPL v2 or later), see LICENSE
+# replay page lookup mix against a running XmlRpcServer: per page the players are resolved
+# one by one (get_account_id / get_username) or with one batch call, some visitors log in
+
+import sys
+import time
+import random
+import threading
+import xmlrpc.client
+
+if len(sys.argv) < 3:
+	print("Usage: %s http://localhost:8300/ username[:password] ..." % sys.argv[0])
+	sys.exit(1)
+
+URL = sys.argv[1]
+USERS = [arg.split(':', 1) for arg in sys.argv[2:]]
+NUM_THREADS = 16
+DURATION = 20 # seconds
+PLAYERS_PER_REPLAY = 8
+
+proxy = xmlrpc.client.ServerProxy(URL)
+names = [u[0] for u in USERS]
+ids = list(proxy.get_account_ids(names).values())
+logins = [u for u in USERS if len(u) == 2]
+print("%d users, %d ids, %d with password" % (len(names), len(ids), len(logins)))
+
+def replay_page(proxy, batch):
+	players = random.sample(names, min(PLAYERS_PER_REPLAY, len(names)))
+	player_ids = random.sample(ids, min(PLAYERS_PER_REPLAY, len(ids)))
+	if batch:
+		proxy.get_account_ids(players)
+		proxy.get_usernames(player_ids)
+		return 2
+	for name in players:
+		proxy.get_account_id(name)
+	for account_id in player_ids:
+		proxy.get_username(account_id)
+	return len(players) + len(player_ids)
+
+def worker(batch, stats):
+	proxy = xmlrpc.client.ServerProxy(URL)
+	end = time.time() + DURATION
+	while time.time() < end:
+		start = time.time()
+		if logins and random.random() < 0.05:
+			username, password = random.choice(logins)
+			proxy.get_account_info(username, password)
+			calls = 1
+		else:
+			calls = replay_page(proxy, batch)
+		stats.append((time.time() - start, calls))
+
+for batch in (False, True):
+	stats = []
+	threads = [threading.Thread(target=worker, args=(batch, stats)) for i in range(NUM_THREADS)]
+	for t in threads: t.start()
+	for t in threads: t.join()
+	latencies = sorted(s[0] for s in stats)
+	calls = sum(s[1] for s in stats)
+	print("%s: %.0f pages/s, %.0f calls/s, page latency p50 %.1fms p99 %.1fms" % ("batch" if batch else "single",
+		len(stats) / DURATION, calls / DURATION, 1000 * latencies[len(latencies)//2], 1000 * latencies[int(len(latencies)*0.99)]))
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# coding=utf-8
+# This file is part of the uberserver (GPL v2 or later), see LICENSE
+# cluster mode over the real bus: starts two server processes, node 0 with the broker, sharing a fresh sqlite
+# db in a temp dir, and checks presence, chat and pms across the nodes, that the nat server only answers for
+# its own users, that 'bm' clients get remote users and statuses batched, that a user logging in on both nodes at once ends up with one session, and node loss
+#
+# usage: cluster_test.py [--port 8900] [--rounds 10]
+
+import os
+import sys
+import time
+import base64
+import socket
+import hashlib
+import argparse
+import tempfile
+import subprocess
+
+SERVER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'server.py')
+ADMIN, PASSWORD = 'clusteradmin', 'clusterpassword'
+
+def encode_password(password):
+	return base64.b64encode(hashlib.md5(password.encode()).digest()).decode()
+
+class Conn:
+	def __init__(self, port):
+		self.sock = socket.create_connection(('127.0.0.1', port))
+		self.sock.settimeout(0.05)
+		self.data = b''
+		self.lines = []
+		self.log = [] # every line, wait() does not drop these
+		self.closed = False
+
+	def send(self, line):
+		self.sock.sendall(line.encode('utf-8') + b'\n')
+
+	def read(self, timeout):
+		deadline = time.time() + timeout
+		while not self.closed and time.time() < deadline:
+			try:
+				data = self.sock.recv(65536)
+			except socket.timeout:
+				continue
+			except OSError:
+				data = b''
+			if not data:
+				self.closed = True
+				break
+			self.data += data
+			*lines, self.data = self.data.split(b'\n')
+			self.lines += [line.decode('utf-8') for line in lines]
+			self.log += self.lines[len(self.lines) - len(lines):]
+
+	def wait(self, prefix, timeout=5):
+		# the first line starting with prefix, dropping the lines before it, or None
+		deadline = time.time() + timeout
+		while True:
+			for i, line in enumerate(self.lines):
+				if line.startswith(prefix):
+					del self.lines[:i + 1]
+					return line
+			if self.closed or time.time() > deadline:
+				return None
+			self.read(0.05)
+
+	def knows(self, username):
+		# whether the last ADDUSER/REMOVEUSER this client got for username was an ADDUSER
+		for line in reversed(self.log):
+			words = line.split(' ')
+			if words[0] in ('ADDUSER', 'REMOVEUSER') and words[1:2] == [username]:
+				return words[0] == 'ADDUSER'
+		return False
+
+	def close(self):
+		self.sock.close()
+
+def connect(port):
+	conn = Conn(port)
+	conn.wait('TASSERVER')
+	return conn
+
+def send_login(conn, username, password='password', flags='sp u'):
+	conn.send('LOGIN %s %s 0 * cluster_test\t0\t%s' % (username, encode_password(password), flags))
+
+def login(port, username, flags='sp u'):
+	conn = connect(port)
+	send_login(conn, username, flags=flags)
+	return conn
+
+def register(port, username, password='password'):
+	conn = connect(port)
+	conn.send('REGISTER %s %s %s@example.com' % (username, encode_password(password), username))
+	ok = conn.wait('REGISTRATION') == 'REGISTRATIONACCEPTED'
+	send_login(conn, username, password, 'sp')
+	if conn.wait(('AGREEMENTEND', 'ACCEPTED')) == 'AGREEMENTEND':
+		conn.send('CONFIRMAGREEMENT')
+	conn.send('PING')
+	ok = ok and conn.wait('PONG') is not None
+	conn.close()
+	return ok
+
+def nat_pong(port, username, timeout=1):
+	sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+	sock.settimeout(timeout)
+	try:
+		sock.sendto(username.encode('utf-8'), ('127.0.0.1', port))
+		return sock.recv(16) == b'PONG'
+	except OSError:
+		return False
+	finally:
+		sock.close()
+
+def start_server(args, tmpdir, node, stdin=b''):
+	port = args.port + 10 * node
+	command = [sys.executable, SERVER, '--port', str(port), '--natport', str(port + 1), '--ip', '127.0.0.1',
+		'--sqlurl', 'sqlite:///%s' % os.path.join(tmpdir, 'server.db'),
+		'--cluster', os.path.join(tmpdir, 'cluster.sock'), '--node', str(node)]
+	if node == 0:
+		command.append('--cluster_broker')
+	process = subprocess.Popen(command, cwd=os.path.dirname(SERVER), stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+		start_new_session=True) # no controlling tty, so getpass reads the admin password from stdin
+	process.stdin.write(stdin)
+	process.stdin.close()
+	return process, port
+
+def wait_listening(port, timeout=60):
+	deadline = time.time() + timeout
+	while time.time() < deadline:
+		try:
+			socket.create_connection(('127.0.0.1', port)).close()
+			return True
+		except OSError:
+			time.sleep(0.2)
+	return False
+
+def check(results, name, ok):
+	results.append(ok)
+	print('%-60s %s' % (name, 'ok' if ok else 'FAILED'))
+
+def main():
+	parser = argparse.ArgumentParser(description='two cluster nodes over the real bus socket')
+	parser.add_argument('--port', type=int, default=8900)
+	parser.add_argument('--rounds', type=int, default=10, help='logins on both nodes at once')
+	args = parser.parse_args()
+
+	tmpdir = tempfile.mkdtemp(prefix='cluster_test')
+	processes = []
+	results = []
+	try:
+		first, port0 = start_server(args, tmpdir, 0, ('%s\n%s\n' % (ADMIN, PASSWORD)).encode())
+		processes.append(first)
+		if not wait_listening(port0):
+			print('node 0 did not start')
+			return 1
+		second, port1 = start_server(args, tmpdir, 1)
+		processes.append(second)
+		if not wait_listening(port1):
+			print('node 1 did not start')
+			return 1
+
+		names = ['alice', 'bobby', 'carol'] + ['double%d' % i for i in range(args.rounds)]
+		check(results, 'register %d users' % len(names), all(register(port0, name) for name in names))
+
+		# presence and chat across the nodes
+		alice = login(port0, 'alice')
+		check(results, 'alice logs in on node 0', alice.wait('ACCEPTED') is not None)
+		bobby = login(port1, 'bobby')
+		check(results, 'bobby logs in on node 1', bobby.wait('ACCEPTED') is not None)
+		check(results, 'bobby gets alice in the login info', bobby.wait('ADDUSER alice') is not None)
+		check(results, 'alice hears of bobby', alice.wait('ADDUSER bobby') is not None)
+		alice.send('JOIN clustertest')
+		bobby.send('JOIN clustertest')
+		alice.wait('JOIN clustertest')
+		bobby.wait('JOIN clustertest')
+		alice.send('SAY clustertest hello from node 0')
+		check(results, 'SAY reaches the other node', bobby.wait('SAID clustertest alice hello from node 0') is not None)
+		bobby.send('SAYPRIVATE alice hello from node 1')
+		check(results, 'SAYPRIVATE reaches the other node', alice.wait('SAIDPRIVATE bobby hello from node 1') is not None)
+
+		# 'bm' clients get the users and statuses of the other node batched
+		carol = login(port1, 'carol', 'sp u bm')
+		carol.wait('ACCEPTED')
+		carol.wait('LOGININFOEND')
+		check(results, "a 'bm' client gets remote users in ADDUSERS", any(line.startswith('ADDUSERS') and '\talice ' in '\t' + line[len('ADDUSERS '):] for line in carol.log))
+		alice.send('MYSTATUS 2') # away
+		check(results, 'a status change reaches the other node', bobby.wait('CLIENTSTATUS alice 2') is not None)
+		check(results, "and is batched for 'bm' clients there", carol.wait('CLIENTSTATUSES alice 2') is not None and not 'CLIENTSTATUS alice 2' in carol.log)
+
+		# udp goes to the node the user is logged in on
+		check(results, 'nat server answers for its own user', nat_pong(port1 + 1, 'bobby'))
+		check(results, 'nat server ignores a user of the other node', not nat_pong(port1 + 1, 'alice'))
+
+		# the same user on both nodes at once: one session stays, the same on both nodes
+		kept = agreed = 0
+		for name in names[3:]:
+			conns = [connect(port0), connect(port1)]
+			for conn in conns:
+				send_login(conn, name)
+			for conn in conns + [alice, bobby]:
+				conn.read(1)
+			logged_in = [conn for conn in conns if any(line.startswith('ACCEPTED') for line in conn.log) and not conn.closed]
+			kept += len(logged_in) == 1
+			agreed += alice.knows(name) and bobby.knows(name)
+			for conn in conns:
+				conn.close()
+		rounds = len(names) - 3
+		check(results, 'one session stays of %d logins on both nodes at once' % rounds, kept == rounds)
+		check(results, 'both nodes list that session', agreed == rounds)
+
+		# node loss
+		second.terminate()
+		second.wait()
+		check(results, 'node 0 drops the users of a lost node', alice.wait('REMOVEUSER bobby', 10) is not None)
+	finally:
+		for process in processes:
+			if process.poll() is None:
+				process.terminate()
+				process.wait()
+
+	print('ok' if all(results) else 'FAILED')
+	return 0 if all(results) else 1
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+# coding=utf-8
+# This file is part of the uberserver (GPL v2 or later), see LICENSE
+# zero downtime restart: starts a server with --handoff, opens many connections, starts a second server
+# that takes them over, and checks that no client was disconnected and that sessions survived
+#
+# usage: handoff_test.py [--connections 3000] [--port 8700]
+#
+# runs both servers from this checkout with a fresh sqlite db in a temp dir. all clients ping in rounds
+# the whole time, the longest round shows how long clients waited during the switch. the servers get a
+# --login_timeout of an hour, so the server doesn't kick the unauthenticated connections during the test
+
+import os
+import sys
+import time
+import base64
+import socket
+import hashlib
+import argparse
+import resource
+import tempfile
+import selectors
+import subprocess
+
+SERVER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'server.py')
+ADMIN, PASSWORD = 'handoffadmin', 'handoffpassword'
+
+class Conn:
+	def __init__(self, address):
+		self.sock = socket.create_connection(address)
+		self.sock.setblocking(False)
+		self.data = b''
+		self.lines = []
+		self.closed = False
+
+	def send(self, line):
+		self.sock.sendall(line.encode('utf-8') + b'\n')
+
+	def read(self):
+		try:
+			data = self.sock.recv(65536)
+		except (BlockingIOError, InterruptedError):
+			return
+		except OSError:
+			data = b''
+		if not data:
+			self.closed = True
+			return
+		self.data += data
+		*lines, self.data = self.data.split(b'\n')
+		self.lines += [line.decode('utf-8') for line in lines]
+
+	def take(self, prefix):
+		for i, line in enumerate(self.lines):
+			if line.startswith(prefix):
+				del self.lines[:i + 1]
+				return line
+		return None
+
+class Clients:
+	def __init__(self):
+		self.selector = selectors.DefaultSelector()
+		self.conns = []
+
+	def add(self, conn):
+		self.conns.append(conn)
+		self.selector.register(conn.sock, selectors.EVENT_READ, conn)
+
+	def poll(self, timeout=0.05):
+		for key, events in self.selector.select(timeout):
+			key.data.read()
+			if key.data.closed:
+				self.selector.unregister(key.data.sock)
+
+	def wait(self, conns, prefix, timeout):
+		# waits until each of conns got a line starting with prefix, returns those that didn't
+		waiting = set(conns)
+		deadline = time.time() + timeout
+		while waiting and time.time() < deadline:
+			self.poll()
+			waiting = set(conn for conn in waiting if not conn.closed and conn.take(prefix) is None)
+		return waiting | set(conn for conn in conns if conn.closed)
+
+def start_server(args, tmpdir, stdin=b''):
+	process = subprocess.Popen([sys.executable, SERVER,
+			'--port', str(args.port), '--natport', str(args.port + 1), '--ip', '127.0.0.1',
+			'--sqlurl', 'sqlite:///%s' % os.path.join(tmpdir, 'server.db'), '--snapshot', '--login_timeout', '3600',
+			'--handoff', os.path.join(tmpdir, 'handoff.sock')],
+		cwd=os.path.dirname(SERVER), stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+		start_new_session=True) # no controlling tty, so getpass reads the admin password from stdin
+	process.stdin.write(stdin)
+	process.stdin.close()
+	return process
+
+def wait_listening(port, timeout=60):
+	deadline = time.time() + timeout
+	while time.time() < deadline:
+		try:
+			socket.create_connection(('127.0.0.1', port)).close()
+			return True
+		except OSError:
+			time.sleep(0.2)
+	return False
+
+def ping_round(clients, conns, timeout=30):
+	start = time.time()
+	for conn in conns:
+		if not conn.closed:
+			try:
+				conn.send('PING')
+			except OSError:
+				conn.closed = True
+	failed = clients.wait(conns, 'PONG', timeout)
+	return time.time() - start, failed
+
+def nat_pong(port, username, timeout=5):
+	# the new server must have got the udp port of the old one
+	sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+	sock.settimeout(timeout)
+	try:
+		sock.sendto(username.encode('utf-8'), ('127.0.0.1', port))
+		return sock.recv(16) == b'PONG'
+	except OSError:
+		return False
+	finally:
+		sock.close()
+
+def main():
+	parser = argparse.ArgumentParser(description='hands off connections from one server process to another')
+	parser.add_argument('--connections', type=int, default=3000)
+	parser.add_argument('--port', type=int, default=8700)
+	args = parser.parse_args()
+
+	soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+	resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard)) # the servers inherit it
+	if hard < 2 * args.connections + 100:
+		print('open file limit %d is too low for %d connections' % (hard, args.connections))
+		return 1
+
+	tmpdir = tempfile.mkdtemp(prefix='handoff_test')
+	old = start_server(args, tmpdir, ('%s\n%s\n' % (ADMIN, PASSWORD)).encode())
+	new = None
+	try:
+		if not wait_listening(args.port):
+			print('the first server did not start')
+			return 1
+		clients = Clients()
+		start = time.time()
+		for i in range(args.connections):
+			clients.add(Conn(('127.0.0.1', args.port)))
+		missing = clients.wait(clients.conns, 'TASSERVER', 30)
+		print('%d connections in %.2fs, %d without greeting' % (len(clients.conns), time.time() - start, len(missing)))
+
+		# one logged in session, in a channel
+		admin = clients.conns[0]
+		password = base64.b64encode(hashlib.md5(PASSWORD.encode()).digest()).decode()
+		admin.send('LOGIN %s %s 0 * handoff_test\t0\tsp u' % (ADMIN, password))
+		if clients.wait([admin], 'ACCEPTED', 10):
+			print('could not log in')
+			return 1
+		admin.send('JOIN handofftest')
+		if clients.wait([admin], 'JOIN handofftest', 10):
+			print('could not join a channel')
+			return 1
+
+		seconds, failed = ping_round(clients, clients.conns)
+		print('ping round before the handoff: %.2fs, %d failed' % (seconds, len(failed)))
+
+		new = start_server(args, tmpdir)
+		rounds = []
+		while old.poll() is None:
+			rounds.append(ping_round(clients, clients.conns))
+			time.sleep(max(0, 0.1 - rounds[-1][0])) # with few clients, rounds back to back would hit the flood limit
+		print('old server exited with %d after %d ping rounds, longest %.2fs' % (old.returncode, len(rounds), max([r[0] for r in rounds] or [0])))
+		seconds, failed = ping_round(clients, clients.conns)
+		print('ping round after the handoff: %.2fs' % seconds)
+
+		admin.send('SAY handofftest still here')
+		session_kept = not clients.wait([admin], 'SAID handofftest %s still here' % ADMIN, 10)
+		fresh = Conn(('127.0.0.1', args.port))
+		clients.add(fresh)
+		accepting = not clients.wait([fresh], 'TASSERVER', 10)
+		nat = nat_pong(args.port + 1, ADMIN)
+
+		disconnected = [conn for conn in clients.conns if conn.closed]
+		print('%d of %d clients disconnected, %d did not answer the last ping' % (len(disconnected), args.connections, len(failed)))
+		print('logged in session kept: %s, new connections accepted: %s, nat server answers: %s' % (session_kept, accepting, nat))
+		ok = old.returncode == 0 and not disconnected and not failed and session_kept and accepting and nat
+		print('ok' if ok else 'FAILED')
+		return 0 if ok else 1
+	finally:
+		for process in (old, new):
+			if process and process.poll() is None:
+				process.terminate()
+				process.wait()
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# coding=utf-8
+# This file is part of the uberserver (GPL v2 or later), see LICENSE
+# floods a local NATServer with UDP packets from one ip, checks that it rate limits and only answers logged in users
+
+import os
+import sys
+import time
+import socket
+import threading
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from twisted.internet import reactor
+import NATServer
+
+NUM_PACKETS = 50000
+
+class DummyProtocol:
+	def __init__(self):
+		self.udp_packets = []
+	def _udp_packet(self, username, ip, udpport):
+		self.udp_packets.append((username, ip, udpport))
+
+class DummyRoot:
+	def __init__(self):
+		self.usernames = {'tester': None}
+		self.protocol = DummyProtocol()
+
+root = DummyRoot()
+natserver = NATServer.NATServer(root)
+port = reactor.listenUDP(0, natserver, interface='127.0.0.1').getHost().port
+results = {}
+
+def flood():
+	s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+	s.settimeout(0.5)
+	start = time.time()
+	for i in range(NUM_PACKETS):
+		s.sendto(b'tester\n' if i % 2 else b'nobody\n', ('127.0.0.1', port))
+	results['duration'] = time.time() - start
+	pongs = 0
+	try:
+		while True:
+			if s.recv(16) == b'PONG':
+				pongs += 1
+	except socket.timeout:
+		pass
+	results['pongs'] = pongs
+	s.close()
+	reactor.callFromThread(reactor.stop)
+
+reactor.callLater(0.1, reactor.callInThread, flood)
+reactor.run()
+
+seconds = int(results['duration']) + 2 # windows the flood may have been spread over
+print("sent %d packets in %.2fs, server received %d, dropped %d, answered %d" % (NUM_PACKETS, results['duration'], natserver.received, natserver.dropped, results['pongs']))
+assert(natserver.received > 0)
+assert(natserver.received - natserver.dropped <= natserver.max_packets * seconds)
+assert(results['pongs'] == len(root.protocol.udp_packets))
+assert(0 < results['pongs'] <= natserver.max_packets * seconds)
+assert(all(p[0] == 'tester' for p in root.protocol.udp_packets))
+print("Test ok!")
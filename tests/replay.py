@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+# coding=utf-8
+# This file is part of the uberserver (GPL v2 or later), see LICENSE
+# replays a capture written by server.py --capture against a (fresh) server over real sockets
+#
+# usage: replay.py capture.txt [--host localhost] [--port 8200] [--speed 1] [--register]
+#                              [--drain 2] [--save result.json] [--compare old_result.json]
+#
+# --speed 1 replays at the recorded pace, 0 as fast as possible, other values scale the pace
+# every line gets a #msg_id, the time to the first reply carrying it is the latency of that command,
+# for LOGIN the time to ACCEPTED or DENIED, which the server sends without the #msg_id
+# a disconnect or EXIT waits (up to a second) for the replies of its session, so fast replays keep the output
+# redacted passwords are replaced by one replay password, --register sends REGISTER before each LOGIN
+# STLS lines are skipped, the replay stays on plain tcp
+# --save writes throughput, latency percentiles and per session output bytes/commands as json,
+# --compare prints where the output of this run differs from a saved one (e.g. of another server version)
+
+import os
+import sys
+import json
+import time
+import base64
+import socket
+import hashlib
+import argparse
+import selectors
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import TrafficCapture
+
+REPLAY_PASSWORD = base64.b64encode(hashlib.md5(b'replay').digest()).decode()
+
+class Session:
+	def __init__(self, session_id, address):
+		self.session_id = session_id
+		self.sock = socket.create_connection(address)
+		self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		self.sock.setblocking(False)
+		self.data = b''
+		self.pending = set() # msg_ids sent on this session without reply yet
+		self.login = None # msg_id of the last LOGIN, the server sends ACCEPTED/DENIED without it
+
+	def send(self, line):
+		data = line.encode('utf-8') + b'\n'
+		sent = 0
+		while sent < len(data): # small lines, the kernel buffer is rarely full
+			try:
+				sent += self.sock.send(data[sent:])
+			except BlockingIOError:
+				time.sleep(0.001)
+
+	def close(self):
+		self.sock.close()
+
+class Replay:
+	def __init__(self, address, speed, register):
+		self.address = address
+		self.speed = speed
+		self.register = register
+		self.selector = selectors.DefaultSelector()
+		self.sessions = {} # captured session id -> Session
+		self.pending = {} # msg_id -> time sent
+		self.latencies = []
+		self.sent = 0
+		self.skipped = 0
+		self.msg_id = 0
+		self.output = {} # captured session id -> {'bytes': n, 'commands': {cmd: n}}, kept after disconnect
+		self.reply_timeout = 1.0 # seconds a disconnect waits for the replies of the session
+
+	def prepare(self, line):
+		words = line.split(' ')
+		if words[0].startswith('#'): # the client's own msg_id is replaced by ours
+			words = words[1:]
+		command = words[0].upper()
+		if command == 'STLS':
+			return []
+		words = [REPLAY_PASSWORD if w == TrafficCapture.REDACTED and i in [p + 1 for p in TrafficCapture.PASSWORD_ARGS.get(command, ())] else w for i, w in enumerate(words)]
+		lines = [' '.join(words)]
+		if command == 'LOGIN' and self.register and len(words) > 2:
+			lines.insert(0, 'REGISTER %s %s' % (words[1], REPLAY_PASSWORD))
+		return lines
+
+	def event(self, session_id, kind, line):
+		if kind == '+':
+			session = Session(session_id, self.address)
+			self.sessions[session_id] = session
+			self.output[session_id] = {'bytes': 0, 'commands': {}}
+			self.selector.register(session.sock, selectors.EVENT_READ, session)
+		elif kind == '-':
+			session = self.sessions.pop(session_id, None)
+			if session:
+				self.wait_replies(session)
+				self.read(session)
+				self.selector.unregister(session.sock)
+				session.close()
+		elif kind == '>':
+			session = self.sessions.get(session_id)
+			if not session:
+				self.skipped += 1 # connected before the capture started
+				return
+			lines = self.prepare(line)
+			if not lines:
+				self.skipped += 1
+			for line in lines:
+				if line.split(' ')[0].upper() == 'EXIT':
+					self.wait_replies(session) # the server aborts the connection, unread output would be lost
+				self.msg_id += 1
+				self.pending[self.msg_id] = time.time()
+				session.pending.add(self.msg_id)
+				if line.split(' ')[0].upper() == 'LOGIN':
+					session.login = self.msg_id
+				session.send('#%d %s' % (self.msg_id, line))
+				self.sent += 1
+
+	def wait_replies(self, session):
+		deadline = time.time() + self.reply_timeout
+		while session.pending and time.time() < deadline:
+			self.poll(deadline - time.time())
+
+	def read(self, session):
+		try:
+			while True:
+				data = session.sock.recv(65536)
+				if not data:
+					break
+				self.received(session, data)
+		except (BlockingIOError, ConnectionError):
+			pass
+
+	def received(self, session, data):
+		now = time.time()
+		output = self.output[session.session_id]
+		output['bytes'] += len(data)
+		lines = (session.data + data).split(b'\n')
+		session.data = lines.pop()
+		for line in lines:
+			words = line.decode('utf-8', 'replace').split(' ', 2)
+			msg_id = None
+			if words[0].startswith('#'):
+				try:
+					msg_id = int(words[0][1:])
+				except ValueError:
+					pass
+				words = words[1:]
+			elif words[0] in ('ACCEPTED', 'DENIED'):
+				msg_id = session.login
+			if msg_id in self.pending:
+				self.latencies.append(now - self.pending.pop(msg_id))
+				session.pending.discard(msg_id)
+			command = words[0] if words else ''
+			output['commands'][command] = output['commands'].get(command, 0) + 1
+
+	def poll(self, timeout):
+		for key, mask in self.selector.select(timeout):
+			self.read(key.data)
+
+	def run(self, events, drain):
+		start = time.time()
+		for seconds, session_id, kind, line in events:
+			if self.speed:
+				due = start + seconds / self.speed
+				while time.time() < due:
+					self.poll(due - time.time())
+			else:
+				self.poll(0)
+			self.event(session_id, kind, line)
+		end = time.time()
+		deadline = end + drain
+		while time.time() < deadline:
+			self.poll(deadline - time.time())
+		for session_id in list(self.sessions):
+			self.event(session_id, '-', None)
+		return end - start
+
+def percentile(values, q):
+	if not values:
+		return 0.0
+	values = sorted(values)
+	return values[min(len(values) - 1, int(q * len(values)))]
+
+def compare(result, old):
+	# sessions are matched by their captured session id
+	print("output bytes: %d now, %d before (%+d)" % (result['output_bytes'], old['output_bytes'], result['output_bytes'] - old['output_bytes']))
+	differences = 0
+	for session_id in sorted(set(result['sessions']) | set(old['sessions']), key=int):
+		new_output = result['sessions'].get(session_id, {'bytes': 0, 'commands': {}})
+		old_output = old['sessions'].get(session_id, {'bytes': 0, 'commands': {}})
+		if new_output == old_output:
+			continue
+		differences += 1
+		commands = []
+		for command in sorted(set(new_output['commands']) | set(old_output['commands'])):
+			n, o = new_output['commands'].get(command, 0), old_output['commands'].get(command, 0)
+			if n != o:
+				commands.append('%s %+d' % (command, n - o))
+		print(" session %s: %d bytes now, %d before; %s" % (session_id, new_output['bytes'], old_output['bytes'], ', '.join(commands) or 'same commands'))
+	print("%d of %d sessions differ" % (differences, len(result['sessions'])))
+
+def main():
+	parser = argparse.ArgumentParser(description='replay a server.py --capture file')
+	parser.add_argument('capture')
+	parser.add_argument('--host', default='localhost')
+	parser.add_argument('--port', type=int, default=8200)
+	parser.add_argument('--speed', type=float, default=1.0, help='1 = recorded pace, 0 = as fast as possible')
+	parser.add_argument('--register', action='store_true', help='send REGISTER before each LOGIN')
+	parser.add_argument('--drain', type=float, default=2.0, help='seconds to wait for replies at the end')
+	parser.add_argument('--save', help='write the results as json')
+	parser.add_argument('--compare', help='json of an earlier run to compare the output with')
+	args = parser.parse_args()
+
+	events = list(TrafficCapture.read(args.capture))
+	replay = Replay((args.host, args.port), args.speed, args.register)
+	duration = replay.run(events, args.drain)
+
+	latencies = replay.latencies
+	result = {
+		'events': len(events),
+		'sent': replay.sent,
+		'skipped': replay.skipped,
+		'seconds': duration,
+		'lines_per_second': replay.sent / duration if duration else 0.0,
+		'replies': len(latencies),
+		'latency_ms': dict((q, 1000 * percentile(latencies, float(q) / 100)) for q in ('50', '90', '99', '100')),
+		'output_bytes': sum(o['bytes'] for o in replay.output.values()),
+		'sessions': dict((str(k), v) for k, v in replay.output.items()),
+	}
+	print("replayed %d lines of %d events (%d skipped) in %.2fs: %.0f lines/s" % (replay.sent, len(events), replay.skipped, duration, result['lines_per_second']))
+	print("latency of %d replied commands: p50 %.2fms, p90 %.2fms, p99 %.2fms, max %.2fms" % ((len(latencies),) + tuple(result['latency_ms'][q] for q in ('50', '90', '99', '100'))))
+	print("received %d bytes in %d sessions" % (result['output_bytes'], len(result['sessions'])))
+	if args.save:
+		with open(args.save, 'w') as f:
+			json.dump(result, f, indent=1, sort_keys=True)
+	if args.compare:
+		with open(args.compare) as f:
+			compare(result, json.load(f))
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+# coding=utf-8
+# This file is part of the uberserver (GPL v2 or later), see LICENSE
+# session resume: starts a server with a short --resume_grace and --capture, drops the connection of a
+# client with the 'rs' compat flag, sends it a SAID and a SAIDPRIVATE while it is detached, RESUMEs it on a
+# new connection and checks the queued lines arrive, that bad tokens fail, that the capture goes on under
+# the old session id, and that a session that is not resumed in time is ended
+#
+# usage: resume_test.py [--port 8950] [--grace 3]
+
+import os
+import sys
+import time
+import base64
+import socket
+import hashlib
+import argparse
+import tempfile
+import subprocess
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import TrafficCapture
+
+SERVER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'server.py')
+ADMIN, PASSWORD = 'resumeadmin', 'resumepassword'
+
+def encode_password(password):
+	return base64.b64encode(hashlib.md5(password.encode()).digest()).decode()
+
+class Conn:
+	def __init__(self, port):
+		self.sock = socket.create_connection(('127.0.0.1', port))
+		self.sock.settimeout(0.05)
+		self.data = b''
+		self.lines = []
+		self.closed = False
+
+	def send(self, line):
+		self.sock.sendall(line.encode('utf-8') + b'\n')
+
+	def read(self, timeout):
+		deadline = time.time() + timeout
+		while not self.closed and time.time() < deadline:
+			try:
+				data = self.sock.recv(65536)
+			except socket.timeout:
+				continue
+			except OSError:
+				data = b''
+			if not data:
+				self.closed = True
+				break
+			self.data += data
+			*lines, self.data = self.data.split(b'\n')
+			self.lines += [line.decode('utf-8') for line in lines]
+
+	def wait(self, prefix, timeout=5):
+		# the first line starting with prefix, dropping the lines before it, or None
+		deadline = time.time() + timeout
+		while True:
+			for i, line in enumerate(self.lines):
+				if line.startswith(prefix):
+					del self.lines[:i + 1]
+					return line
+			if self.closed or time.time() > deadline:
+				return None
+			self.read(0.05)
+
+	def close(self):
+		self.sock.close()
+
+def connect(port):
+	conn = Conn(port)
+	conn.wait('TASSERVER')
+	return conn
+
+def login(port, username, flags='sp u'):
+	conn = connect(port)
+	conn.send('LOGIN %s %s 0 * resume_test\t0\t%s' % (username, encode_password('password'), flags))
+	return conn
+
+def register(port, username):
+	conn = connect(port)
+	conn.send('REGISTER %s %s %s@example.com' % (username, encode_password('password'), username))
+	ok = conn.wait('REGISTRATION') == 'REGISTRATIONACCEPTED'
+	conn.send('LOGIN %s %s 0 * resume_test\t0\tsp' % (username, encode_password('password')))
+	if conn.wait(('AGREEMENTEND', 'ACCEPTED')) == 'AGREEMENTEND':
+		conn.send('CONFIRMAGREEMENT')
+	conn.send('PING')
+	ok = ok and conn.wait('PONG') is not None
+	conn.close()
+	return ok
+
+def start_server(args, tmpdir, stdin):
+	process = subprocess.Popen([sys.executable, SERVER,
+			'--port', str(args.port), '--natport', str(args.port + 1), '--ip', '127.0.0.1',
+			'--sqlurl', 'sqlite:///%s' % os.path.join(tmpdir, 'server.db'),
+			'--resume_grace', str(args.grace), '--capture', os.path.join(tmpdir, 'capture.txt')],
+		cwd=os.path.dirname(SERVER), stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+		start_new_session=True) # no controlling tty, so getpass reads the admin password from stdin
+	process.stdin.write(stdin)
+	process.stdin.close()
+	return process
+
+def wait_listening(port, timeout=60):
+	deadline = time.time() + timeout
+	while time.time() < deadline:
+		try:
+			socket.create_connection(('127.0.0.1', port)).close()
+			return True
+		except OSError:
+			time.sleep(0.2)
+	return False
+
+def check(results, name, ok):
+	results.append(ok)
+	print('%-60s %s' % (name, 'ok' if ok else 'FAILED'))
+
+def main():
+	parser = argparse.ArgumentParser(description='drops and resumes a session')
+	parser.add_argument('--port', type=int, default=8950)
+	parser.add_argument('--grace', type=int, default=3, help='--resume_grace of the server')
+	args = parser.parse_args()
+
+	tmpdir = tempfile.mkdtemp(prefix='resume_test')
+	server = start_server(args, tmpdir, ('%s\n%s\n' % (ADMIN, PASSWORD)).encode())
+	results = []
+	try:
+		if not wait_listening(args.port):
+			print('the server did not start')
+			return 1
+		check(results, 'register 2 users', register(args.port, 'alice') and register(args.port, 'bobby'))
+
+		alice = login(args.port, 'alice', 'sp u rs')
+		token = alice.wait('RESUMETOKEN')
+		check(results, 'alice gets a RESUMETOKEN at login', token is not None)
+		token = token.split(' ')[1] if token else ''
+		bobby = login(args.port, 'bobby')
+		bobby.wait('ACCEPTED')
+		for conn in (alice, bobby):
+			conn.send('JOIN resumetest')
+			conn.wait('JOIN resumetest')
+
+		# drop, and queue while detached
+		alice.close()
+		time.sleep(0.5)
+		bobby.send('SAY resumetest while you were away')
+		bobby.send('SAYPRIVATE alice psst')
+		bobby.send('PING')
+		bobby.wait('PONG')
+		check(results, 'the session stays while detached', bobby.wait('LEFT resumetest alice', 0.5) is None)
+
+		failed = connect(args.port)
+		failed.send('RESUME alice wrongtoken')
+		check(results, 'a wrong token fails', failed.wait('RESUMEFAILED') is not None)
+		failed.send('RESUME alice tökén')
+		check(results, 'a non-ascii token fails', failed.wait('RESUMEFAILED') is not None)
+		failed.send('PING')
+		check(results, 'and the connection goes on', failed.wait('PONG') is not None)
+		failed.close()
+
+		alice = connect(args.port)
+		alice.send('RESUME alice %s' % token)
+		check(results, 'RESUME with the token', alice.wait('RESUMED alice') is not None)
+		check(results, 'the queued SAID arrives', alice.wait('SAID resumetest bobby while you were away') is not None)
+		check(results, 'the queued SAIDPRIVATE arrives', alice.wait('SAIDPRIVATE bobby psst') is not None)
+		token = alice.wait('RESUMETOKEN')
+		check(results, 'with a new RESUMETOKEN', token is not None)
+		alice.send('SAY resumetest back again')
+		check(results, 'the resumed session talks in its channel', bobby.wait('SAID resumetest alice back again') is not None)
+
+		# expiry
+		alice.close()
+		check(results, 'a session not resumed in time is ended', bobby.wait('LEFT resumetest alice', args.grace + 5) is not None)
+		late = connect(args.port)
+		late.send('RESUME alice %s' % token.split(' ')[1])
+		check(results, 'RESUME after the grace period fails', late.wait('RESUMEFAILED') is not None)
+		late.close()
+		bobby.close()
+	finally:
+		server.terminate()
+		server.wait()
+
+	# the lines after RESUME are captured under the old session id, which connects again there
+	events = list(TrafficCapture.read(os.path.join(tmpdir, 'capture.txt')))
+	said = [e for e in events if e[2] == '>' and e[3] == 'SAY resumetest back again']
+	resumed = [e for e in events if e[2] == '>' and e[3].startswith('RESUME alice ') and e[3] != 'RESUME alice wrongtoken' and not 'ö' in e[3]]
+	ok = len(said) == 1 and len(resumed) == 2
+	if ok:
+		new_id, old_id = resumed[0][1], said[0][1]
+		ok = new_id != old_id and [e[1:3] for e in events if e[1] in (new_id, old_id) and e[2] != '>'] == [(old_id, '+'), (old_id, '-'), (new_id, '+'), (new_id, '-'), (old_id, '+'), (old_id, '-')]
+	check(results, 'the capture goes on under the old session id', ok)
+
+	print('ok' if all(results) else 'FAILED')
+	return 0 if all(results) else 1
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -1,25 +1,40 @@
 from twisted.internet.protocol import Factory
 from twisted.internet import protocol
-from twisted.protocols.policies import TimeoutMixin
+from twisted.internet import error
+from twisted.internet import reactor
+from twisted.python import failure
 from protocol import Protocol
 import DataHandler
 import Client
+import TrafficCapture
+import Frontend
+import Compression
+import Handoff
 import traceback
 import logging
 import resource
+import time
 
 maxhandles, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
 maxclients = int(maxhandles / 2)
 
-class Chat(protocol.Protocol, Client.Client, TimeoutMixin):
+class Chat(protocol.Protocol, Client.Client):
 
 	def __init__(self, root):
 		self.root = root
 		self.TLS = False
+		self.restore = None # state of a handed off connection, see Handoff.RestoreFactory
 		assert(self.root.userdb != None)
 
 	def connectionMade(self):
 		try:
+			if self.restore:
+				Handoff.restore_client(self.root, self, self.restore)
+				self.restore = None
+				self.connect_time = time.time()
+				self.root.idle_wheel.add(self)
+				return
+
 			clientcount = len(self.root.clients)
 			if clientcount >= maxclients:
 				logging.error("to many connections: %d > %d" %(clientcount, maxclients))
@@ -31,9 +46,12 @@ class Chat(protocol.Protocol, Client.Client, TimeoutMixin):
 			self.session_id = self.root.session_id
 			assert(self.session_id not in self.root.clients)
 			self.root.clients[self.session_id] = self
-			self.setTimeout(60)
 			peer = (self.transport.getPeer().host, self.transport.getPeer().port)
 			Client.Client.__init__(self, self.root, peer, self.session_id)
+			self.connect_time = time.time()
+			self.root.idle_wheel.add(self)
+			if self.root.capture:
+				self.root.capture.connected(self.session_id)
 			self.root.protocol._new(self)
 		except Exception as e:
 			logging.error("Error in adding client: %s %s %s" %(str(e), self.transport.getPeer().host, str(traceback.format_exc())))
@@ -42,25 +60,28 @@ class Chat(protocol.Protocol, Client.Client, TimeoutMixin):
 	def connectionLost(self, reason):
 		if not hasattr(self, 'session_id'): # this func is called after a client has dc'ed
 			return
+		self.root.idle_wheel.discard(self)
+		if self.root.capture:
+			self.root.capture.disconnected(self.session_id)
+		if self.root.protocol._detach(self, str(reason.value)):
+			return # kept for RESUME until the grace period ends
 		self.root.protocol._remove(self, str(reason.value))
 		del self.root.clients[self.session_id]
 
 	def removePWs(self, data):
-		# remove pw from LOGIN msg, to avoid appearing in logfile
+		# remove passwords (LOGIN, REGISTER, CHANGEPASSWORD, ...) to avoid them appearing in logfiles
 		data = data.decode("UTF-8")
-		if not "LOGIN" in data: return data.encode('UTF-8')
-		words = data.split(" ")
-		if data.startswith('#') and len(words)>= 3:
-			words[3] = "*"
-		elif data.startswith('LOGIN') and len(words)>= 2:
-			words[2] = "*"
-		data = " ".join(words)
+		data = "\n".join(TrafficCapture.redact(line) for line in data.split("\n"))
 		return data.encode('UTF-8')
+
+	def HandleProtocolCommand(self, cmd):
+		if self.root.capture and cmd:
+			self.root.capture.line(self.session_id, cmd)
+		Client.Client.HandleProtocolCommand(self, cmd)
 		
 	def dataReceived(self, data):
+		self._root.metrics.bytes_received.inc(len(data))
 		try:
-			if self.username:
-				self.resetTimeout() #reset timeout for authentificated users when data is received
 			self.Handle(data.decode("utf-8"))
 			self._root.session_manager.commit_guard()			
 		except UnicodeDecodeError as e:
@@ -73,12 +94,26 @@ class Chat(protocol.Protocol, Client.Client, TimeoutMixin):
 		finally:
 			self._root.session_manager.close_guard()
 			
+	def timeoutDeadline(self):
+		# when root.idle_wheel times out this connection: idle_timeout after the last data once logged in, login_timeout after connecting before
+		if self.username:
+			return self.lastdata + self.root.idle_timeout
+		return self.connect_time + self.root.login_timeout
+
 	def timeoutConnection(self):
 		self.transport.abortConnection()
 
 	def Remove(self, reason='Quit'):
+		self.removing = True # not resumable
+		if self.username in self.root.detached and self.root.detached[self.username][0] is self:
+			self.root.protocol._expire(self, reason) # kicked while its connection is gone
+			return
 		self.transport.abortConnection()
 
+	def StartCompression(self, level):
+		compressor = Compression.Compressor(level, self.root.compress_budget)
+		self.transport = Compression.CompressingTransport(self.transport, compressor, reactor.callLater, self.root.metrics)
+
 	def StartTLS(self):
 		try:
 			self.transport.startTLS(self.root.sslFactory)
@@ -96,3 +131,87 @@ class ChatFactory(Factory):
 	def buildProtocol(self, addr):
 		return Chat(self.root)
 
+
+class WorkerTransport:
+	'a client connection held by a Frontend worker process'
+	def __init__(self, link, session, host, port):
+		self.link = link
+		self.session = session
+		self.peer = Frontend.Peer(host, port)
+
+	def getPeer(self):
+		return self.peer
+
+	def write(self, data):
+		self.link.sendFrame(Frontend.SEND, self.session, data)
+
+	def abortConnection(self):
+		self.link.sendFrame(Frontend.KICK, self.session)
+
+	loseConnection = abortConnection
+
+	def startTLS(self, options):
+		self.link.sendFrame(Frontend.STARTTLS, self.session)
+
+class WorkerChat(Chat):
+	'a client whose framing and flood control happen in a worker, dataReceived gets complete lines'
+	def __init__(self, root):
+		Chat.__init__(self, root)
+		self.sent_limits = None
+
+	def Handle(self, data):
+		self.lastdata = int(time.time())
+		self.HandleProtocolCommands(data.split("\n"), self.flood_limits())
+		self.sendLimits()
+
+	def flushBuffer(self):
+		Chat.flushBuffer(self)
+		self.sendLimits() # the end of LOGIN, the limits change with the access
+
+	def sendLimits(self):
+		limits = self.flood_limits()
+		if limits is self.sent_limits:
+			return
+		self.sent_limits = limits
+		self.transport.link.sendFrame(Frontend.LIMITS, self.transport.session, ('%d %d %d' % (limits['bytespersecond'], limits['seconds'], limits['msglength'])).encode('utf-8'))
+
+class WorkerLink(Frontend.FrameReceiver):
+	'connection from one Frontend worker'
+	def connectionMade(self):
+		Frontend.FrameReceiver.connectionMade(self)
+		self.clients = {} # worker session -> WorkerChat
+		logging.info("Frontend worker connected")
+
+	def connectionLost(self, reason):
+		logging.error("Lost a frontend worker with %d clients" % len(self.clients))
+		for session in list(self.clients):
+			self.closed(session, error.ConnectionLost('frontend worker gone'))
+
+	def closed(self, session, reason):
+		client = self.clients.pop(session)
+		client.connectionLost(failure.Failure(reason))
+
+	def frameReceived(self, kind, session, payload):
+		if kind == Frontend.CONNECT:
+			host, port = payload.decode('utf-8').split(' ')
+			client = WorkerChat(self.factory.root)
+			self.clients[session] = client
+			client.makeConnection(WorkerTransport(self, session, host, int(port)))
+			if hasattr(client, 'session_id'): # not turned away by connectionMade
+				client.sendLimits()
+		elif not session in self.clients:
+			return
+		elif kind == Frontend.DATA:
+			self.clients[session].dataReceived(payload)
+		elif kind == Frontend.CLOSE:
+			self.closed(session, error.ConnectionDone())
+		elif kind == Frontend.FLOOD:
+			count, reason = payload.decode('utf-8').split(' ', 1)
+			self.clients[session].ReportFloodBreach(reason, int(count))
+
+class WorkerLinkFactory(Factory):
+	protocol = WorkerLink
+
+	def __init__(self, root):
+		self.root = root
+		assert(self.root.userdb != None)